@@ -0,0 +1,80 @@
+import asyncio
+import logging
+import os
+
+from db_utils import upsert_daily_activity_many
+
+logger = logging.getLogger(__name__)
+
+# Активность пишется в БД не на каждое сообщение, а пачками:
+# раз в ACTIVITY_FLUSH_INTERVAL секунд (это же максимальное окно потерь
+# при падении процесса) или раньше, если накопилось ACTIVITY_MAX_PENDING ключей.
+# ACTIVITY_FLUSH_INTERVAL=0 — писать сразу, как раньше.
+ACTIVITY_FLUSH_INTERVAL = float(os.environ.get("ACTIVITY_FLUSH_INTERVAL", "30"))
+ACTIVITY_MAX_PENDING = int(os.environ.get("ACTIVITY_MAX_PENDING", "5000"))
+
+
+class ActivityBuffer:
+    """
+    Копит первую/последнюю активность по ключу (chat_id, user_id, day)
+    и сбрасывает накопленное одним executemany.
+    Используется только из потока event loop, поэтому без блокировок.
+    """
+
+    def __init__(self):
+        self._pending = {}
+        self._flush_task = None
+
+    def __len__(self):
+        return len(self._pending)
+
+    def record(self, chat_id, user_id, username, msg_datetime):
+        key = (chat_id, user_id, msg_datetime.date().isoformat())
+        entry = self._pending.get(key)
+        if entry is None:
+            self._pending[key] = [username, msg_datetime, msg_datetime]
+        else:
+            entry[0] = username
+            entry[1] = min(entry[1], msg_datetime)
+            entry[2] = max(entry[2], msg_datetime)
+
+        if ACTIVITY_FLUSH_INTERVAL <= 0 or len(self._pending) >= ACTIVITY_MAX_PENDING:
+            self._schedule_flush()
+
+    def _schedule_flush(self):
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.get_running_loop().create_task(self.flush())
+
+    def _merge_back(self, batch):
+        for key, (username, first, last) in batch.items():
+            entry = self._pending.get(key)
+            if entry is None:
+                self._pending[key] = [username, first, last]
+            else:
+                entry[1] = min(entry[1], first)
+                entry[2] = max(entry[2], last)
+
+    async def flush(self):
+        if not self._pending:
+            return
+        batch, self._pending = self._pending, {}
+        rows = [
+            (chat_id, user_id, username, day, first.isoformat(), last.isoformat())
+            for (chat_id, user_id, day), (username, first, last) in batch.items()
+        ]
+        try:
+            await upsert_daily_activity_many.aio(rows)
+        except Exception:
+            logger.exception("Не удалось записать активность, повторим при следующем сбросе")
+            self._merge_back(batch)
+
+    async def run(self):
+        """Фоновый цикл периодического сброса."""
+        if ACTIVITY_FLUSH_INTERVAL <= 0:
+            return
+        while True:
+            await asyncio.sleep(ACTIVITY_FLUSH_INTERVAL)
+            await self.flush()
+
+
+activity_buffer = ActivityBuffer()
@@ -0,0 +1,162 @@
+import hashlib
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from db_utils import (
+    get_cached_answer,
+    load_cached_answers,
+    prune_answer_cache,
+    save_cached_answer,
+)
+from text_search import STOP_WORDS, stem_ru, tokenize
+
+logger = logging.getLogger(__name__)
+
+# Кеш ответов на повторяющиеся вопросы. Ключ — нормализованный вопрос плюс
+# набор найденных фрагментов базы знаний, поэтому при изменении базы ключ
+# меняется сам; удалённые записи вычищаются явно (invalidate_knowledge и
+# delete_knowledge_rows). В памяти — LRU, в SQLite — копия для рестартов.
+# Вопросы с историей разговора кеш не используют (см. process_user_input).
+ANSWER_CACHE_ENABLED = os.environ.get("ANSWER_CACHE_ENABLED", "1") == "1"
+ANSWER_CACHE_TTL = float(os.environ.get("ANSWER_CACHE_TTL", str(24 * 3600)))
+ANSWER_CACHE_SIZE = int(os.environ.get("ANSWER_CACHE_SIZE", "500"))
+ANSWER_CACHE_MAX_ROWS = int(os.environ.get("ANSWER_CACHE_MAX_ROWS", "5000"))
+_PRUNE_EVERY = 100
+
+
+def normalize_question(text):
+    """Основы значимых слов: «Где график уборки?» и «график уборки» совпадают."""
+    return " ".join(
+        stem_ru(token) for token in tokenize(text) if token not in STOP_WORDS
+    )
+
+
+def make_key(normalized, chunk_ids):
+    raw = normalized + "|" + ",".join(str(i) for i in sorted(chunk_ids))
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class AnswerCache:
+    def __init__(self):
+        self._lock = threading.Lock()
+        # key -> (answer, has_knowledge, knowledge_ids, created_at)
+        self._entries = OrderedDict()
+        # нормализованный вопрос -> key: быстрый путь без поиска по базе знаний
+        self._by_question = {}
+        # key -> нормализованный вопрос, чтобы убрать его вместе с записью
+        self._question_of = {}
+        self._puts = 0
+
+    def _min_created_at(self):
+        return time.time() - ANSWER_CACHE_TTL
+
+    def _link_question(self, normalized, key):
+        self._by_question[normalized] = key
+        self._question_of[key] = normalized
+
+    def _drop(self, key):
+        """Удаляет запись вместе со ссылкой на неё из быстрого пути."""
+        self._entries.pop(key, None)
+        normalized = self._question_of.pop(key, None)
+        if normalized is not None and self._by_question.get(normalized) == key:
+            del self._by_question[normalized]
+
+    def _remember(self, key, normalized, entry):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        if normalized:
+            self._link_question(normalized, key)
+        while len(self._entries) > ANSWER_CACHE_SIZE:
+            self._drop(next(iter(self._entries)))
+
+    def _get_fresh(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[3] < self._min_created_at():
+            self._drop(key)
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def lookup_fast(self, question):
+        """Ответ по одному лишь вопросу — если база знаний с тех пор не менялась."""
+        if not ANSWER_CACHE_ENABLED:
+            return None
+        normalized = normalize_question(question)
+        with self._lock:
+            key = self._by_question.get(normalized)
+            return self._get_fresh(key) if key else None
+
+    async def lookup(self, question, chunk_ids):
+        """Ответ для вопроса и найденного набора фрагментов (память, затем SQLite)."""
+        if not ANSWER_CACHE_ENABLED:
+            return None
+        normalized = normalize_question(question)
+        key = make_key(normalized, chunk_ids)
+        with self._lock:
+            entry = self._get_fresh(key)
+            if entry is not None:
+                self._link_question(normalized, key)
+                return entry
+        row = await get_cached_answer.aio(key, self._min_created_at())
+        if row is None:
+            return None
+        # created_at из SQLite: TTL отсчитывается от момента ответа, а не чтения
+        entry = row
+        with self._lock:
+            self._remember(key, normalized, entry)
+        return entry
+
+    async def put(self, question, chunk_ids, knowledge_ids, has_knowledge, answer):
+        if not ANSWER_CACHE_ENABLED or not answer:
+            return
+        normalized = normalize_question(question)
+        if not normalized:
+            return
+        key = make_key(normalized, chunk_ids)
+        created_at = time.time()
+        with self._lock:
+            self._remember(key, normalized, (answer, has_knowledge, list(knowledge_ids), created_at))
+            self._puts += 1
+            prune = self._puts % _PRUNE_EVERY == 0
+        await save_cached_answer.aio(
+            key, question, answer, has_knowledge, list(knowledge_ids), created_at
+        )
+        if prune:
+            await prune_answer_cache.aio(self._min_created_at(), ANSWER_CACHE_MAX_ROWS)
+
+    def warm_up(self):
+        """Загружает свежие записи из SQLite в память (при старте)."""
+        rows = load_cached_answers(self._min_created_at(), ANSWER_CACHE_SIZE)
+        with self._lock:
+            for key, answer, has_knowledge, knowledge_ids, created_at in reversed(rows):
+                ids = [int(i) for i in knowledge_ids.split(",") if i]
+                self._remember(key, None, (answer, bool(has_knowledge), ids, created_at))
+        logger.info(f"Кеш ответов: загружено {len(rows)} записей")
+
+    def invalidate_knowledge(self, knowledge_ids):
+        """Записи базы знаний удалены или заменены: убираем ответы, основанные на них."""
+        removed = set(knowledge_ids)
+        with self._lock:
+            stale = [key for key, entry in self._entries.items() if removed & set(entry[2])]
+            for key in stale:
+                self._drop(key)
+
+    def knowledge_added(self):
+        """
+        В базу знаний добавлены записи: для любого вопроса может найтись
+        другой набор фрагментов, поэтому быстрый путь сбрасывается, а ответы,
+        данные без опоры на базу знаний, удаляются.
+        """
+        with self._lock:
+            self._by_question.clear()
+            self._question_of.clear()
+            for key in [key for key, entry in self._entries.items() if not entry[1]]:
+                del self._entries[key]
+
+
+answer_cache = AnswerCache()
@@ -0,0 +1,431 @@
+"""
+Нагрузочный прогон бота без сети: синтетические обновления Telegram
+(текст, голосовые, документы, команды) проходят через настоящие хендлеры
+Application из main.py, а OpenAI, Google и Telegram заменены локальными
+заглушками с настраиваемой задержкой.
+
+Пример:
+    python benchmark.py --rate 20 --duration 30 --mix text=70,voice=10,document=10,command=10 \
+        --openai-latency lognormal:400:0.5 --json bench.json --max-p95-ms 5000
+
+Задержка задаётся как fixed:MS, uniform:MIN_MS:MAX_MS, exp:MEAN_MS
+или lognormal:MEDIAN_MS:SIGMA. Код выхода 1, если p95 какого-либо типа
+превысил --max-p95-ms или блокировка event loop — --max-blocked-ms
+(удобно как проверка регрессий перед выкладкой).
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import math
+import os
+import random
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+STREAM_CURSOR = " ▌"
+TELEGRAM_PORT = 18081
+
+
+class Latency:
+    """Распределение задержки; sample() — секунды."""
+
+    def __init__(self, spec):
+        kind, *params = spec.split(":")
+        self.kind = kind
+        if kind not in ("fixed", "uniform", "exp", "lognormal"):
+            raise ValueError(f"Неизвестное распределение: {spec}")
+        # Все параметры в миллисекундах, кроме sigma у lognormal
+        self.params = [float(p) if kind == "lognormal" and i == 1 else float(p) / 1000
+                       for i, p in enumerate(params)]
+
+    def sample(self):
+        p = self.params
+        if self.kind == "fixed":
+            return p[0]
+        if self.kind == "uniform":
+            return random.uniform(p[0], p[1])
+        if self.kind == "exp":
+            return random.expovariate(1 / p[0]) if p[0] > 0 else 0.0
+        return p[0] * math.exp(random.gauss(0, p[1] if len(p) > 1 else 0.5))
+
+    __call__ = sample
+
+
+def percentile(values, q):
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, math.ceil(q / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+# ---------- Заглушки внешних сервисов ----------
+
+QUESTIONS = [
+    "Как убирать ресторан после открытия?",
+    "Какие средства использовать для мытья окон?",
+    "Сколько стоит генеральная уборка офиса?",
+    "Какой график уборки в торговом центре?",
+    "Что делать, если клиент недоволен уборкой?",
+    "Как часто менять тряпки и швабры?",
+    "Какая униформа у сотрудников?",
+    "Как оформить заявку на уборку?",
+]
+
+
+class FakeOpenAI:
+    """Тот же интерфейс, что у openai.AsyncOpenAI, в объёме, который использует бот."""
+
+    def __init__(self, latency, token_delay, answer_tokens=60):
+        self.latency = latency
+        self.token_delay = token_delay
+        self.answer_tokens = answer_tokens
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._chat))
+        self.audio = SimpleNamespace(transcriptions=SimpleNamespace(create=self._transcribe))
+
+    def _answer(self):
+        return " ".join(random.choice(["Лиза", "советует", "убирать", "аккуратно", "и", "быстро"])
+                        for _ in range(self.answer_tokens))
+
+    def _usage(self, messages):
+        prompt = sum(len(str(m.get("content", "")).split()) for m in messages)
+        return SimpleNamespace(prompt_tokens=prompt, completion_tokens=self.answer_tokens)
+
+    async def _chat(self, model, messages, stream=False, stream_options=None, timeout=None):
+        await asyncio.sleep(self.latency())
+        if not stream:
+            message = SimpleNamespace(content=self._answer())
+            return SimpleNamespace(
+                choices=[SimpleNamespace(message=message)], usage=self._usage(messages)
+            )
+        return self._stream(self._usage(messages))
+
+    async def _stream(self, usage):
+        for word in self._answer().split():
+            await asyncio.sleep(self.token_delay())
+            delta = SimpleNamespace(content=word + " ")
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=delta)], usage=None)
+        yield SimpleNamespace(choices=[], usage=usage)
+
+    async def _transcribe(self, model, file, timeout=None):
+        await asyncio.sleep(self.latency())
+        return SimpleNamespace(text=random.choice(QUESTIONS))
+
+
+class _Request:
+    def __init__(self, value, latency):
+        self.value = value
+        self.latency = latency
+
+    def execute(self):
+        time.sleep(self.latency())  # клиенты Google вызываются из потоков
+        return self.value
+
+
+class FakeGoogle:
+    """Docs и Sheets в объёме команд /doc и /sheet."""
+
+    def __init__(self, latency):
+        self.latency = latency
+
+    def documents(self):
+        return self
+
+    def spreadsheets(self):
+        return self
+
+    def values(self):
+        return self
+
+    def get(self, documentId=None, spreadsheetId=None, range=None):
+        if documentId is not None:
+            text = f"Регламент {documentId}\n\nУборка выполняется ежедневно. " * 20
+            body = {"content": [{"paragraph": {"elements": [{"textRun": {"content": text}}]}}]}
+            return _Request({"body": body}, self.latency)
+        rows = [[f"Объект {i}", "ежедневно", f"{i * 100} руб."] for i in range(50)]
+        return _Request({"values": rows}, self.latency)
+
+
+class _EmbeddingWithLatency:
+    """Обёртка бэкенда эмбеддингов: добавляет задержку сетевого запроса."""
+
+    def __init__(self, backend, latency):
+        self.backend = backend
+        self.name = backend.name
+        self.latency = latency
+
+    def embed(self, texts):
+        time.sleep(self.latency())
+        return self.backend.embed(texts)
+
+
+# ---------- Мониторинг event loop ----------
+
+class LoopMonitor:
+    """Раз в interval проверяет, насколько event loop опаздывает проснуться."""
+
+    def __init__(self, interval=0.01, threshold=0.005):
+        self.interval = interval
+        self.threshold = threshold
+        self.lags = []
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            self.lags.append(max(0.0, loop.time() - expected))
+
+    def report(self):
+        blocked = [lag for lag in self.lags if lag > self.threshold]
+        return {
+            "samples": len(self.lags),
+            "max_lag_ms": round(max(self.lags, default=0) * 1000, 1),
+            "p99_lag_ms": round(percentile(self.lags, 99) * 1000, 1) if self.lags else 0,
+            "blocked_ms": round(sum(blocked) * 1000, 1),
+            "stalls": len(blocked),
+        }
+
+
+# ---------- Прогон ----------
+
+class Bench:
+    def __init__(self, args):
+        self.args = args
+        self.pending = {}  # chat_id -> (kind, started_at, first_reply_at)
+        self.results = {}  # kind -> {"first": [...], "done": [...]}
+        self.ids = itertools.count(1)
+        self.completed = asyncio.Event()
+
+    def on_send(self, method, params):
+        chat_id = int(params.get("chat_id", 0))
+        entry = self.pending.get(chat_id)
+        if entry is None:
+            return
+        kind, started, first = entry
+        now = time.perf_counter()
+        if first is None:
+            first = now
+            self.pending[chat_id] = (kind, started, first)
+        text = params.get("text", "")
+        # Промежуточные сообщения: кусок потокового ответа и «поставлено в очередь»
+        if text.endswith(STREAM_CURSOR.strip()) or text.startswith(("📥", "⏳")):
+            return
+        del self.pending[chat_id]
+        stats = self.results.setdefault(kind, {"first": [], "done": []})
+        stats["first"].append(first - started)
+        stats["done"].append(now - started)
+        if not self.pending:
+            self.completed.set()
+
+    def make_update(self, kind, telegram, admin_id):
+        from telegram import Update
+
+        n = next(self.ids)
+        # У каждого запроса свой чат и пользователь: так ответы однозначно
+        # сопоставляются с запросами и не склеиваются планировщиком
+        chat_id = user_id = 10_000_000 + n
+        message = {
+            "message_id": n,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": f"u{n}", "username": f"u{n}"},
+        }
+        if kind == "text":
+            message["text"] = random.choice(QUESTIONS)
+        elif kind == "voice":
+            file_id = f"voice{n}"
+            telegram.add_file(file_id, os.urandom(16 * 1024))
+            message["voice"] = {"file_id": file_id, "file_unique_id": file_id,
+                                "duration": 5, "file_size": 16 * 1024}
+        elif kind == "document":
+            file_id = f"doc{n}"
+            text = f"Инструкция {n}\n\n" + "Уборка помещений выполняется по графику. " * 200
+            telegram.add_file(file_id, text.encode("utf-8"))
+            message["document"] = {"file_id": file_id, "file_unique_id": file_id,
+                                   "file_name": f"инструкция_{n}.txt", "file_size": len(text)}
+        else:
+            command = random.choice(["/help", "/start", "/ref уборка", "/doc D1", "/sheet S1 A1:C50"])
+            if command.startswith(("/doc", "/sheet")):
+                # Эти команды доступны только администратору
+                message["from"]["id"] = admin_id
+            message["text"] = command
+            message["entities"] = [{"type": "bot_command", "offset": 0,
+                                    "length": len(command.split()[0])}]
+        return kind, chat_id, Update.de_json({"update_id": n, "message": message}, None)
+
+
+def parse_mix(spec):
+    mix = {}
+    for part in spec.split(","):
+        kind, _, weight = part.partition("=")
+        if kind not in ("text", "voice", "document", "command"):
+            raise ValueError(f"Неизвестный тип сообщения: {kind}")
+        mix[kind] = float(weight or 1)
+    return mix
+
+
+def configure_environment(args, workdir):
+    """Переменные окружения до импорта модулей бота: всё локально и офлайн."""
+    os.environ.update({
+        "BOT_TOKEN": "123456:benchmark",
+        "OPENAI_API_KEY": "benchmark",
+        "GOOGLE_CREDENTIALS_PATH": os.path.join(workdir, "credentials.json"),
+        "LIZA_DB_PATH": os.path.join(workdir, "bench.db"),
+        "TELEGRAM_API_BASE_URL": f"http://127.0.0.1:{args.telegram_port}",
+        "EMBEDDING_BACKEND": "hashing",
+        "EMBEDDED_WORKER": "1",
+        "JOB_POLL_INTERVAL": str(args.job_poll_interval),
+        "LLM_STREAMING": "1" if args.streaming else "0",
+        "ANSWER_CACHE_ENABLED": "1" if args.answer_cache else "0",
+        "STREAM_EDIT_INTERVAL": "0.5",
+        "USER_BURST": "1000",
+    })
+    os.environ.pop("GOOGLE_DRIVE_FOLDER_ID", None)
+    os.environ.pop("ACTIVITY_EXPORT_SPREADSHEET_ID", None)
+
+
+async def run(args):
+    from fake_telegram import FakeTelegram
+
+    import main
+    import embeddings
+    import google_connect
+    import services
+    from handlers import ADMIN_IDS
+
+    # Журнал каждого HTTP-запроса заглушит отчёт
+    for name in ("httpx", "aiohttp.access"):
+        logging.getLogger(name).setLevel(logging.WARNING)
+
+    bench = Bench(args)
+    services.openai_client = FakeOpenAI(
+        Latency(args.openai_latency), Latency(args.token_latency)
+    )
+    google = FakeGoogle(Latency(args.google_latency))
+    google_connect._get_service = lambda api, version: google
+    embeddings.backend = _EmbeddingWithLatency(embeddings.backend, Latency(args.embedding_latency))
+
+    telegram = FakeTelegram(latency=Latency(args.telegram_latency), on_send=bench.on_send)
+    await telegram.start(port=args.telegram_port)
+
+    app = main.app
+    await app.initialize()
+    for i in range(args.knowledge):
+        await services.add_knowledge(
+            f"Регламент {i}",
+            f"Раздел {i}\n\n" + " ".join(random.sample(QUESTIONS, 3)) * 5,
+            ADMIN_IDS[0],
+        )
+    main.start_background_tasks()
+    monitor = LoopMonitor()
+    monitor_task = asyncio.get_running_loop().create_task(monitor.run())
+
+    mix = parse_mix(args.mix)
+    kinds, weights = list(mix), list(mix.values())
+    total = args.count or int(args.rate * args.duration)
+    sent = {}
+    handler_tasks = []
+    started = time.perf_counter()
+    for _ in range(total):
+        kind, chat_id, update = bench.make_update(random.choices(kinds, weights)[0], telegram, ADMIN_IDS[0])
+        update.set_bot(app.bot)
+        update.message.set_bot(app.bot)
+        bench.pending[chat_id] = (kind, time.perf_counter(), None)
+        sent[kind] = sent.get(kind, 0) + 1
+        handler_tasks.append(asyncio.get_running_loop().create_task(app.process_update(update)))
+        await asyncio.sleep(random.expovariate(args.rate))
+    await asyncio.gather(*handler_tasks, return_exceptions=True)
+    # Событие могло сработать в паузе между запросами, пока подавалась нагрузка
+    if bench.pending:
+        bench.completed.clear()
+    try:
+        await asyncio.wait_for(bench.completed.wait(), args.timeout)
+    except asyncio.TimeoutError:
+        pass
+    elapsed = time.perf_counter() - started
+    monitor_task.cancel()
+
+    await main.on_stop(app)
+    await app.shutdown()
+    await main.on_shutdown(app)
+    await telegram.stop()
+
+    report = {"elapsed_s": round(elapsed, 2), "sent": sum(sent.values()), "kinds": {}}
+    done_total = 0
+    for kind in kinds:
+        stats = bench.results.get(kind, {"first": [], "done": []})
+        done_total += len(stats["done"])
+        report["kinds"][kind] = {
+            "sent": sent.get(kind, 0),
+            "done": len(stats["done"]),
+            "first_reply_p50_ms": round(percentile(stats["first"], 50) * 1000, 1),
+            "p50_ms": round(percentile(stats["done"], 50) * 1000, 1),
+            "p95_ms": round(percentile(stats["done"], 95) * 1000, 1),
+            "p99_ms": round(percentile(stats["done"], 99) * 1000, 1),
+        }
+    report["timed_out"] = len(bench.pending)
+    report["throughput_per_s"] = round(done_total / elapsed, 2) if elapsed else 0
+    report["event_loop"] = monitor.report()
+    return report
+
+
+def print_report(report):
+    print(f"Отправлено: {report['sent']}, без ответа: {report['timed_out']}, "
+          f"время: {report['elapsed_s']} с, пропускная способность: {report['throughput_per_s']}/с")
+    print(f"{'тип':<10}{'отпр.':>7}{'готово':>8}{'1-й ответ p50':>15}{'p50':>10}{'p95':>10}{'p99':>10}  (мс)")
+    for kind, stats in report["kinds"].items():
+        print(f"{kind:<10}{stats['sent']:>7}{stats['done']:>8}{stats['first_reply_p50_ms']:>15}"
+              f"{stats['p50_ms']:>10}{stats['p95_ms']:>10}{stats['p99_ms']:>10}")
+    loop = report["event_loop"]
+    print(f"Event loop: макс. задержка {loop['max_lag_ms']} мс, p99 {loop['p99_lag_ms']} мс, "
+          f"заблокирован {loop['blocked_ms']} мс ({loop['stalls']} раз)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rate", type=float, default=10, help="обновлений в секунду (пуассоновский поток)")
+    parser.add_argument("--duration", type=float, default=10, help="секунд подачи нагрузки")
+    parser.add_argument("--count", type=int, default=0, help="ровно столько обновлений (вместо rate*duration)")
+    parser.add_argument("--mix", default="text=70,voice=10,document=10,command=10")
+    parser.add_argument("--openai-latency", default="lognormal:300:0.5")
+    parser.add_argument("--token-latency", default="fixed:5")
+    parser.add_argument("--embedding-latency", default="fixed:0")
+    parser.add_argument("--google-latency", default="lognormal:150:0.3")
+    parser.add_argument("--telegram-latency", default="uniform:5:30")
+    parser.add_argument("--knowledge", type=int, default=100, help="записей в базе знаний перед прогоном")
+    parser.add_argument("--streaming", action=argparse.BooleanOptionalAction, default=True)
+    parser.add_argument("--answer-cache", action=argparse.BooleanOptionalAction, default=True)
+    parser.add_argument("--job-poll-interval", type=float, default=0.2)
+    parser.add_argument("--telegram-port", type=int, default=TELEGRAM_PORT)
+    parser.add_argument("--timeout", type=float, default=120, help="сколько ждать ответов после подачи")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", help="сохранить отчёт в JSON")
+    parser.add_argument("--max-p95-ms", type=float, help="порог p95 для любого типа")
+    parser.add_argument("--max-blocked-ms", type=float, help="порог суммарной блокировки event loop")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    with tempfile.TemporaryDirectory(prefix="liza-bench-") as workdir:
+        configure_environment(args, workdir)
+        report = asyncio.run(run(args))
+
+    print_report(report)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+    failed = report["timed_out"] > 0
+    if args.max_p95_ms is not None:
+        failed |= any(k["p95_ms"] > args.max_p95_ms for k in report["kinds"].values())
+    if args.max_blocked_ms is not None:
+        failed |= report["event_loop"]["blocked_ms"] > args.max_blocked_ms
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
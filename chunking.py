@@ -0,0 +1,101 @@
+import os
+import re
+
+# Нарезка документов на фрагменты для базы знаний: в промпт попадают
+# только подходящие отрывки, а не документ целиком.
+
+CHUNK_MAX_CHARS = int(os.environ.get("CHUNK_MAX_CHARS", "1200"))
+CHUNK_OVERLAP_CHARS = int(os.environ.get("CHUNK_OVERLAP_CHARS", "200"))
+
+_NUMBERED_HEADING_RE = re.compile(r"^(\d+[.)]?)+\s+\S")
+_SENTENCE_END_RE = re.compile(r"(?<=[.!?…])\s+")
+
+
+def _is_heading(line):
+    """Эвристика заголовка: markdown, нумерация «1.2 Раздел» или короткая строка капсом/без точки."""
+    line = line.strip()
+    if not line or len(line) > 100:
+        return False
+    if line.startswith("#"):
+        return True
+    if line.endswith((".", ",", ";", ":")):
+        return False
+    if _NUMBERED_HEADING_RE.match(line) and len(line) <= 80:
+        return True
+    letters = [ch for ch in line if ch.isalpha()]
+    return len(letters) >= 3 and all(ch.isupper() for ch in letters)
+
+
+def _sections(text):
+    """Делит текст на (заголовок, [абзацы]) по найденным заголовкам."""
+    heading = ""
+    paragraphs = []
+    current = []
+    for line in text.splitlines():
+        if _is_heading(line):
+            if current:
+                paragraphs.append(" ".join(current))
+                current = []
+            if paragraphs:
+                yield heading, paragraphs
+                paragraphs = []
+            heading = line.strip().lstrip("#").strip()
+        elif not line.strip():
+            if current:
+                paragraphs.append(" ".join(current))
+                current = []
+        else:
+            current.append(line.strip())
+    if current:
+        paragraphs.append(" ".join(current))
+    if paragraphs:
+        yield heading, paragraphs
+
+
+def _split_long(paragraph, max_chars):
+    """Слишком длинный абзац режется по предложениям, в крайнем случае — по длине."""
+    pieces = []
+    for sentence in _SENTENCE_END_RE.split(paragraph):
+        while len(sentence) > max_chars:
+            pieces.append(sentence[:max_chars])
+            sentence = sentence[max_chars:]
+        if sentence:
+            pieces.append(sentence)
+    return pieces
+
+
+def _overlap_tail(text, overlap):
+    """Хвост фрагмента для перекрытия, начинающийся с границы слова."""
+    if overlap <= 0 or len(text) <= overlap:
+        return ""
+    tail = text[-overlap:]
+    space = tail.find(" ")
+    return tail[space + 1:] if space != -1 else tail
+
+
+def split_into_chunks(text, max_chars=CHUNK_MAX_CHARS, overlap=CHUNK_OVERLAP_CHARS):
+    """
+    Возвращает [(заголовок, фрагмент), ...]. Фрагменты не пересекают границы
+    разделов, внутри раздела соседние фрагменты перекрываются на ~overlap символов.
+    """
+    chunks = []
+    for heading, paragraphs in _sections(text):
+        pieces = []
+        for paragraph in paragraphs:
+            pieces.extend(_split_long(paragraph, max_chars))
+
+        current = ""
+        for piece in pieces:
+            candidate = f"{current}\n{piece}" if current else piece
+            if len(candidate) <= max_chars:
+                current = candidate
+                continue
+            if current:
+                chunks.append((heading, current))
+                tail = _overlap_tail(current, overlap)
+                current = f"{tail}\n{piece}" if tail and len(tail) + len(piece) < max_chars else piece
+            else:
+                current = piece
+        if current:
+            chunks.append((heading, current))
+    return chunks
@@ -0,0 +1,102 @@
+import logging
+import os
+
+from db_utils import (
+    add_conversation_turns,
+    get_conversation_summary,
+    get_recent_turns,
+    get_turns_to_summarize,
+    save_conversation_summary,
+)
+
+logger = logging.getLogger(__name__)
+
+# История диалога: последние HISTORY_WINDOW_TURNS реплик хранятся как есть,
+# более старые раз в HISTORY_SUMMARY_BATCH реплик сворачиваются в краткое
+# содержание. В промпт история попадает в пределах HISTORY_TOKEN_BUDGET.
+HISTORY_WINDOW_TURNS = int(os.environ.get("HISTORY_WINDOW_TURNS", "12"))
+HISTORY_SUMMARY_BATCH = int(os.environ.get("HISTORY_SUMMARY_BATCH", "10"))
+HISTORY_TOKEN_BUDGET = int(os.environ.get("HISTORY_TOKEN_BUDGET", "1500"))
+HISTORY_TURN_MAX_CHARS = 2000
+
+SUMMARY_PROMPT = (
+    "Сожми переписку пользователя с Лизой в краткое содержание (до 10 предложений): "
+    "о чём спрашивали, что ответили, важные детали и договорённости. "
+    "Если есть предыдущее краткое содержание, дополни его."
+)
+
+_summarizing = set()
+
+
+def estimate_tokens(text):
+    """Грубая оценка числа токенов (для кириллицы ~3 символа на токен)."""
+    return len(text) // 3 + 1
+
+
+async def build_history(chat_id, user_id):
+    """
+    Сообщения истории для промпта: краткое содержание и последние реплики,
+    начиная с самых свежих, пока укладываемся в бюджет токенов.
+    """
+    summary = await get_conversation_summary.aio(chat_id, user_id)
+    turns = await get_recent_turns.aio(chat_id, user_id, HISTORY_WINDOW_TURNS)
+
+    budget = HISTORY_TOKEN_BUDGET
+    messages = []
+    for role, content in turns:
+        cost = estimate_tokens(content)
+        if cost > budget:
+            break
+        budget -= cost
+        messages.append({"role": role, "content": content})
+    messages.reverse()
+
+    if summary and estimate_tokens(summary) <= budget:
+        messages.insert(0, {
+            "role": "system",
+            "content": f"Краткое содержание предыдущего разговора:\n{summary}",
+        })
+    return messages
+
+
+async def remember_exchange(chat_id, user_id, question, answer):
+    """
+    Дописывает вопрос и ответ в историю (вставка, без перезаписи старого).
+    Возвращает True, если пора свернуть старые реплики в краткое содержание.
+    """
+    count = await add_conversation_turns.aio(chat_id, user_id, [
+        ("user", question[:HISTORY_TURN_MAX_CHARS]),
+        ("assistant", answer[:HISTORY_TURN_MAX_CHARS]),
+    ])
+    return count >= HISTORY_WINDOW_TURNS + HISTORY_SUMMARY_BATCH
+
+
+async def summarize(chat_id, user_id, complete):
+    """
+    Сворачивает реплики старше окна в краткое содержание и удаляет их.
+    complete(messages) -> str — вызов LLM.
+    """
+    key = (chat_id, user_id)
+    if key in _summarizing:
+        return
+    _summarizing.add(key)
+    try:
+        turns = await get_turns_to_summarize.aio(chat_id, user_id, HISTORY_WINDOW_TURNS)
+        if not turns:
+            return
+        summary = await get_conversation_summary.aio(chat_id, user_id)
+        transcript = "\n".join(
+            f"{'Пользователь' if role == 'user' else 'Лиза'}: {content}"
+            for _, role, content in turns
+        )
+        if summary:
+            transcript = f"Предыдущее краткое содержание:\n{summary}\n\nНовые реплики:\n{transcript}"
+        new_summary = await complete([
+            {"role": "system", "content": SUMMARY_PROMPT},
+            {"role": "user", "content": transcript},
+        ])
+        await save_conversation_summary.aio(chat_id, user_id, new_summary, turns[-1][0])
+    except Exception:
+        logger.exception("Не удалось свернуть историю диалога")
+    finally:
+        _summarizing.discard(key)
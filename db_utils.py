@@ -1,17 +1,41 @@
-import sqlite3
+import hashlib
 from datetime import datetime
 
+from storage import db_read, db_write
+from chunking import split_into_chunks
+from text_search import build_match_query, stem_text
 
-def create_db():
-    conn = sqlite3.connect("liza_db.db")
+
+@db_write
+def create_db(conn):
     cursor = conn.cursor()
 
+    # История диалога: по строке на реплику, старые реплики сворачиваются
+    # в conversation_summaries (см. conversation.py)
     cursor.execute("""
-        CREATE TABLE IF NOT EXISTS conversations (
-            user_id INTEGER PRIMARY KEY,
-            context TEXT
+        CREATE TABLE IF NOT EXISTS conversation_turns (
+            id         INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id    INTEGER,
+            user_id    INTEGER,
+            role       TEXT,   -- 'user' | 'assistant'
+            content    TEXT,
+            created_at TEXT
+        )
+    """)
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_conversation_turns_chat_user "
+        "ON conversation_turns (chat_id, user_id, id)"
+    )
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS conversation_summaries (
+            chat_id    INTEGER,
+            user_id    INTEGER,
+            summary    TEXT,
+            updated_at TEXT,
+            PRIMARY KEY (chat_id, user_id)
         )
     """)
+    _migrate_legacy_conversations(conn)
 
     cursor.execute("""
         CREATE TABLE IF NOT EXISTS documents (
@@ -28,7 +52,8 @@ def create_db():
             title TEXT,
             content TEXT,
             added_by INTEGER,
-            timestamp TEXT
+            timestamp TEXT,
+            content_hash TEXT
         )
     """)
 
@@ -44,104 +69,1215 @@ def create_db():
             PRIMARY KEY (chat_id, user_id, day)
         )
     """)
+    # updated_at — когда строка последний раз менялась: по нему экспорт
+    # в Google Sheets выбирает только новые и изменённые строки
+    _add_column_if_missing(conn, "daily_user_activity", "updated_at", "REAL DEFAULT 0")
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_daily_user_activity_updated "
+        "ON daily_user_activity (updated_at)"
+    )
+    # Строки, накопленные до появления колонки, получили 0 и оказались бы
+    # ниже любого водяного знака — отмечаем их изменёнными сейчас
+    cursor.execute(
+        "UPDATE daily_user_activity SET updated_at = ? WHERE updated_at = 0 OR updated_at IS NULL",
+        (datetime.now().timestamp(),),
+    )
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_daily_user_activity_day "
+        "ON daily_user_activity (day)"
+    )
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_daily_user_activity_chat_day "
+        "ON daily_user_activity (chat_id, day)"
+    )
+    # Сводки активности для /stats, обновляются вместе с daily_user_activity:
+    # по дню и чату и по пользователю в чате (за всё время).
+    # span_seconds — сумма (last_msg - first_msg) по пользователе-дням.
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS activity_rollup_day (
+            day          TEXT,
+            chat_id      INTEGER,
+            active_users INTEGER,
+            first_msg    TEXT,
+            last_msg     TEXT,
+            span_seconds INTEGER,
+            PRIMARY KEY (day, chat_id)
+        )
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS activity_rollup_user (
+            chat_id      INTEGER,
+            user_id      INTEGER,
+            username     TEXT,
+            days_active  INTEGER,
+            first_day    TEXT,
+            last_day     TEXT,
+            span_seconds INTEGER,
+            PRIMARY KEY (chat_id, user_id)
+        )
+    """)
+    # По пользователю за день во всех чатах сразу: день в нескольких чатах
+    # считается один раз. По ней — отчёт /stats по пользователям вне группы.
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS activity_rollup_user_day (
+            user_id   INTEGER,
+            day       TEXT,
+            username  TEXT,
+            first_msg TEXT,
+            last_msg  TEXT,
+            PRIMARY KEY (user_id, day)
+        )
+    """)
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_activity_rollup_user_day_day "
+        "ON activity_rollup_user_day (day, user_id)"
+    )
+    _build_activity_rollups(conn)
 
-    conn.commit()
-    conn.close()
-
-
-def save_conversation(user_id, message):
-    conn = sqlite3.connect("liza_db.db")
-    cursor = conn.cursor()
+    # Очередь фоновых задач (см. jobs.py и worker.py). Задачу забирает воркер,
+    # ставя locked_until; если он не продлил аренду и не завершил задачу
+    # (упал), по истечении аренды задачу заберёт другой воркер.
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS jobs (
+            id           INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind         TEXT,
+            payload      TEXT,
+            dedupe_key   TEXT,
+            status       TEXT DEFAULT 'queued',  -- queued / running / done / failed
+            attempts     INTEGER DEFAULT 0,
+            max_attempts INTEGER DEFAULT 3,
+            run_after    REAL,
+            locked_until REAL,
+            worker       TEXT,
+            result       TEXT,
+            error        TEXT,
+            notified     INTEGER DEFAULT 0,
+            created_at   REAL,
+            finished_at  REAL
+        )
+    """)
     cursor.execute(
-        "REPLACE INTO conversations (user_id, context) VALUES (?, ?)",
-        (user_id, message)
+        "CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status, run_after)"
+    )
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_jobs_unnotified ON jobs (notified, status)"
+    )
+    # Ход выполнения: воркер пишет текст и сбрасывает progress_notified,
+    # бот показывает его в статусном сообщении и отмечает показанным
+    _add_column_if_missing(conn, "jobs", "progress", "TEXT")
+    _add_column_if_missing(conn, "jobs", "progress_notified", "INTEGER DEFAULT 1")
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_jobs_progress ON jobs (progress_notified) "
+        "WHERE progress_notified = 0"
     )
-    conn.commit()
-    conn.close()
 
+    # Состояние инкрементального экспорта активности в Google Sheets:
+    # водяной знак по updated_at, следующая свободная строка листа
+    # и номер строки листа для каждой уже выгруженной строки
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS activity_export_state (
+            spreadsheet_id TEXT,
+            range_name     TEXT,
+            watermark      REAL,
+            next_row       INTEGER,
+            PRIMARY KEY (spreadsheet_id, range_name)
+        )
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS activity_export_rows (
+            spreadsheet_id TEXT,
+            range_name     TEXT,
+            chat_id        INTEGER,
+            user_id        INTEGER,
+            day            TEXT,
+            sheet_row      INTEGER,
+            PRIMARY KEY (spreadsheet_id, range_name, chat_id, user_id, day)
+        )
+    """)
 
-def get_conversation(user_id):
-    conn = sqlite3.connect("liza_db.db")
-    cursor = conn.cursor()
+    # Фрагменты документов: в промпт и в поиск попадают они, а не документ целиком
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS knowledge_chunks (
+            id           INTEGER PRIMARY KEY AUTOINCREMENT,
+            knowledge_id INTEGER,
+            seq          INTEGER,
+            heading      TEXT,
+            content      TEXT
+        )
+    """)
     cursor.execute(
-        "SELECT context FROM conversations WHERE user_id = ?",
-        (user_id,)
+        "CREATE INDEX IF NOT EXISTS idx_knowledge_chunks_knowledge "
+        "ON knowledge_chunks (knowledge_id)"
     )
-    result = cursor.fetchone()
-    conn.close()
-    return result[0] if result else ""
 
+    # Полнотекстовый индекс по фрагментам: rowid = knowledge_chunks.id,
+    # в колонках лежит текст, приведённый к основам слов (см. text_search).
+    # Индекс и векторы по целым документам больше не используются.
+    cursor.execute("DROP TABLE IF EXISTS knowledge_fts")
+    cursor.execute("DROP TABLE IF EXISTS knowledge_embeddings")
+    cursor.execute("""
+        CREATE VIRTUAL TABLE IF NOT EXISTS knowledge_chunks_fts USING fts5(
+            title,
+            heading,
+            content,
+            tokenize = 'unicode61 remove_diacritics 2'
+        )
+    """)
+
+    # Векторы фрагментов для семантического поиска (float32, см. embeddings.py)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS chunk_embeddings (
+            chunk_id INTEGER PRIMARY KEY,
+            model    TEXT,
+            vector   BLOB
+        )
+    """)
+    _migrate_knowledge_hashes(conn)
+    _sync_knowledge_chunks(conn)
 
-def save_knowledge(title, content, added_by):
-    conn = sqlite3.connect("liza_db.db")
-    cursor = conn.cursor()
+    # Кеш ответов на повторяющиеся вопросы (см. answer_cache.py) и записи
+    # базы знаний, на которых основан каждый ответ — для инвалидации
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS answer_cache (
+            key           TEXT PRIMARY KEY,
+            question      TEXT,
+            answer        TEXT,
+            has_knowledge INTEGER,
+            knowledge_ids TEXT,
+            created_at    REAL
+        )
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS answer_cache_sources (
+            knowledge_id INTEGER,
+            key          TEXT,
+            PRIMARY KEY (knowledge_id, key)
+        )
+    """)
+
+    # Состояние синхронизации Google Drive: что уже загружено и токен changes.list
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS drive_sync_files (
+            file_id       TEXT PRIMARY KEY,
+            folder_id     TEXT,
+            parent_id     TEXT,
+            name          TEXT,
+            mime_type     TEXT,
+            modified_time TEXT,
+            md5_checksum  TEXT,
+            knowledge_id  INTEGER
+        )
+    """)
+    _add_column_if_missing(conn, "drive_sync_files", "parent_id", "TEXT")
     cursor.execute(
-        "SELECT 1 FROM knowledge WHERE title = ? AND content = ?",
-        (title, content)
+        "CREATE INDEX IF NOT EXISTS idx_drive_sync_files_folder "
+        "ON drive_sync_files (folder_id)"
     )
-    if not cursor.fetchone():
-        cursor.execute(
-            "INSERT INTO knowledge (title, content, added_by, timestamp) "
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS drive_sync_state (
+            folder_id  TEXT PRIMARY KEY,
+            page_token TEXT,
+            synced_at  TEXT
+        )
+    """)
+    # Вложенные папки синхронизируемой папки: folder_id -> parent_id
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS drive_sync_folders (
+            root_id   TEXT,
+            folder_id TEXT,
+            parent_id TEXT,
+            PRIMARY KEY (root_id, folder_id)
+        )
+    """)
+
+    # Кеш извлечённого текста по md5 содержимого файла (общий для загрузок
+    # в Telegram и синхронизации Drive) и дополнительные ключи к нему —
+    # например, file_unique_id из Telegram, известный ещё до скачивания
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS parse_cache (
+            content_md5    TEXT PRIMARY KEY,
+            ext            TEXT,
+            parser_version INTEGER,
+            content        TEXT,
+            parsed_at      REAL
+        )
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS parse_cache_aliases (
+            alias       TEXT PRIMARY KEY,
+            content_md5 TEXT
+        )
+    """)
+
+
+def _add_chunks(conn, knowledge_id, title, content):
+    """Режет документ на фрагменты и индексирует их в FTS."""
+    for seq, (heading, text) in enumerate(split_into_chunks(content or "")):
+        cursor = conn.execute(
+            "INSERT INTO knowledge_chunks (knowledge_id, seq, heading, content) "
             "VALUES (?, ?, ?, ?)",
-            (title, content, added_by, datetime.now().isoformat())
+            (knowledge_id, seq, heading, text),
+        )
+        conn.execute(
+            "INSERT INTO knowledge_chunks_fts (rowid, title, heading, content) "
+            "VALUES (?, ?, ?, ?)",
+            (cursor.lastrowid, stem_text(title or ""), stem_text(heading), stem_text(text)),
         )
-        conn.commit()
-    conn.close()
 
 
-def get_relevant_knowledge(query, limit=3):
-    conn = sqlite3.connect("liza_db.db")
-    cursor = conn.cursor()
-    q = f"%{query.lower()}%"
-    cursor.execute("""
-        SELECT title, content FROM knowledge
-        WHERE LOWER(content) LIKE ? OR LOWER(title) LIKE ?
-        ORDER BY timestamp DESC LIMIT ?
-    """, (q, q, limit))
-    results = cursor.fetchall()
-    conn.close()
-    return [f"{title}\n{content}" for title, content in results]
+def _delete_chunks(conn, knowledge_ids):
+    placeholders = ",".join("?" for _ in knowledge_ids)
+    chunk_filter = (
+        f"SELECT id FROM knowledge_chunks WHERE knowledge_id IN ({placeholders})"
+    )
+    conn.execute(
+        f"DELETE FROM knowledge_chunks_fts WHERE rowid IN ({chunk_filter})",
+        list(knowledge_ids),
+    )
+    conn.execute(
+        f"DELETE FROM chunk_embeddings WHERE chunk_id IN ({chunk_filter})",
+        list(knowledge_ids),
+    )
+    conn.execute(
+        f"DELETE FROM knowledge_chunks WHERE knowledge_id IN ({placeholders})",
+        list(knowledge_ids),
+    )
 
 
-def find_knowledge_by_keyword(keyword):
-    conn = sqlite3.connect("liza_db.db")
-    cursor = conn.cursor()
-    cursor.execute(
-        "SELECT title, content FROM knowledge "
-        "WHERE content LIKE ? ORDER BY timestamp DESC LIMIT 1",
-        (f"%{keyword}%",)
+def _add_column_if_missing(conn, table, column, declaration):
+    columns = [row[1] for row in conn.execute(f"PRAGMA table_info({table})")]
+    if column not in columns:
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {declaration}")
+
+
+_SPAN_SQL = "CAST(ROUND((julianday(last_msg) - julianday(first_msg)) * 86400) AS INTEGER)"
+
+
+def _build_activity_rollups(conn):
+    """Первичное заполнение сводок по уже накопленной активности (каждой — один раз)."""
+    if not conn.execute("SELECT 1 FROM daily_user_activity LIMIT 1").fetchone():
+        return
+    if not conn.execute("SELECT 1 FROM activity_rollup_day LIMIT 1").fetchone():
+        conn.execute(f"""
+            INSERT INTO activity_rollup_day
+                (day, chat_id, active_users, first_msg, last_msg, span_seconds)
+            SELECT day, chat_id, COUNT(*), MIN(first_msg), MAX(last_msg), SUM({_SPAN_SQL})
+            FROM daily_user_activity
+            GROUP BY day, chat_id
+        """)
+        conn.execute(f"""
+            INSERT INTO activity_rollup_user
+                (chat_id, user_id, username, days_active, first_day, last_day, span_seconds)
+            SELECT chat_id, user_id, MAX(username), COUNT(*), MIN(day), MAX(day), SUM({_SPAN_SQL})
+            FROM daily_user_activity
+            GROUP BY chat_id, user_id
+        """)
+    if not conn.execute("SELECT 1 FROM activity_rollup_user_day LIMIT 1").fetchone():
+        conn.execute("""
+            INSERT INTO activity_rollup_user_day (user_id, day, username, first_msg, last_msg)
+            SELECT user_id, day, MAX(username), MIN(first_msg), MAX(last_msg)
+            FROM daily_user_activity
+            GROUP BY user_id, day
+        """)
+
+
+def _span_seconds(first_msg, last_msg):
+    try:
+        delta = datetime.fromisoformat(last_msg) - datetime.fromisoformat(first_msg)
+    except (TypeError, ValueError):
+        return 0
+    return round(delta.total_seconds())
+
+
+def content_hash(content):
+    return hashlib.sha256((content or "").encode("utf-8")).hexdigest()
+
+
+def _migrate_legacy_conversations(conn):
+    """
+    Старая таблица conversations (user_id -> context) в историю для промпта
+    не переносится: кроме сообщений пользователя в context дописывались целые
+    тексты документов (/doc, /sheet, загрузки), и отличить одно от другого
+    нельзя. Таблица переименовывается в conversations_legacy — данные
+    сохраняются, но бот их не читает.
+    """
+    exists = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'conversations'"
+    ).fetchone()
+    if exists:
+        conn.execute("ALTER TABLE conversations RENAME TO conversations_legacy")
+
+
+def _migrate_knowledge_hashes(conn):
+    """
+    Добавляет content_hash к старым записям, удаляет точные дубликаты
+    (одинаковые название и текст) и создаёт уникальный индекс.
+    """
+    _add_column_if_missing(conn, "knowledge", "content_hash", "TEXT")
+
+    rows = conn.execute(
+        "SELECT id, content FROM knowledge WHERE content_hash IS NULL"
+    ).fetchall()
+    conn.executemany(
+        "UPDATE knowledge SET content_hash = ? WHERE id = ?",
+        [(content_hash(content), knowledge_id) for knowledge_id, content in rows],
+    )
+
+    duplicates = [row[0] for row in conn.execute("""
+        SELECT id FROM knowledge
+        WHERE id NOT IN (
+            SELECT MIN(id) FROM knowledge GROUP BY title, content_hash
+        )
+    """)]
+    if duplicates:
+        _delete_chunks(conn, duplicates)
+        placeholders = ",".join("?" for _ in duplicates)
+        conn.execute(f"DELETE FROM knowledge WHERE id IN ({placeholders})", duplicates)
+
+    conn.execute(
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_knowledge_title_hash "
+        "ON knowledge (title, content_hash)"
+    )
+
+
+def _sync_knowledge_chunks(conn):
+    """Нарезает на фрагменты записи, добавленные до появления фрагментов (миграция)."""
+    rows = conn.execute(
+        "SELECT id, title, content FROM knowledge "
+        "WHERE id NOT IN (SELECT knowledge_id FROM knowledge_chunks)"
+    ).fetchall()
+    for knowledge_id, title, content in rows:
+        _add_chunks(conn, knowledge_id, title, content)
+
+
+@db_write
+def add_conversation_turns(conn, chat_id, user_id, turns):
+    """Добавляет реплики [(role, content), ...] и возвращает их текущее число."""
+    now = datetime.now().isoformat()
+    conn.executemany(
+        "INSERT INTO conversation_turns (chat_id, user_id, role, content, created_at) "
+        "VALUES (?, ?, ?, ?, ?)",
+        [(chat_id, user_id, role, content, now) for role, content in turns],
+    )
+    return conn.execute(
+        "SELECT COUNT(*) FROM conversation_turns WHERE chat_id = ? AND user_id = ?",
+        (chat_id, user_id),
+    ).fetchone()[0]
+
+
+@db_read
+def get_recent_turns(conn, chat_id, user_id, limit):
+    """Последние реплики [(role, content), ...], начиная с самой свежей."""
+    return conn.execute(
+        "SELECT role, content FROM conversation_turns "
+        "WHERE chat_id = ? AND user_id = ? ORDER BY id DESC LIMIT ?",
+        (chat_id, user_id, limit),
+    ).fetchall()
+
+
+@db_read
+def get_turns_to_summarize(conn, chat_id, user_id, keep):
+    """Реплики [(id, role, content), ...] старше последних keep, по порядку."""
+    return conn.execute(
+        """
+        SELECT id, role, content FROM conversation_turns
+        WHERE chat_id = ? AND user_id = ? AND id < COALESCE((
+            SELECT MIN(id) FROM (
+                SELECT id FROM conversation_turns
+                WHERE chat_id = ? AND user_id = ? ORDER BY id DESC LIMIT ?
+            )
+        ), 0)
+        ORDER BY id
+        """,
+        (chat_id, user_id, chat_id, user_id, keep),
+    ).fetchall()
+
+
+@db_read
+def get_conversation_summary(conn, chat_id, user_id):
+    row = conn.execute(
+        "SELECT summary FROM conversation_summaries WHERE chat_id = ? AND user_id = ?",
+        (chat_id, user_id),
+    ).fetchone()
+    return row[0] if row else ""
+
+
+@db_write
+def save_conversation_summary(conn, chat_id, user_id, summary, upto_turn_id):
+    """Сохраняет краткое содержание и удаляет вошедшие в него реплики."""
+    conn.execute(
+        "REPLACE INTO conversation_summaries (chat_id, user_id, summary, updated_at) "
+        "VALUES (?, ?, ?, ?)",
+        (chat_id, user_id, summary, datetime.now().isoformat()),
+    )
+    conn.execute(
+        "DELETE FROM conversation_turns WHERE chat_id = ? AND user_id = ? AND id <= ?",
+        (chat_id, user_id, upto_turn_id),
     )
-    result = cursor.fetchone()
-    conn.close()
+
+
+@db_write
+def delete_conversation(conn, user_id):
+    conn.execute("DELETE FROM conversation_turns WHERE user_id = ?", (user_id,))
+    conn.execute("DELETE FROM conversation_summaries WHERE user_id = ?", (user_id,))
+
+
+def _insert_knowledge(conn, title, content, added_by):
+    """
+    Вставляет запись, если такой (название + хеш текста) ещё нет.
+    Возвращает (id, True) для новой записи и (id существующей, False) для дубликата.
+    """
+    digest = content_hash(content)
+    cursor = conn.execute(
+        "INSERT OR IGNORE INTO knowledge (title, content, added_by, timestamp, content_hash) "
+        "VALUES (?, ?, ?, ?, ?)",
+        (title, content, added_by, datetime.now().isoformat(), digest)
+    )
+    if cursor.rowcount:
+        _add_chunks(conn, cursor.lastrowid, title, content)
+        # Ответы, данные без опоры на базу знаний, могли устареть
+        conn.execute("DELETE FROM answer_cache WHERE has_knowledge = 0")
+        return cursor.lastrowid, True
+    row = conn.execute(
+        "SELECT id FROM knowledge WHERE title = ? AND content_hash = ?",
+        (title, digest),
+    ).fetchone()
+    return row[0], False
+
+
+@db_write
+def save_knowledge(conn, title, content, added_by):
+    """Сохраняет запись; возвращает её id или None, если такая уже есть."""
+    knowledge_id, created = _insert_knowledge(conn, title, content, added_by)
+    return knowledge_id if created else None
+
+
+@db_write
+def save_knowledge_many(conn, items, added_by):
+    """
+    Сохраняет пачку [(title, content), ...] одной транзакцией.
+    Возвращает [(id, создана_ли_запись), ...] в том же порядке.
+    """
+    return [_insert_knowledge(conn, title, content, added_by) for title, content in items]
+
+
+def _format_passage(title, heading, content):
+    header = f"{title} — {heading}" if heading and heading != title else title
+    return f"{header}\n{content}"
+
+
+def _search_chunks(conn, query, limit):
+    """Поиск фрагментов по FTS5 с ранжированием BM25 (заголовки весят больше текста)."""
+    match = build_match_query(query)
+    if not match:
+        return []
+    return conn.execute("""
+        SELECT c.id, k.title, c.heading, c.content
+        FROM knowledge_chunks_fts
+        JOIN knowledge_chunks AS c ON c.id = knowledge_chunks_fts.rowid
+        JOIN knowledge AS k ON k.id = c.knowledge_id
+        WHERE knowledge_chunks_fts MATCH ?
+        ORDER BY bm25(knowledge_chunks_fts, 5.0, 3.0, 1.0)
+        LIMIT ?
+    """, (match, limit)).fetchall()
+
+
+@db_read
+def get_relevant_knowledge(conn, query, limit=4):
+    results = _search_chunks(conn, query, limit)
+    return [_format_passage(title, heading, content) for _, title, heading, content in results]
+
+
+@db_read
+def search_chunk_ids(conn, query, limit=4):
+    return [row[0] for row in _search_chunks(conn, query, limit)]
+
+
+@db_read
+def get_chunk_passages(conn, ids):
+    """
+    [(knowledge_id, отрывок), ...] в том же порядке, что и ids;
+    отрывок содержит название документа и раздела.
+    """
+    if not ids:
+        return []
+    placeholders = ",".join("?" for _ in ids)
+    rows = conn.execute(
+        f"""
+        SELECT c.id, c.knowledge_id, k.title, c.heading, c.content
+        FROM knowledge_chunks AS c
+        JOIN knowledge AS k ON k.id = c.knowledge_id
+        WHERE c.id IN ({placeholders})
+        """,
+        list(ids),
+    ).fetchall()
+    by_id = {row[0]: (row[1], _format_passage(*row[2:])) for row in rows}
+    return [by_id[i] for i in ids if i in by_id]
+
+
+@db_read
+def find_knowledge_by_keyword(conn, keyword):
+    """Лучший отрывок для /ref: (название документа, текст отрывка)."""
+    results = _search_chunks(conn, keyword, 1)
+    if not results:
+        return None
+    _, title, heading, content = results[0]
+    return title, (f"{heading}\n{content}" if heading else content)
+
+
+@db_read
+def list_recent_knowledge(conn, limit=20):
+    return conn.execute(
+        "SELECT id, title, timestamp FROM knowledge "
+        "ORDER BY timestamp DESC LIMIT ?",
+        (limit,),
+    ).fetchall()
+
+
+@db_read
+def get_recent_knowledge(conn, limit=5):
+    return conn.execute(
+        "SELECT title, content, timestamp FROM knowledge "
+        "ORDER BY timestamp DESC LIMIT ?",
+        (limit,),
+    ).fetchall()
+
+
+@db_write
+def delete_knowledge_rows(conn, ids):
+    """Удаляет записи базы знаний по id и возвращает число удалённых."""
+    placeholders = ",".join("?" for _ in ids)
+    _delete_chunks(conn, ids)
+    conn.execute(
+        f"""
+        DELETE FROM answer_cache WHERE key IN (
+            SELECT key FROM answer_cache_sources WHERE knowledge_id IN ({placeholders})
+        )
+        """,
+        list(ids),
+    )
+    conn.execute(
+        f"DELETE FROM answer_cache_sources WHERE knowledge_id IN ({placeholders})",
+        list(ids),
+    )
+    cursor = conn.execute(
+        f"DELETE FROM knowledge WHERE id IN ({placeholders})", list(ids)
+    )
+    return cursor.rowcount
+
+
+@db_read
+def get_cached_answer(conn, key, min_created_at):
+    """(answer, has_knowledge, knowledge_ids, created_at) или None, если нет или устарел."""
+    row = conn.execute(
+        "SELECT answer, has_knowledge, knowledge_ids, created_at FROM answer_cache "
+        "WHERE key = ? AND created_at >= ?",
+        (key, min_created_at),
+    ).fetchone()
+    if row is None:
+        return None
+    answer, has_knowledge, knowledge_ids, created_at = row
+    return (
+        answer, bool(has_knowledge), [int(i) for i in knowledge_ids.split(",") if i], created_at
+    )
+
+
+@db_read
+def load_cached_answers(conn, min_created_at, limit):
+    """Свежие записи кеша для прогрева памяти при старте."""
+    return conn.execute(
+        "SELECT key, answer, has_knowledge, knowledge_ids, created_at FROM answer_cache "
+        "WHERE created_at >= ? ORDER BY created_at DESC LIMIT ?",
+        (min_created_at, limit),
+    ).fetchall()
+
+
+@db_write
+def save_cached_answer(conn, key, question, answer, has_knowledge, knowledge_ids, created_at):
+    conn.execute(
+        "REPLACE INTO answer_cache "
+        "(key, question, answer, has_knowledge, knowledge_ids, created_at) "
+        "VALUES (?, ?, ?, ?, ?, ?)",
+        (key, question, answer, int(has_knowledge),
+         ",".join(str(i) for i in knowledge_ids), created_at),
+    )
+    conn.executemany(
+        "INSERT OR IGNORE INTO answer_cache_sources (knowledge_id, key) VALUES (?, ?)",
+        [(knowledge_id, key) for knowledge_id in set(knowledge_ids)],
+    )
+
+
+@db_write
+def prune_answer_cache(conn, min_created_at, max_rows):
+    """Удаляет устаревшие записи и всё сверх max_rows самых свежих."""
+    conn.execute(
+        """
+        DELETE FROM answer_cache WHERE created_at < ? OR key NOT IN (
+            SELECT key FROM answer_cache ORDER BY created_at DESC LIMIT ?
+        )
+        """,
+        (min_created_at, max_rows),
+    )
+    conn.execute(
+        "DELETE FROM answer_cache_sources WHERE key NOT IN (SELECT key FROM answer_cache)"
+    )
+
+
+@db_read
+def get_parsed_text(conn, parser_version, content_md5=None, alias=None):
+    """(content_md5, текст) из кеша разбора по md5 или по псевдониму, либо None."""
+    if content_md5 is None and alias is not None:
+        row = conn.execute(
+            "SELECT content_md5 FROM parse_cache_aliases WHERE alias = ?", (alias,)
+        ).fetchone()
+        content_md5 = row[0] if row else None
+    if content_md5 is None:
+        return None
+    row = conn.execute(
+        "SELECT content FROM parse_cache WHERE content_md5 = ? AND parser_version = ?",
+        (content_md5, parser_version),
+    ).fetchone()
+    return (content_md5, row[0]) if row else None
+
+
+@db_write
+def save_parsed_text(conn, content_md5, ext, parser_version, content, aliases=(), max_rows=0):
+    """Запоминает текст файла; max_rows > 0 — оставить только столько самых свежих."""
+    conn.execute(
+        "REPLACE INTO parse_cache (content_md5, ext, parser_version, content, parsed_at) "
+        "VALUES (?, ?, ?, ?, ?)",
+        (content_md5, ext, parser_version, content, datetime.now().timestamp()),
+    )
+    conn.executemany(
+        "REPLACE INTO parse_cache_aliases (alias, content_md5) VALUES (?, ?)",
+        [(alias, content_md5) for alias in aliases],
+    )
+    if max_rows > 0:
+        conn.execute(
+            """
+            DELETE FROM parse_cache WHERE content_md5 NOT IN (
+                SELECT content_md5 FROM parse_cache ORDER BY parsed_at DESC LIMIT ?
+            )
+            """,
+            (max_rows,),
+        )
+        conn.execute(
+            "DELETE FROM parse_cache_aliases "
+            "WHERE content_md5 NOT IN (SELECT content_md5 FROM parse_cache)"
+        )
+
+
+@db_read
+def get_chunks_for_embedding(conn, knowledge_ids):
+    """[(chunk_id, knowledge_id, текст для эмбеддинга), ...] для указанных документов."""
+    placeholders = ",".join("?" for _ in knowledge_ids)
+    rows = conn.execute(
+        f"""
+        SELECT c.id, c.knowledge_id, k.title, c.heading, c.content
+        FROM knowledge_chunks AS c
+        JOIN knowledge AS k ON k.id = c.knowledge_id
+        WHERE c.knowledge_id IN ({placeholders})
+        ORDER BY c.id
+        """,
+        list(knowledge_ids),
+    ).fetchall()
+    return [
+        (chunk_id, knowledge_id, _format_passage(title, heading, content))
+        for chunk_id, knowledge_id, title, heading, content in rows
+    ]
+
+
+@db_read
+def get_knowledge_without_embeddings(conn, model):
+    """id документов, у которых есть фрагменты без векторов для данной модели."""
+    rows = conn.execute(
+        """
+        SELECT DISTINCT c.knowledge_id FROM knowledge_chunks AS c
+        LEFT JOIN chunk_embeddings AS e
+            ON e.chunk_id = c.id AND e.model = ?
+        WHERE e.chunk_id IS NULL
+        """,
+        (model,),
+    ).fetchall()
+    return [row[0] for row in rows]
+
+
+@db_read
+def load_embeddings(conn, model, chunk_ids=None):
+    """[(chunk_id, knowledge_id, vector_bytes), ...]; chunk_ids — только эти фрагменты."""
+    query = """
+        SELECT e.chunk_id, c.knowledge_id, e.vector
+        FROM chunk_embeddings AS e
+        JOIN knowledge_chunks AS c ON c.id = e.chunk_id
+        WHERE e.model = ?
+    """
+    if chunk_ids is None:
+        return conn.execute(query, (model,)).fetchall()
+    rows = []
+    for start in range(0, len(chunk_ids), 500):
+        batch = list(chunk_ids[start:start + 500])
+        rows += conn.execute(
+            query + f" AND e.chunk_id IN ({','.join('?' for _ in batch)})",
+            [model, *batch],
+        ).fetchall()
+    return rows
+
+
+@db_read
+def get_embedded_chunks(conn, model):
+    """[(chunk_id, knowledge_id), ...] всех фрагментов, у которых есть вектор."""
+    return conn.execute(
+        """
+        SELECT e.chunk_id, c.knowledge_id
+        FROM chunk_embeddings AS e
+        JOIN knowledge_chunks AS c ON c.id = e.chunk_id
+        WHERE e.model = ?
+        """,
+        (model,),
+    ).fetchall()
+
+
+@db_write
+def save_embeddings(conn, rows):
+    """rows: [(chunk_id, model, vector_bytes), ...]"""
+    conn.executemany(
+        "REPLACE INTO chunk_embeddings (chunk_id, model, vector) VALUES (?, ?, ?)",
+        rows,
+    )
+
+
+@db_read
+def get_drive_files_state(conn, folder_id):
+    """{file_id: {...}} для всех файлов папки, уже загруженных в базу знаний."""
+    rows = conn.execute(
+        "SELECT file_id, parent_id, name, mime_type, modified_time, md5_checksum, knowledge_id "
+        "FROM drive_sync_files WHERE folder_id = ?",
+        (folder_id,),
+    ).fetchall()
+    return {
+        file_id: {
+            "parent_id": parent_id,
+            "name": name,
+            "mime_type": mime_type,
+            "modified_time": modified_time,
+            "md5_checksum": md5_checksum,
+            "knowledge_id": knowledge_id,
+        }
+        for file_id, parent_id, name, mime_type, modified_time, md5_checksum, knowledge_id in rows
+    }
+
+
+@db_write
+def save_drive_files_state(conn, rows):
+    """rows: [(file_id, folder_id, parent_id, name, mime_type, modified_time, md5_checksum, knowledge_id), ...]"""
+    conn.executemany(
+        "REPLACE INTO drive_sync_files "
+        "(file_id, folder_id, parent_id, name, mime_type, modified_time, md5_checksum, knowledge_id) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+        rows,
+    )
+
+
+@db_write
+def delete_drive_files_state(conn, file_ids):
+    conn.executemany(
+        "DELETE FROM drive_sync_files WHERE file_id = ?",
+        [(file_id,) for file_id in file_ids],
+    )
+
+
+@db_read
+def get_unreferenced_drive_knowledge(conn, knowledge_ids):
+    """Из переданных id оставляет те, на которые не ссылается ни один файл Drive."""
+    if not knowledge_ids:
+        return []
+    placeholders = ",".join("?" for _ in knowledge_ids)
+    referenced = {row[0] for row in conn.execute(
+        f"SELECT knowledge_id FROM drive_sync_files WHERE knowledge_id IN ({placeholders})",
+        list(knowledge_ids),
+    )}
+    return [i for i in set(knowledge_ids) if i not in referenced]
+
+
+@db_read
+def get_drive_folders(conn, root_id):
+    """{folder_id: parent_id} для всех вложенных папок синхронизируемой папки."""
+    return dict(conn.execute(
+        "SELECT folder_id, parent_id FROM drive_sync_folders WHERE root_id = ?",
+        (root_id,),
+    ).fetchall())
+
+
+@db_read
+def get_drive_page_token(conn, folder_id):
+    row = conn.execute(
+        "SELECT page_token FROM drive_sync_state WHERE folder_id = ?",
+        (folder_id,),
+    ).fetchone()
+    return row[0] if row else None
+
+
+@db_write
+def save_drive_sync_state(conn, folder_id, folders, page_token):
+    """
+    Дерево папок и токен changes.list сохраняются вместе: при повторе с
+    прежним токеном изменения сверяются с прежним деревом, и перенесённые
+    в папку подпапки снова обходятся целиком.
+    """
+    conn.execute("DELETE FROM drive_sync_folders WHERE root_id = ?", (folder_id,))
+    conn.executemany(
+        "INSERT INTO drive_sync_folders (root_id, folder_id, parent_id) VALUES (?, ?, ?)",
+        [(folder_id, child_id, parent_id) for child_id, parent_id in folders.items()],
+    )
+    conn.execute(
+        "REPLACE INTO drive_sync_state (folder_id, page_token, synced_at) VALUES (?, ?, ?)",
+        (folder_id, page_token, datetime.now().isoformat()),
+    )
+
+
+# Дневная активность пользователей (пишется пачками из activity.ActivityBuffer)
+@db_write
+def upsert_daily_activity_many(conn, rows):
+    """
+    rows: [(chat_id, user_id, username, day, first_msg, last_msg), ...]
+    Для каждого пользователя в чате за день хранится первое и последнее
+    сообщение; username — в последней актуальной версии.
+    Сводки activity_rollup_* обновляются в той же транзакции на разницу
+    между старой и новой строкой.
+    """
+    updated_at = datetime.now().timestamp()
+    for chat_id, user_id, username, day, first_msg, last_msg in rows:
+        old = conn.execute(
+            "SELECT first_msg, last_msg FROM daily_user_activity "
+            "WHERE chat_id = ? AND user_id = ? AND day = ?",
+            (chat_id, user_id, day),
+        ).fetchone()
+        if old:
+            first_msg, last_msg = min(old[0], first_msg), max(old[1], last_msg)
+            new_day = 0
+            span_delta = _span_seconds(first_msg, last_msg) - _span_seconds(*old)
+        else:
+            new_day = 1
+            span_delta = _span_seconds(first_msg, last_msg)
+
+        conn.execute("""
+            INSERT INTO daily_user_activity
+                (chat_id, user_id, username, day, first_msg, last_msg, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(chat_id, user_id, day) DO UPDATE SET
+                username = excluded.username,
+                first_msg = excluded.first_msg,
+                last_msg = excluded.last_msg,
+                updated_at = excluded.updated_at
+        """, (chat_id, user_id, username, day, first_msg, last_msg, updated_at))
+        conn.execute("""
+            INSERT INTO activity_rollup_day
+                (day, chat_id, active_users, first_msg, last_msg, span_seconds)
+            VALUES (?, ?, 1, ?, ?, ?)
+            ON CONFLICT(day, chat_id) DO UPDATE SET
+                active_users = active_users + ?,
+                first_msg = MIN(first_msg, excluded.first_msg),
+                last_msg = MAX(last_msg, excluded.last_msg),
+                span_seconds = span_seconds + ?
+        """, (day, chat_id, first_msg, last_msg, span_delta, new_day, span_delta))
+        conn.execute("""
+            INSERT INTO activity_rollup_user
+                (chat_id, user_id, username, days_active, first_day, last_day, span_seconds)
+            VALUES (?, ?, ?, 1, ?, ?, ?)
+            ON CONFLICT(chat_id, user_id) DO UPDATE SET
+                username = excluded.username,
+                days_active = days_active + ?,
+                first_day = MIN(first_day, excluded.first_day),
+                last_day = MAX(last_day, excluded.last_day),
+                span_seconds = span_seconds + ?
+        """, (chat_id, user_id, username, day, day, span_delta, new_day, span_delta))
+        conn.execute("""
+            INSERT INTO activity_rollup_user_day (user_id, day, username, first_msg, last_msg)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(user_id, day) DO UPDATE SET
+                username = excluded.username,
+                first_msg = MIN(first_msg, excluded.first_msg),
+                last_msg = MAX(last_msg, excluded.last_msg)
+        """, (user_id, day, username, first_msg, last_msg))
+
+
+@db_read
+def fetch_activity_changes(conn, watermark, after, limit):
+    """
+    Строки, изменённые после watermark, порциями по limit в порядке
+    (updated_at, chat_id, user_id, day); after — ключ последней строки
+    предыдущей порции или None.
+    """
+    after = after or (watermark, -(2 ** 63), -(2 ** 63), "")
+    return conn.execute(
+        """
+        SELECT updated_at, chat_id, user_id, username, day, first_msg, last_msg
+        FROM daily_user_activity
+        WHERE updated_at > ? AND (updated_at, chat_id, user_id, day) > (?, ?, ?, ?)
+        ORDER BY updated_at, chat_id, user_id, day
+        LIMIT ?
+        """,
+        (watermark, *after, limit),
+    ).fetchall()
+
+
+@db_read
+def get_activity_export_state(conn, spreadsheet_id, range_name):
+    """(watermark, next_row) или None, если в этот диапазон ещё не выгружали."""
+    return conn.execute(
+        "SELECT watermark, next_row FROM activity_export_state "
+        "WHERE spreadsheet_id = ? AND range_name = ?",
+        (spreadsheet_id, range_name),
+    ).fetchone()
+
+
+@db_read
+def get_activity_export_rows(conn, spreadsheet_id, range_name, keys):
+    """{(chat_id, user_id, day): номер строки листа} для уже выгруженных ключей."""
+    result = {}
+    for chat_id, user_id, day in keys:
+        row = conn.execute(
+            "SELECT sheet_row FROM activity_export_rows "
+            "WHERE spreadsheet_id = ? AND range_name = ? "
+            "AND chat_id = ? AND user_id = ? AND day = ?",
+            (spreadsheet_id, range_name, chat_id, user_id, day),
+        ).fetchone()
+        if row:
+            result[(chat_id, user_id, day)] = row[0]
     return result
 
 
-# Обновление дневной активности пользователя (с username)
-def update_daily_user_activity(
-    chat_id: int,
-    user_id: int,
-    username: str,
-    msg_datetime: datetime,
-):
+@db_write
+def save_activity_export_progress(conn, spreadsheet_id, range_name, new_rows, next_row, watermark):
+    """new_rows: [(chat_id, user_id, day, sheet_row), ...] — только что добавленные строки."""
+    conn.executemany(
+        "INSERT OR REPLACE INTO activity_export_rows "
+        "(spreadsheet_id, range_name, chat_id, user_id, day, sheet_row) "
+        "VALUES (?, ?, ?, ?, ?, ?)",
+        [(spreadsheet_id, range_name, *row) for row in new_rows],
+    )
+    conn.execute(
+        "REPLACE INTO activity_export_state (spreadsheet_id, range_name, watermark, next_row) "
+        "VALUES (?, ?, ?, ?)",
+        (spreadsheet_id, range_name, watermark, next_row),
+    )
+
+
+@db_read
+def get_activity_by_day(conn, since_day, chat_id=None):
+    """[(day, active_users, first_msg, last_msg, span_seconds), ...] из сводки по дням."""
+    chat_filter = "AND chat_id = ?" if chat_id is not None else ""
+    params = [since_day] + ([chat_id] if chat_id is not None else [])
+    return conn.execute(
+        f"""
+        SELECT day, SUM(active_users), MIN(first_msg), MAX(last_msg), SUM(span_seconds)
+        FROM activity_rollup_day
+        WHERE day >= ? {chat_filter}
+        GROUP BY day
+        ORDER BY day
+        """,
+        params,
+    ).fetchall()
+
+
+@db_read
+def get_activity_by_user(conn, since_day, chat_id=None, limit=15):
     """
-    Сохраняет для пользователя в чате первое и последнее сообщение за день:
-    - при первом сообщении дня пишется и first_msg, и last_msg;
-    - при последующих обновляется только last_msg.
-    username хранится в последней актуальной версии.
+    [(user_id, username, дней за период, span_seconds за период, дней всего), ...]
+    по убыванию числа активных дней.
+    По всем чатам — из сводки activity_rollup_user_day (день в нескольких чатах
+    считается один раз, span — от первого до последнего сообщения за день);
+    по одному чату — строки этого чата по индексу (chat_id, day) и итог
+    по activity_rollup_user.
     """
-    day = msg_datetime.date().isoformat()   # 'YYYY-MM-DD'
-    iso_dt = msg_datetime.isoformat()
+    if chat_id is None:
+        return conn.execute(
+            f"""
+            SELECT u.user_id, MAX(u.username), COUNT(*) AS days, SUM({_SPAN_SQL}) AS span,
+                   (SELECT COUNT(*) FROM activity_rollup_user_day AS t
+                    WHERE t.user_id = u.user_id)
+            FROM activity_rollup_user_day AS u
+            WHERE u.day >= ?
+            GROUP BY u.user_id
+            ORDER BY days DESC, span DESC
+            LIMIT ?
+            """,
+            (since_day, limit),
+        ).fetchall()
+    return conn.execute(
+        f"""
+        SELECT a.user_id, MAX(a.username), COUNT(*) AS days, SUM({_SPAN_SQL}) AS span,
+               MAX(r.days_active)
+        FROM daily_user_activity AS a
+        JOIN activity_rollup_user AS r ON r.chat_id = a.chat_id AND r.user_id = a.user_id
+        WHERE a.chat_id = ? AND a.day >= ?
+        GROUP BY a.user_id
+        ORDER BY days DESC, span DESC
+        LIMIT ?
+        """,
+        (chat_id, since_day, limit),
+    ).fetchall()
 
-    conn = sqlite3.connect("liza_db.db")
-    cursor = conn.cursor()
 
-    cursor.execute("""
-        INSERT INTO daily_user_activity (chat_id, user_id, username, day, first_msg, last_msg)
-        VALUES (?, ?, ?, ?, ?, ?)
-        ON CONFLICT(chat_id, user_id, day) DO UPDATE SET
-            username = excluded.username,
-            last_msg = excluded.last_msg
-    """, (chat_id, user_id, username, day, iso_dt, iso_dt))
+# ---------- Очередь фоновых задач ----------
+
+@db_write
+def enqueue_job(conn, kind, payload, max_attempts=3, dedupe_key=None):
+    """
+    Ставит задачу в очередь и возвращает её id. С dedupe_key задача не
+    дублируется: пока такая же ждёт или выполняется, возвращается её id.
+    """
+    if dedupe_key is not None:
+        row = conn.execute(
+            "SELECT id FROM jobs WHERE dedupe_key = ? AND status IN ('queued', 'running')",
+            (dedupe_key,),
+        ).fetchone()
+        if row:
+            return row[0]
+    now = datetime.now().timestamp()
+    cursor = conn.execute(
+        "INSERT INTO jobs (kind, payload, dedupe_key, max_attempts, run_after, created_at) "
+        "VALUES (?, ?, ?, ?, ?, ?)",
+        (kind, payload, dedupe_key, max_attempts, now, now),
+    )
+    return cursor.lastrowid
+
+
+@db_write
+def claim_job(conn, worker, lease_seconds, kinds=None):
+    """
+    Забирает одну готовую к выполнению задачу (или задачу с истёкшей арендой)
+    и возвращает (id, kind, payload, attempts) либо None.
+    """
+    now = datetime.now().timestamp()
+    # Задачи, чья аренда истекла на последней попытке, больше не повторяем
+    conn.execute(
+        "UPDATE jobs SET status = 'failed', error = 'Истекло время выполнения', "
+        "finished_at = ? "
+        "WHERE status = 'running' AND locked_until < ? AND attempts >= max_attempts",
+        (now, now),
+    )
+    kind_filter = ""
+    params = [now, now]
+    if kinds:
+        kind_filter = f"AND kind IN ({','.join('?' for _ in kinds)})"
+        params += list(kinds)
+    return conn.execute(
+        f"""
+        UPDATE jobs
+        SET status = 'running', attempts = attempts + 1, worker = ?, locked_until = ?
+        WHERE id = (
+            SELECT id FROM jobs
+            WHERE ((status = 'queued' AND run_after <= ?)
+                   OR (status = 'running' AND locked_until < ?)) {kind_filter}
+            ORDER BY id
+            LIMIT 1
+        )
+        RETURNING id, kind, payload, attempts
+        """,
+        [worker, now + lease_seconds, *params],
+    ).fetchone()
+
+
+@db_write
+def extend_job_lease(conn, job_id, worker, lease_seconds):
+    """Продлевает аренду; False — задачу уже забрал другой воркер."""
+    cursor = conn.execute(
+        "UPDATE jobs SET locked_until = ? WHERE id = ? AND worker = ? AND status = 'running'",
+        (datetime.now().timestamp() + lease_seconds, job_id, worker),
+    )
+    return cursor.rowcount > 0
+
+
+@db_write
+def complete_job(conn, job_id, worker, result):
+    conn.execute(
+        "UPDATE jobs SET status = 'done', result = ?, error = NULL, finished_at = ? "
+        "WHERE id = ? AND worker = ?",
+        (result, datetime.now().timestamp(), job_id, worker),
+    )
+
+
+@db_write
+def fail_job(conn, job_id, worker, error, retry_delay):
+    """Ошибка выполнения: повтор через retry_delay секунд или окончательный отказ."""
+    now = datetime.now().timestamp()
+    conn.execute(
+        """
+        UPDATE jobs SET
+            status = CASE WHEN attempts < max_attempts THEN 'queued' ELSE 'failed' END,
+            run_after = ?,
+            error = ?,
+            finished_at = CASE WHEN attempts < max_attempts THEN NULL ELSE ? END
+        WHERE id = ? AND worker = ?
+        """,
+        (now + retry_delay, error, now, job_id, worker),
+    )
+
+
+@db_write
+def set_job_progress(conn, job_id, progress):
+    conn.execute(
+        "UPDATE jobs SET progress = ?, progress_notified = 0 WHERE id = ? AND status = 'running'",
+        (progress, job_id),
+    )
+
+
+@db_write
+def claim_job_progress(conn):
+    """Непоказанный ход выполняющихся задач: [(id, kind, payload, progress)], отмечается показанным."""
+    return conn.execute(
+        "UPDATE jobs SET progress_notified = 1 "
+        "WHERE progress_notified = 0 AND status = 'running' "
+        "RETURNING id, kind, payload, progress"
+    ).fetchall()
+
+
+@db_write
+def claim_finished_jobs(conn, limit=50):
+    """
+    Забирает завершённые задачи, о которых ещё не сообщили, и сразу отмечает
+    их: при нескольких процессах бота о задаче сообщит только один.
+    Возвращает [(id, kind, payload, status, result, error)].
+    """
+    return conn.execute(
+        """
+        UPDATE jobs SET notified = 1
+        WHERE id IN (
+            SELECT id FROM jobs
+            WHERE notified = 0 AND status IN ('done', 'failed')
+            ORDER BY id
+            LIMIT ?
+        )
+        RETURNING id, kind, payload, status, result, error
+        """,
+        (limit,),
+    ).fetchall()
+
+
+@db_write
+def prune_notified_jobs(conn, keep_seconds):
+    """Удаляет задачи, о которых сообщили, старше keep_seconds."""
+    conn.execute(
+        "DELETE FROM jobs WHERE notified = 1 AND finished_at < ?",
+        (datetime.now().timestamp() - keep_seconds,),
+    )
+
+
+@db_read
+def count_active_jobs(conn):
+    """Число задач в очереди и в работе: {'queued': n, 'running': n}."""
+    counts = dict.fromkeys(("queued", "running"), 0)
+    counts.update(conn.execute(
+        "SELECT status, COUNT(*) FROM jobs WHERE status IN ('queued', 'running') GROUP BY status"
+    ).fetchall())
+    return counts
+
 
-    conn.commit()
-    conn.close()
+@db_read
+def get_oldest_waiting_job(conn):
+    """Время (timestamp), с которого ждёт самая давняя готовая к выполнению задача, или None."""
+    return conn.execute(
+        "SELECT MIN(run_after) FROM jobs WHERE status = 'queued' AND run_after <= ?",
+        (datetime.now().timestamp(),),
+    ).fetchone()[0]
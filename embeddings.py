@@ -0,0 +1,251 @@
+import hashlib
+import logging
+import os
+import threading
+
+import numpy as np
+import openai
+
+from db_utils import (
+    get_chunks_for_embedding,
+    get_embedded_chunks,
+    get_knowledge_without_embeddings,
+    load_embeddings,
+    save_embeddings,
+)
+import metrics
+from text_search import stem_ru, tokenize
+
+logger = logging.getLogger(__name__)
+
+# openai — эмбеддинги OpenAI, hashing — детерминированная локальная замена
+# (для тестов и офлайн-запуска), none — семантический поиск выключен.
+EMBEDDING_BACKEND = os.environ.get("EMBEDDING_BACKEND", "openai")
+EMBEDDING_MODEL = os.environ.get("EMBEDDING_MODEL", "text-embedding-3-small")
+EMBEDDING_BATCH_SIZE = int(os.environ.get("EMBEDDING_BATCH_SIZE", "64"))
+EMBEDDING_MAX_CHARS = 8000
+SEMANTIC_MIN_SCORE = float(os.environ.get("SEMANTIC_MIN_SCORE", "0.3"))
+
+
+class OpenAIEmbeddingBackend:
+    def __init__(self, model=EMBEDDING_MODEL):
+        self.model = model
+        self.name = f"openai:{model}"
+        self._client = openai.OpenAI(timeout=60, max_retries=2)
+
+    def embed(self, texts):
+        with metrics.track_dependency("openai", "embeddings"):
+            response = self._client.embeddings.create(model=self.model, input=list(texts))
+        metrics.record_openai_usage(self.model, getattr(response, "usage", None))
+        return np.array([item.embedding for item in response.data], dtype=np.float32)
+
+
+class HashingEmbeddingBackend:
+    """Hashing trick по основам слов: без сети и всегда одинаковый результат."""
+
+    def __init__(self, dim=512):
+        self.dim = dim
+        self.name = f"hashing:{dim}"
+
+    def embed(self, texts):
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for token in tokenize(text):
+                digest = hashlib.blake2b(stem_ru(token).encode(), digest_size=8).digest()
+                value = int.from_bytes(digest, "little")
+                sign = 1.0 if value & 1 else -1.0
+                vectors[row, (value >> 1) % self.dim] += sign
+        return vectors
+
+
+def _normalize(vectors):
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+class VectorIndex:
+    """
+    Нормированные векторы в одной непрерывной матрице float32.
+    Вставка дописывает строки в конец (ёмкость растёт удвоением),
+    удаление переносит последнюю строку на место удалённой.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._matrix = None
+        self._ids = np.empty(0, dtype=np.int64)
+        self._positions = {}
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def add(self, ids, vectors):
+        vectors = _normalize(np.asarray(vectors, dtype=np.float32))
+        with self._lock:
+            for item_id, vector in zip(ids, vectors):
+                position = self._positions.get(item_id)
+                if position is None:
+                    self._ensure_capacity(self._size + 1, vector.shape[0])
+                    position = self._size
+                    self._size += 1
+                    self._positions[item_id] = position
+                    self._ids[position] = item_id
+                self._matrix[position] = vector
+
+    def remove(self, ids):
+        with self._lock:
+            for item_id in ids:
+                position = self._positions.pop(item_id, None)
+                if position is None:
+                    continue
+                last = self._size - 1
+                if position != last:
+                    moved_id = int(self._ids[last])
+                    self._matrix[position] = self._matrix[last]
+                    self._ids[position] = moved_id
+                    self._positions[moved_id] = position
+                self._size = last
+
+    def search(self, vector, k):
+        """Возвращает [(id, cosine), ...] по убыванию сходства."""
+        vector = _normalize(np.asarray(vector, dtype=np.float32).reshape(1, -1))[0]
+        with self._lock:
+            if not self._size:
+                return []
+            scores = self._matrix[: self._size] @ vector
+            k = min(k, self._size)
+            top = np.argpartition(-scores, k - 1)[:k]
+            top = top[np.argsort(-scores[top])]
+            return [(int(self._ids[i]), float(scores[i])) for i in top]
+
+    def _ensure_capacity(self, size, dim):
+        if self._matrix is None:
+            capacity = max(size, 1024)
+            self._matrix = np.zeros((capacity, dim), dtype=np.float32)
+            self._ids = np.zeros(capacity, dtype=np.int64)
+            return
+        if size <= self._matrix.shape[0]:
+            return
+        capacity = self._matrix.shape[0] * 2
+        matrix = np.zeros((capacity, dim), dtype=np.float32)
+        matrix[: self._size] = self._matrix[: self._size]
+        ids = np.zeros(capacity, dtype=np.int64)
+        ids[: self._size] = self._ids[: self._size]
+        self._matrix, self._ids = matrix, ids
+
+
+def _make_backend():
+    if EMBEDDING_BACKEND == "openai":
+        return OpenAIEmbeddingBackend()
+    if EMBEDDING_BACKEND == "hashing":
+        return HashingEmbeddingBackend()
+    return None
+
+
+backend = _make_backend()
+# В индексе лежат векторы фрагментов (id = knowledge_chunks.id);
+# для удаления по документу храним, какие фрагменты ему принадлежат.
+index = VectorIndex()
+_chunks_by_knowledge = {}
+_chunks_lock = threading.Lock()
+
+
+def _add_to_index(chunk_ids, knowledge_ids, vectors):
+    index.add(chunk_ids, vectors)
+    with _chunks_lock:
+        for chunk_id, knowledge_id in zip(chunk_ids, knowledge_ids):
+            _chunks_by_knowledge.setdefault(knowledge_id, set()).add(chunk_id)
+
+
+def load_index():
+    """Загружает сохранённые векторы в память (при старте бота)."""
+    if backend is None:
+        return
+    rows = load_embeddings(backend.name)
+    if rows:
+        vectors = np.stack([np.frombuffer(blob, dtype=np.float32) for _, _, blob in rows])
+        _add_to_index([row[0] for row in rows], [row[1] for row in rows], vectors)
+    logger.info(f"Семантический индекс загружен: {len(index)} векторов ({backend.name})")
+
+
+def index_knowledge(knowledge_ids):
+    """Считает эмбеддинги фрагментов указанных записей пачками и добавляет их в индекс."""
+    if backend is None or not knowledge_ids:
+        return
+    rows = get_chunks_for_embedding(list(knowledge_ids))
+    for start in range(0, len(rows), EMBEDDING_BATCH_SIZE):
+        batch = rows[start:start + EMBEDDING_BATCH_SIZE]
+        vectors = backend.embed([text[:EMBEDDING_MAX_CHARS] for _, _, text in batch])
+        chunk_ids = [chunk_id for chunk_id, _, _ in batch]
+        save_embeddings(
+            [(chunk_id, backend.name, vector.tobytes()) for chunk_id, vector in zip(chunk_ids, vectors)]
+        )
+        _add_to_index(chunk_ids, [knowledge_id for _, knowledge_id, _ in batch], vectors)
+
+
+def index_pending():
+    """Досчитывает эмбеддинги для записей, у которых их ещё нет."""
+    if backend is None:
+        return
+    pending = get_knowledge_without_embeddings(backend.name)
+    if pending:
+        logger.info(f"Считаю эмбеддинги для {len(pending)} записей базы знаний")
+        index_knowledge(pending)
+
+
+def warm_up():
+    """Загрузка индекса и досчёт недостающих векторов (в фоновом потоке)."""
+    try:
+        load_index()
+        index_pending()
+    except Exception:
+        logger.exception("Ошибка при подготовке семантического индекса")
+
+
+def remove_knowledge(knowledge_ids):
+    """Убирает из индекса все фрагменты удалённых записей."""
+    chunk_ids = []
+    with _chunks_lock:
+        for knowledge_id in knowledge_ids:
+            chunk_ids.extend(_chunks_by_knowledge.pop(knowledge_id, ()))
+    index.remove(chunk_ids)
+
+
+def refresh():
+    """
+    Сверяет индекс с БД после изменений, сделанных другим процессом
+    (воркером): подгружает готовые векторы новых фрагментов, не пересчитывая
+    их, и убирает фрагменты удалённых записей.
+    Возвращает (id добавленных записей, id удалённых записей).
+    """
+    if backend is None:
+        return [], []
+    in_db = {}
+    for chunk_id, knowledge_id in get_embedded_chunks(backend.name):
+        in_db.setdefault(knowledge_id, set()).add(chunk_id)
+    with _chunks_lock:
+        known = {knowledge_id: set(chunks) for knowledge_id, chunks in _chunks_by_knowledge.items()}
+
+    removed = [knowledge_id for knowledge_id in known if knowledge_id not in in_db]
+    remove_knowledge(removed)
+    new_chunks = [
+        chunk_id
+        for knowledge_id, chunks in in_db.items()
+        for chunk_id in chunks - known.get(knowledge_id, set())
+    ]
+    rows = load_embeddings(backend.name, new_chunks) if new_chunks else []
+    if rows:
+        vectors = np.stack([np.frombuffer(blob, dtype=np.float32) for _, _, blob in rows])
+        _add_to_index([row[0] for row in rows], [row[1] for row in rows], vectors)
+    return sorted({row[1] for row in rows} - set(known)), removed
+
+
+def search(query, k=4):
+    """Top-k фрагментов базы знаний по косинусному сходству с запросом."""
+    if backend is None or not len(index):
+        return []
+    vector = backend.embed([query])[0]
+    return [(chunk_id, score) for chunk_id, score in index.search(vector, k)
+            if score >= SEMANTIC_MIN_SCORE]
@@ -0,0 +1,184 @@
+import hashlib
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from html.parser import HTMLParser
+
+import fitz  # PyMuPDF
+import docx
+
+try:
+    import openpyxl
+except ImportError:  # XLSX необязателен
+    openpyxl = None
+
+# Извлечение текста из PDF/DOCX нагружает CPU, поэтому выполняется
+# в пуле процессов, а не в потоке event loop.
+PARSE_WORKERS = int(os.environ.get("PARSE_WORKERS", str(min(2, os.cpu_count() or 1))))
+# Ограничения на объём разбора: огромный PDF не должен занимать воркер
+# надолго и раздувать базу знаний. 0 — без ограничения.
+EXTRACT_MAX_PAGES = int(os.environ.get("EXTRACT_MAX_PAGES", "500"))
+EXTRACT_MAX_CHARS = int(os.environ.get("EXTRACT_MAX_CHARS", "2000000"))
+
+# Извлечённый текст кешируется в БД по md5 содержимого (см. parse_cache
+# в db_utils). PARSER_VERSION увеличивается при изменении экстракторов,
+# чтобы старые записи кеша перестали использоваться.
+PARSER_VERSION = 2
+PARSE_CACHE_MAX_ROWS = int(os.environ.get("PARSE_CACHE_MAX_ROWS", "1000"))
+
+# Реестр экстракторов: расширение -> функция(path, max_chars) -> str
+EXTRACTORS = {}
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_parse_pool() -> ProcessPoolExecutor:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=PARSE_WORKERS)
+        return _pool
+
+
+def shutdown_parse_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=True, cancel_futures=True)
+            _pool = None
+
+
+def extractor(*extensions):
+    """Регистрирует функцию извлечения текста для указанных расширений."""
+    def register(func):
+        for ext in extensions:
+            EXTRACTORS[ext] = func
+        return func
+    return register
+
+
+def _take_until_limit(parts, max_chars):
+    """Собирает куски текста, пока не набрано max_chars символов."""
+    taken = []
+    total = 0
+    for part in parts:
+        taken.append(part)
+        total += len(part) + 1
+        if max_chars and total >= max_chars:
+            break
+    return "\n".join(taken)
+
+
+@extractor("txt", "md")
+def _extract_plain(path, max_chars):
+    # Markdown оставляем как есть: заголовки «#» понимает нарезка на фрагменты
+    with open(path, "r", encoding="utf-8", errors="ignore") as f:
+        return f.read(max_chars) if max_chars else f.read()
+
+
+@extractor("pdf")
+def _extract_pdf(path, max_chars):
+    with fitz.open(path) as doc:
+        page_count = len(doc)
+        if EXTRACT_MAX_PAGES:
+            page_count = min(page_count, EXTRACT_MAX_PAGES)
+        pages = (doc[number].get_text() for number in range(page_count))
+        return _take_until_limit(pages, max_chars)
+
+
+@extractor("docx")
+def _extract_docx(path, max_chars):
+    d = docx.Document(path)
+    return _take_until_limit((p.text for p in d.paragraphs), max_chars)
+
+
+class _HTMLText(HTMLParser):
+    """Текст HTML без скриптов и стилей, блочные теги дают перенос строки."""
+
+    _SKIP = {"script", "style", "noscript", "template"}
+    _BLOCKS = {"p", "div", "br", "li", "tr", "h1", "h2", "h3", "h4", "h5", "h6",
+               "section", "article", "table", "ul", "ol", "pre", "blockquote"}
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parts = []
+        self.size = 0
+        self._skipping = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self._SKIP:
+            self._skipping += 1
+        elif tag in self._BLOCKS:
+            self.parts.append("\n")
+        if tag in ("h1", "h2", "h3", "h4", "h5", "h6"):
+            self.parts.append("# ")
+
+    def handle_endtag(self, tag):
+        if tag in self._SKIP and self._skipping:
+            self._skipping -= 1
+        elif tag in self._BLOCKS:
+            self.parts.append("\n")
+
+    def handle_data(self, data):
+        if not self._skipping:
+            self.parts.append(data)
+            self.size += len(data)
+
+
+@extractor("html", "htm")
+def _extract_html(path, max_chars):
+    # Файл скармливается парсеру блоками, пока текста не набрано max_chars
+    parser = _HTMLText()
+    with open(path, "r", encoding="utf-8", errors="ignore") as f:
+        for block in iter(lambda: f.read(64 * 1024), ""):
+            parser.feed(block)
+            if max_chars and parser.size >= max_chars:
+                break
+    parser.close()
+    lines = (" ".join(line.split()) for line in "".join(parser.parts).splitlines())
+    return _take_until_limit((line for line in lines if line), max_chars)
+
+
+if openpyxl is not None:
+    @extractor("xlsx")
+    def _extract_xlsx(path, max_chars):
+        workbook = openpyxl.load_workbook(path, read_only=True, data_only=True)
+        try:
+            def rows():
+                for sheet in workbook.worksheets:
+                    yield f"# {sheet.title}"
+                    for values in sheet.iter_rows(values_only=True):
+                        cells = [str(v) for v in values if v is not None]
+                        if cells:
+                            yield " | ".join(cells)
+            return _take_until_limit(rows(), max_chars)
+        finally:
+            workbook.close()
+
+
+SUPPORTED_EXTENSIONS = tuple(EXTRACTORS)
+
+
+def file_md5(path: str) -> str:
+    """md5 содержимого файла — тот же, что отдаёт Drive в md5Checksum."""
+    digest = hashlib.md5()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def extract_text(path: str, ext: str) -> str:
+    """
+    Текст файла с диска; выполняется в дочернем процессе.
+    Файлы читаются потоково, PDF — постранично; разбор останавливается
+    на EXTRACT_MAX_PAGES страницах / EXTRACT_MAX_CHARS символах.
+    """
+    func = EXTRACTORS.get(ext)
+    if func is None:
+        return ""
+    content = func(path, EXTRACT_MAX_CHARS)
+    if EXTRACT_MAX_CHARS:
+        content = content[:EXTRACT_MAX_CHARS]
+    return content.strip()
@@ -0,0 +1,190 @@
+"""
+Локальный фейковый Telegram Bot API для проверки режима webhook без сети.
+
+Запуск:
+    python fake_telegram.py --port 8081 "Привет" "Какой график уборки?"
+
+и бот в соседнем терминале:
+    BOT_MODE=webhook TELEGRAM_API_BASE_URL=http://127.0.0.1:8081 \
+    WEBHOOK_URL=http://127.0.0.1:8080 WEBHOOK_SECRET=test BOT_TOKEN=123:fake \
+    python main.py
+
+Фейк ждёт, пока бот зарегистрирует webhook, отправляет ему сообщения
+как обновления Telegram и печатает всё, что бот отправил в ответ.
+Тот же класс используется в benchmark.py (с искусственной задержкой ответов
+и файлами для getFile).
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import time
+
+import aiohttp
+from aiohttp import web
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+class FakeTelegram:
+    def __init__(self, latency=None, on_send=None):
+        """
+        latency() -> секунды задержки каждого ответа Bot API;
+        on_send(method, params) вызывается для каждого исходящего сообщения бота.
+        """
+        self.webhook_url = None
+        self.secret = None
+        self.sent = []  # (method, params) всех исходящих вызовов бота
+        self.files = {}  # file_id -> содержимое для getFile / скачивания
+        self.latency = latency
+        self.on_send = on_send
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1000)
+        self._webhook_set = asyncio.Event()
+        self._sent_event = asyncio.Event()
+        self._runner = None
+
+    # ---- сторона Bot API ----
+
+    def make_app(self):
+        app = web.Application()
+        app.router.add_route("*", "/bot{token}/{method}", self.handle_method)
+        app.router.add_get("/file/bot{token}/{file_id}", self.handle_file)
+        return app
+
+    def add_file(self, file_id, data):
+        self.files[file_id] = data
+
+    async def handle_file(self, request):
+        data = self.files.get(request.match_info["file_id"])
+        if data is None:
+            return web.Response(status=404)
+        return web.Response(body=data)
+
+    async def start(self, host="127.0.0.1", port=8081):
+        self._runner = web.AppRunner(self.make_app())
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    @staticmethod
+    async def _params(request):
+        if request.content_type == "application/json":
+            return await request.json()
+        params = {}
+        for key, value in (await request.post()).items():
+            try:
+                params[key] = json.loads(value) if isinstance(value, str) else value
+            except ValueError:
+                params[key] = value
+        return params
+
+    def _message(self, chat_id, text):
+        return {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": int(chat_id), "type": "private"},
+            "from": {"id": 1, "is_bot": True, "first_name": "Лиза", "username": "liza_bot"},
+            "text": text,
+        }
+
+    async def handle_method(self, request):
+        method = request.match_info["method"]
+        params = await self._params(request)
+        if self.latency is not None:
+            await asyncio.sleep(self.latency())
+        if method == "getMe":
+            result = {
+                "id": 1, "is_bot": True, "first_name": "Лиза", "username": "liza_bot",
+                "can_join_groups": True, "can_read_all_group_messages": False,
+                "supports_inline_queries": False,
+            }
+        elif method == "setWebhook":
+            self.webhook_url = params.get("url")
+            self.secret = params.get("secret_token")
+            self._webhook_set.set()
+            result = True
+        elif method == "getFile":
+            file_id = params.get("file_id", "")
+            result = {
+                "file_id": file_id,
+                "file_unique_id": f"u-{file_id}",
+                "file_size": len(self.files.get(file_id, b"")),
+                "file_path": file_id,
+            }
+        elif method in ("sendMessage", "editMessageText"):
+            self.sent.append((method, params))
+            self._sent_event.set()
+            if self.on_send is not None:
+                self.on_send(method, params)
+            result = self._message(params.get("chat_id", 0), params.get("text", ""))
+        else:
+            self.sent.append((method, params))
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    # ---- сторона пользователя ----
+
+    async def wait_for_webhook(self, timeout=60):
+        await asyncio.wait_for(self._webhook_set.wait(), timeout)
+
+    def text_update(self, text, user_id=100, chat_id=None, username="tester"):
+        chat_id = user_id if chat_id is None else chat_id
+        message = {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private" if chat_id == user_id else "group"},
+            "from": {"id": user_id, "is_bot": False, "first_name": username, "username": username},
+            "text": text,
+        }
+        if text.startswith("/"):
+            command = text.split()[0]
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(command)}]
+        return {"update_id": next(self._update_ids), "message": message}
+
+    async def deliver(self, update, secret=None):
+        """Отправляет обновление на webhook бота, возвращает HTTP-статус."""
+        headers = {SECRET_HEADER: self.secret if secret is None else secret}
+        async with aiohttp.ClientSession() as session:
+            async with session.post(self.webhook_url, json=update, headers=headers) as response:
+                return response.status
+
+    async def wait_for_sent(self, count, timeout=60):
+        """Ждёт, пока бот сделает не меньше count исходящих вызовов."""
+        deadline = time.monotonic() + timeout
+        while len(self.sent) < count:
+            self._sent_event.clear()
+            await asyncio.wait_for(self._sent_event.wait(), deadline - time.monotonic())
+        return self.sent
+
+
+async def _demo(port, texts, timeout):
+    fake = FakeTelegram()
+    await fake.start(port=port)
+    print(f"Фейковый Bot API на http://127.0.0.1:{port}, ждём регистрации webhook…")
+    try:
+        await fake.wait_for_webhook(timeout)
+        print(f"Webhook: {fake.webhook_url}")
+        print(f"Чужой секрет -> HTTP {await fake.deliver(fake.text_update('x'), secret='wrong')}")
+        for text in texts:
+            print(f"> {text}: HTTP {await fake.deliver(fake.text_update(text))}")
+        try:
+            await fake.wait_for_sent(len(texts), timeout)
+        except asyncio.TimeoutError:
+            pass
+        for method, params in fake.sent:
+            print(f"< {method}: {params.get('text', '')}")
+    finally:
+        await fake.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("texts", nargs="*", default=["Привет"])
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--timeout", type=float, default=60)
+    args = parser.parse_args()
+    asyncio.run(_demo(args.port, args.texts, args.timeout))
@@ -1,30 +1,115 @@
 import os
-from io import BytesIO
-import sqlite3
-
-import fitz  # PyMuPDF
-import docx
+import logging
+import re
+import tempfile
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import google_auth_httplib2
+import httplib2
 from google.oauth2 import service_account
 from googleapiclient.discovery import build
 from googleapiclient import http
 
-from db_utils import save_knowledge
+from db_utils import (
+    save_knowledge_many,
+    delete_knowledge_rows,
+    fetch_activity_changes,
+    get_activity_export_state,
+    get_activity_export_rows,
+    save_activity_export_progress,
+    get_drive_files_state,
+    save_drive_files_state,
+    delete_drive_files_state,
+    get_unreferenced_drive_knowledge,
+    get_drive_folders,
+    get_drive_page_token,
+    save_drive_sync_state,
+    get_parsed_text,
+    save_parsed_text,
+)
+import embeddings
+import metrics
+from answer_cache import answer_cache
+from extraction import (
+    PARSE_CACHE_MAX_ROWS,
+    PARSER_VERSION,
+    SUPPORTED_EXTENSIONS,
+    extract_text,
+    get_parse_pool,
+)
+
+logger = logging.getLogger(__name__)
 
 GOOGLE_CREDENTIALS_PATH = os.environ["GOOGLE_CREDENTIALS_PATH"]
+GOOGLE_HTTP_TIMEOUT = float(os.environ.get("GOOGLE_HTTP_TIMEOUT", "120"))
+
+# Учётные данные читаются с диска один раз, клиенты API строятся один раз
+# на процесс (по встроенному discovery-документу, без сетевого запроса).
+# httplib2 не потокобезопасен, поэтому каждый запрос выполняется через
+# AuthorizedHttp своего потока; токен общий и обновляется автоматически.
+_creds = None
+_services = {}
+_clients_lock = threading.Lock()
+_thread_local = threading.local()
 
 
 def _get_creds():
-    return service_account.Credentials.from_service_account_file(
-        GOOGLE_CREDENTIALS_PATH
-    )
+    global _creds
+    with _clients_lock:
+        if _creds is None:
+            _creds = service_account.Credentials.from_service_account_file(
+                GOOGLE_CREDENTIALS_PATH
+            )
+        return _creds
+
+
+def _thread_http():
+    authorized = getattr(_thread_local, "http", None)
+    if authorized is None:
+        authorized = google_auth_httplib2.AuthorizedHttp(
+            _get_creds(), http=httplib2.Http(timeout=GOOGLE_HTTP_TIMEOUT)
+        )
+        _thread_local.http = authorized
+    return authorized
+
+
+class _TimedRequest(http.HttpRequest):
+    """Запрос к Google API с метрикой по methodId (например, drive.files.list)."""
+
+    def execute(self, *args, **kwargs):
+        service, _, operation = (self.methodId or "google.unknown").partition(".")
+        with metrics.track_dependency(f"google_{service}", operation):
+            return super().execute(*args, **kwargs)
+
+
+def _build_request(_http, *args, **kwargs):
+    return _TimedRequest(_thread_http(), *args, **kwargs)
+
+
+def _get_service(api: str, version: str):
+    """Общий для всех потоков клиент Google API."""
+    key = (api, version)
+    service = _services.get(key)
+    if service is None:
+        service = build(
+            api,
+            version,
+            http=_thread_http(),
+            requestBuilder=_build_request,
+            static_discovery=True,
+            cache_discovery=False,
+        )
+        with _clients_lock:
+            service = _services.setdefault(key, service)
+    return service
 
 
 # -------- Google Docs / Sheets чтение --------
 
 
 def get_google_docs_text(document_id: str) -> str:
-    creds = _get_creds()
-    service = build("docs", "v1", credentials=creds)
+    service = _get_service("docs", "v1")
     doc = service.documents().get(documentId=document_id).execute()
     text = ""
     for element in doc.get("body", {}).get("content", []):
@@ -35,8 +120,7 @@ def get_google_docs_text(document_id: str) -> str:
 
 
 def get_google_sheet_values(spreadsheet_id: str, range_name: str):
-    creds = _get_creds()
-    service = build("sheets", "v4", credentials=creds)
+    service = _get_service("sheets", "v4")
     sheet = service.spreadsheets()
     result = sheet.values().get(
         spreadsheetId=spreadsheet_id,
@@ -48,100 +132,470 @@ def get_google_sheet_values(spreadsheet_id: str, range_name: str):
 # -------- Синхронизация папки Google Drive в базу знаний --------
 
 
-def sync_drive_folder_to_knowledge(folder_id: str):
-    creds = _get_creds()
-    drive_service = build("drive", "v3", credentials=creds)
-
-    results = drive_service.files().list(
-        q=f"'{folder_id}' in parents and trashed = false",
-        fields="files(id, name, mimeType)",
-    ).execute()
-
-    files = results.get("files", [])
-    known_types = {
+KNOWN_DRIVE_TYPES = {
+    mime_type: ext
+    for mime_type, ext in {
         "application/pdf": "pdf",
         "application/vnd.openxmlformats-officedocument.wordprocessingml.document": "docx",
+        "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet": "xlsx",
         "text/plain": "txt",
+        "text/markdown": "md",
+        "text/html": "html",
+    }.items()
+    if ext in SUPPORTED_EXTENSIONS
+}
+
+DRIVE_FILE_FIELDS = "id, name, mimeType, parents, trashed, modifiedTime, md5Checksum"
+FOLDER_MIME_TYPE = "application/vnd.google-apps.folder"
+SYNC_BATCH_SIZE = 20
+DOWNLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+SPOOL_DIR = os.environ.get("DRIVE_SPOOL_DIR") or None
+DOWNLOAD_WORKERS = int(os.environ.get("DRIVE_DOWNLOAD_WORKERS", "4"))
+
+def _download(file_id: str, ext: str) -> str:
+    """
+    Скачивает файл частями во временный файл на диске и возвращает путь к нему:
+    в памяти одновременно находится не больше одного куска.
+    """
+    request = _get_service("drive", "v3").files().get_media(fileId=file_id)
+    with tempfile.NamedTemporaryFile(
+        prefix="drive-", suffix=f".{ext}", dir=SPOOL_DIR, delete=False
+    ) as fh:
+        try:
+            downloader = http.MediaIoBaseDownload(fh, request, chunksize=DOWNLOAD_CHUNK_SIZE)
+            done = False
+            with metrics.track_dependency("google_drive", "download"):
+                while not done:
+                    _, done = downloader.next_chunk()
+        except Exception:
+            os.unlink(fh.name)
+            raise
+    return fh.name
+
+
+def _is_unchanged(file: dict, known: dict | None) -> bool:
+    if known is None:
+        return False
+    if file.get("md5Checksum") and known["md5_checksum"]:
+        return file["md5Checksum"] == known["md5_checksum"]
+    return file.get("modifiedTime") == known["modified_time"]
+
+
+def _forget_files(forgotten: dict, stats: dict):
+    """Удаляет из базы знаний файлы, которые пропали из папки."""
+    if not forgotten:
+        return
+    delete_drive_files_state(list(forgotten))
+    _drop_orphaned_knowledge([known["knowledge_id"] for known in forgotten.values()], stats)
+    stats["deleted"] += len(forgotten)
+
+
+def _drop_orphaned_knowledge(knowledge_ids: list, stats: dict):
+    """Удаляет записи, на которые больше не ссылается ни один файл Drive."""
+    orphaned = get_unreferenced_drive_knowledge([i for i in knowledge_ids if i])
+    if orphaned:
+        delete_knowledge_rows(orphaned)
+        embeddings.remove_knowledge(orphaned)
+        answer_cache.invalidate_knowledge(orphaned)
+        stats["knowledge_removed"] += orphaned
+
+
+def _state_row(folder_id: str, file: dict, knowledge_id):
+    return (
+        file["id"],
+        folder_id,
+        file["_parent"],
+        file["name"],
+        file["mimeType"],
+        file.get("modifiedTime"),
+        file.get("md5Checksum"),
+        knowledge_id,
+    )
+
+
+def _store_files(folder_id: str, fetched: list, stats: dict, new_ids: list):
+    """
+    Записывает пачку скачанных файлов: старые версии удаляются,
+    новые вставляются одной транзакцией через save_knowledge_many.
+    fetched: [(file, known, content), ...]
+    """
+    with_content = [(file, content) for file, _, content in fetched if content]
+    # 126204360 – твой user_id, чтобы было видно, кто загрузил
+    saved = save_knowledge_many(
+        [(file["name"], content) for file, content in with_content],
+        added_by=126204360,
+    )
+    knowledge_ids = {}
+    for (file, _), (knowledge_id, created) in zip(with_content, saved):
+        knowledge_ids[file["id"]] = knowledge_id
+        if created:
+            new_ids.append(knowledge_id)
+    if any(created for _, created in saved):
+        answer_cache.knowledge_added()
+
+    save_drive_files_state([
+        _state_row(folder_id, file, knowledge_ids.get(file["id"])) for file, _, _ in fetched
+    ])
+    _drop_orphaned_knowledge([known["knowledge_id"] for _, known, _ in fetched if known], stats)
+    for _, known, _ in fetched:
+        stats["updated" if known else "added"] += 1
+
+
+def _list_children(drive_service, folder_id: str):
+    """Все непосредственные потомки папки, с учётом постраничной выдачи."""
+    page_token = None
+    while True:
+        response = drive_service.files().list(
+            q=f"'{folder_id}' in parents and trashed = false",
+            fields=f"nextPageToken, files({DRIVE_FILE_FIELDS})",
+            pageSize=1000,
+            pageToken=page_token,
+        ).execute()
+        yield from response.get("files", [])
+        page_token = response.get("nextPageToken")
+        if not page_token:
+            return
+
+
+def _walk_folder(drive_service, folder_id: str, present: dict, folders: dict):
+    """Обходит папку и все вложенные папки, собирая файлы и дерево папок."""
+    queue = [folder_id]
+    while queue:
+        current = queue.pop()
+        for item in _list_children(drive_service, current):
+            if item["mimeType"] == FOLDER_MIME_TYPE:
+                folders[item["id"]] = current
+                queue.append(item["id"])
+            else:
+                item["_parent"] = current
+                present[item["id"]] = item
+
+
+def _tree_parent(file: dict, tree: set):
+    """Первый родитель файла, входящий в синхронизируемое дерево папок."""
+    for parent in file.get("parents", []):
+        if parent in tree:
+            return parent
+    return None
+
+
+def _plan_full_sync(drive_service, folder_id: str, known_files: dict):
+    """Полная сверка папки (и подпапок) с сохранённым состоянием (первый запуск)."""
+    present, folders = {}, {}
+    _walk_folder(drive_service, folder_id, present, folders)
+    forgotten = {
+        file_id: known for file_id, known in known_files.items() if file_id not in present
     }
+    return present, forgotten, folders
+
 
-    for file in files:
-        file_id = file["id"]
-        name = file["name"]
-        mime = file["mimeType"]
-        ext = known_types.get(mime)
-        if not ext:
+def _plan_changes(drive_service, folder_id: str, page_token: str, known_files: dict, folders: dict):
+    """
+    Читает изменения Drive (changes.list) начиная с page_token.
+    Возвращает (изменённые файлы дерева, пропавшие из дерева файлы, дерево папок, новый токен).
+    """
+    present, forgotten = {}, {}
+    folders = dict(folders)
+    while True:
+        response = drive_service.changes().list(
+            pageToken=page_token,
+            spaces="drive",
+            includeRemoved=True,
+            pageSize=1000,
+            fields=f"nextPageToken, newStartPageToken, changes(fileId, removed, file({DRIVE_FILE_FIELDS}))",
+        ).execute()
+
+        for change in response.get("changes", []):
+            file_id = change["fileId"]
+            file = change.get("file") or {}
+            tree = {folder_id, *folders}
+            parent = None
+            if not change.get("removed") and not file.get("trashed"):
+                parent = _tree_parent(file, tree)
+
+            if file.get("mimeType") == FOLDER_MIME_TYPE or file_id in folders:
+                if parent and file_id not in folders:
+                    # В дерево переместили папку вместе с содержимым
+                    folders[file_id] = parent
+                    _walk_folder(drive_service, file_id, present, folders)
+                elif not parent and file_id in folders:
+                    removed = _subtree(file_id, folders)
+                    for folder in removed:
+                        folders.pop(folder, None)
+                    for known_id, known in known_files.items():
+                        if known["parent_id"] in removed:
+                            present.pop(known_id, None)
+                            forgotten[known_id] = known
+                elif parent:
+                    folders[file_id] = parent
+                continue
+
+            if parent:
+                file["_parent"] = parent
+                present[file_id] = file
+                forgotten.pop(file_id, None)
+            else:
+                present.pop(file_id, None)
+                if file_id in known_files:
+                    forgotten[file_id] = known_files[file_id]
+
+        if "newStartPageToken" in response:
+            return present, forgotten, folders, response["newStartPageToken"]
+        page_token = response["nextPageToken"]
+
+
+def _subtree(folder_id: str, folders: dict) -> set:
+    """Папка и все вложенные в неё папки."""
+    result = {folder_id}
+    changed = True
+    while changed:
+        changed = False
+        for child, parent in folders.items():
+            if parent in result and child not in result:
+                result.add(child)
+                changed = True
+    return result
+
+
+def _fetch_files(to_fetch: list, stats: dict, progress=None):
+    """
+    Скачивает файлы в пуле потоков и разбирает их в пуле процессов:
+    разбор файла начинается сразу, как только он скачан. Файлы, чьё
+    содержимое (md5Checksum) уже разбиралось, берутся из кеша без скачивания.
+    Отдаёт (file, known, content) по мере готовности.
+    """
+    parse_pool = get_parse_pool()
+    total = len(to_fetch)
+    done = 0
+    to_download = []
+    for file, known, ext in to_fetch:
+        cached = None
+        if file.get("md5Checksum"):
+            cached = get_parsed_text(PARSER_VERSION, content_md5=file["md5Checksum"])
+        if cached is None:
+            to_download.append((file, known, ext))
             continue
+        done += 1
+        if progress:
+            progress(done, total, file["name"])
+        yield file, known, cached[1]
+
+    with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS, thread_name_prefix="drive-download") as downloads:
+        pending = {
+            downloads.submit(_download, file["id"], ext): ("download", file, known, ext, None)
+            for file, known, ext in to_download
+        }
+        while pending:
+            finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                stage, file, known, ext, path = pending.pop(future)
+                if stage == "parse":
+                    os.unlink(path)
+                try:
+                    result = future.result()
+                except Exception:
+                    logger.exception(f"Ошибка обработки {file['name']} ({stage})")
+                    stats["failed"] += 1
+                    done += 1
+                    continue
+                if stage == "download":
+                    pending[parse_pool.submit(extract_text, result, ext)] = ("parse", file, known, ext, result)
+                    continue
+                if file.get("md5Checksum"):
+                    save_parsed_text(
+                        file["md5Checksum"], ext, PARSER_VERSION, result, (), PARSE_CACHE_MAX_ROWS
+                    )
+                done += 1
+                if progress:
+                    progress(done, total, file["name"])
+                yield file, known, result
+
+
+def sync_drive_folder_to_knowledge(folder_id: str, progress=None) -> dict:
+    """
+    Инкрементальная синхронизация папки Google Drive (вместе с подпапками)
+    с базой знаний.
 
-        request = drive_service.files().get_media(fileId=file_id)
-        fh = BytesIO()
-        downloader = http.MediaIoBaseDownload(fh, request)
-        done = False
-        while not done:
-            _, done = downloader.next_chunk()
-
-        fh.seek(0)
-        if ext == "txt":
-            content = fh.read().decode("utf-8", errors="ignore")
-        elif ext == "pdf":
-            doc = fitz.open("pdf", fh.read())
-            content = "\n".join(page.get_text() for page in doc)
-        elif ext == "docx":
-            f = BytesIO(fh.read())
-            d = docx.Document(f)
-            content = "\n".join(p.text for p in d.paragraphs)
-        else:
-            content = ""
+    Первый запуск сверяет всю папку; дальше используются токены changes.list,
+    поэтому синхронизация папки без изменений стоит один запрос к API.
+    Скачиваются только новые и изменённые (по md5Checksum / modifiedTime) файлы,
+    удалённые из папки файлы удаляются из базы знаний.
+
+    Вызывается из фонового потока; progress(done, total, name) сообщает о ходе
+    загрузки (тоже из фонового потока).
+    """
+    drive_service = _get_service("drive", "v3")
+    # knowledge_added / knowledge_removed — id записей базы знаний: по ним
+    # процесс бота сбрасывает свой кеш ответов, если синхронизацию выполнял воркер
+    stats = {
+        "added": 0, "updated": 0, "deleted": 0, "skipped": 0, "failed": 0,
+        "knowledge_added": [], "knowledge_removed": [],
+    }
+    new_ids = []
 
-        if content.strip():
-            # 126204360 – твой user_id, чтобы было видно, кто загрузил
-            save_knowledge(name, content.strip(), added_by=126204360)
+    known_files = get_drive_files_state(folder_id)
+    page_token = get_drive_page_token(folder_id)
+    if page_token:
+        present, forgotten, folders, page_token = _plan_changes(
+            drive_service, folder_id, page_token, known_files, get_drive_folders(folder_id)
+        )
+    else:
+        # Токен берём до листинга, чтобы не потерять изменения во время сверки
+        page_token = drive_service.changes().getStartPageToken().execute()["startPageToken"]
+        present, forgotten, folders = _plan_full_sync(drive_service, folder_id, known_files)
+
+    _forget_files(forgotten, stats)
+
+    to_fetch = []
+    moved = []
+    for file_id, file in present.items():
+        known = known_files.get(file_id)
+        ext = KNOWN_DRIVE_TYPES.get(file["mimeType"])
+        if not ext or _is_unchanged(file, known):
+            stats["skipped"] += 1
+            if known and known["parent_id"] != file["_parent"]:
+                moved.append(_state_row(folder_id, file, known["knowledge_id"]))
+            continue
+        to_fetch.append((file, known, ext))
+    save_drive_files_state(moved)
+
+    fetched = []
+    for item in _fetch_files(to_fetch, stats, progress):
+        fetched.append(item)
+        if len(fetched) >= SYNC_BATCH_SIZE:
+            _store_files(folder_id, fetched, stats, new_ids)
+            fetched = []
+    _store_files(folder_id, fetched, stats, new_ids)
+    # Если что-то не скачалось, ни токен, ни дерево папок не сдвигаем: файлы
+    # попробуем снова в следующий раз (уже загруженные пропустятся по
+    # контрольной сумме).
+    if not stats["failed"]:
+        save_drive_sync_state(folder_id, folders, page_token)
+
+    # Эмбеддинги новых файлов считаются пачками в конце синхронизации
+    embeddings.index_knowledge(new_ids)
+    stats["knowledge_added"] = new_ids
+    return stats
 
 
 # -------- Экспорт daily_user_activity в Google Sheets --------
 
 
-def export_daily_activity_to_sheet(spreadsheet_id: str, range_name: str):
+ACTIVITY_HEADER = ["chat_id", "user_id", "username", "day", "first_msg", "last_msg"]
+EXPORT_BATCH_ROWS = int(os.environ.get("EXPORT_BATCH_ROWS", "500"))
+_A1_CELL_RE = re.compile(r"^([A-Za-z]{1,3})(\d*)(:.*)?$")
+# Ручной /export_stats и плановый экспорт не должны раздавать одни и те же строки листа
+_export_lock = threading.Lock()
+
+
+def _parse_a1(range_name: str):
+    """«Лист1!B3» -> ("Лист1!", индекс колонки B, 3); по умолчанию A1."""
+    sheet, sep, cell = range_name.rpartition("!")
+    match = _A1_CELL_RE.match(cell)
+    if not match:
+        return range_name + "!", 0, 1
+    column = 0
+    for letter in match.group(1).upper():
+        column = column * 26 + ord(letter) - ord("A") + 1
+    return sheet + sep, column - 1, int(match.group(2) or 1)
+
+
+def _column_letter(index: int) -> str:
+    letters = ""
+    index += 1
+    while index:
+        index, rest = divmod(index - 1, 26)
+        letters = chr(ord("A") + rest) + letters
+    return letters
+
+
+def _row_blocks(placed: dict, prefix: str, column: int) -> list:
+    """{номер строки: значения} -> диапазоны для batchUpdate, подряд идущие строки склеиваются."""
+    first_col = _column_letter(column)
+    last_col = _column_letter(column + len(ACTIVITY_HEADER) - 1)
+    blocks = []
+    for sheet_row in sorted(placed):
+        if blocks and blocks[-1][1] == sheet_row - 1:
+            blocks[-1][1] = sheet_row
+            blocks[-1][2].append(placed[sheet_row])
+        else:
+            blocks.append([sheet_row, sheet_row, [placed[sheet_row]]])
+    return [
+        {"range": f"{prefix}{first_col}{start}:{last_col}{end}", "values": values}
+        for start, end, values in blocks
+    ]
+
+
+def export_daily_activity_to_sheet(spreadsheet_id: str, range_name: str) -> dict:
     """
-    Экспортирует всю таблицу daily_user_activity в указанный диапазон Google Sheets.
+    Инкрементально выгружает daily_user_activity в Google Sheets.
+
+    Первый запуск пишет заголовок и все строки начиная с ячейки range_name;
+    дальше выгружаются только строки, изменённые после водяного знака:
+    новые дописываются вниз, изменённые переписываются на своём месте.
+    Строки читаются из SQLite порциями по EXPORT_BATCH_ROWS, каждая порция —
+    один запрос values.batchUpdate.
 
     Формат колонок:
     [chat_id, user_id, username, day, first_msg, last_msg]
     """
-    conn = sqlite3.connect("liza_db.db")
-    cursor = conn.cursor()
-    cursor.execute(
-        """
-        SELECT chat_id, user_id, username, day, first_msg, last_msg
-        FROM daily_user_activity
-        ORDER BY day, chat_id, user_id
-        """
-    )
-    rows = cursor.fetchall()
-    conn.close()
-
-    values = [["chat_id", "user_id", "username", "day", "first_msg", "last_msg"]]
-    for chat_id, user_id, username, day, first_msg, last_msg in rows:
-        values.append(
-            [
-                str(chat_id),
-                str(user_id),
-                username or "",
-                day,
-                first_msg,
-                last_msg,
-            ]
-        )
-
-    creds = _get_creds()
-    service = build("sheets", "v4", credentials=creds)
-    body = {"values": values}
-
-    service.spreadsheets().values().update(
-        spreadsheetId=spreadsheet_id,
-        range=range_name,
-        valueInputOption="RAW",
-        body=body,
-    ).execute()
+    with _export_lock:
+        return _export_activity(spreadsheet_id, range_name)
+
+
+def _export_activity(spreadsheet_id: str, range_name: str) -> dict:
+    prefix, column, start_row = _parse_a1(range_name)
+    values_api = _get_service("sheets", "v4").spreadsheets().values()
+    stats = {"appended": 0, "updated": 0}
+
+    state = get_activity_export_state(spreadsheet_id, range_name)
+    if state is None:
+        watermark, next_row = 0.0, start_row + 1
+        header = {start_row: ACTIVITY_HEADER}
+    else:
+        watermark, next_row = state
+        header = {}
+
+    new_watermark = watermark
+    after = None
+    while True:
+        rows = fetch_activity_changes(watermark, after, EXPORT_BATCH_ROWS)
+        if not rows:
+            break
+        keys = [(chat_id, user_id, day) for _, chat_id, user_id, _, day, _, _ in rows]
+        positions = get_activity_export_rows(spreadsheet_id, range_name, keys)
+
+        placed = dict(header)
+        header = {}
+        new_rows = []
+        for (updated_at, chat_id, user_id, username, day, first_msg, last_msg), key in zip(rows, keys):
+            sheet_row = positions.get(key)
+            if sheet_row is None:
+                sheet_row = next_row
+                next_row += 1
+                new_rows.append((*key, sheet_row))
+                stats["appended"] += 1
+            else:
+                stats["updated"] += 1
+            placed[sheet_row] = [str(chat_id), str(user_id), username or "", day, first_msg, last_msg]
+            new_watermark = max(new_watermark, updated_at)
+
+        values_api.batchUpdate(
+            spreadsheetId=spreadsheet_id,
+            body={"valueInputOption": "RAW", "data": _row_blocks(placed, prefix, column)},
+        ).execute()
+        # Водяной знак сдвигаем только в конце: при сбое посередине строки
+        # выгрузятся повторно, но на свои же места
+        save_activity_export_progress(spreadsheet_id, range_name, new_rows, next_row, watermark)
+        after = (rows[-1][0], *keys[-1])
+
+    if header:
+        values_api.batchUpdate(
+            spreadsheetId=spreadsheet_id,
+            body={"valueInputOption": "RAW", "data": _row_blocks(header, prefix, column)},
+        ).execute()
+    save_activity_export_progress(spreadsheet_id, range_name, [], next_row, new_watermark)
+    return stats
 
 
 # -------- Новое: просто записать число в Excel (Google Sheets) --------
@@ -158,8 +612,7 @@ def write_number_to_sheet(spreadsheet_id: str, range_name: str, number: float):
         777,
     )
     """
-    creds = _get_creds()
-    service = build("sheets", "v4", credentials=creds)
+    service = _get_service("sheets", "v4")
 
     body = {"values": [[number]]}
 
@@ -1,16 +1,36 @@
+import asyncio
+import os
+from datetime import datetime, timedelta, timezone
+
 from telegram import Update
 from telegram.ext import ContextTypes
-from db_utils import save_conversation, save_knowledge, find_knowledge_by_keyword
+from db_utils import (
+    delete_conversation,
+    find_knowledge_by_keyword,
+    list_recent_knowledge,
+    get_recent_knowledge,
+    delete_knowledge_rows,
+    get_activity_by_day,
+    get_activity_by_user,
+)
 from google_connect import (
     get_google_docs_text,
     get_google_sheet_values,
-    sync_drive_folder_to_knowledge,
-    export_daily_activity_to_sheet,   # NEW
 )
-import sqlite3
+from services import add_knowledge
+from activity import activity_buffer
+import embeddings
+import jobs
+import metrics
+import profiling
+from answer_cache import answer_cache
 
 ADMIN_IDS = [126204360, 982915733]
 
+# Время в /stats показывается в этом часовом поясе (в БД — время Telegram, UTC)
+STATS_UTC_OFFSET_HOURS = float(os.environ.get("STATS_UTC_OFFSET_HOURS", "3"))
+STATS_MAX_DAYS = 366
+
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(
@@ -29,6 +49,9 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "/clear — Очистить историю общения (только админ)\n"
         "/sync <ID_папки_на_Google_Диске> — синхронизировать файлы в базу знаний\n"
         "/export_stats <SPREADSHEET_ID> <RANGE> — выгрузить статистику в Google Sheets (только админ)\n"
+        "/stats [дней] — активность за период (только админ)\n"
+        "/metrics — время ответов и внешних сервисов (только админ)\n"
+        "/profile [секунд | N req] — профиль бота файлом (только админ)\n"
         "/help — Показать это меню"
     )
     await update.message.reply_text(help_text)  # Без parse_mode
@@ -50,7 +73,7 @@ async def learn(update: Update, context: ContextTypes.DEFAULT_TYPE):
     title = lines[0][:100]
     content = lines[1] if len(lines) > 1 else lines[0]
     try:
-        save_knowledge(title, content, user_id)
+        await add_knowledge(title, content, user_id)
         await update.message.reply_text(
             f"Спасибо, Александр! Я запомнила информацию под названием: \"{title}\""
         )
@@ -63,7 +86,7 @@ async def reference(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Укажи ключевое слово для поиска. Пример: /ref офис")
         return
     keyword = " ".join(context.args)
-    result = find_knowledge_by_keyword(keyword)
+    result = await find_knowledge_by_keyword.aio(keyword)
     if result:
         await update.message.reply_text(
             f"🔎 Нашла в базе знаний:\n\n*{result[0]}*\n\n{result[1][:3000]}",
@@ -89,15 +112,7 @@ async def list_knowledge(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
 
-    conn = sqlite3.connect("liza_db.db")
-    cursor = conn.cursor()
-    cursor.execute(
-        "SELECT id, title, timestamp FROM knowledge "
-        "ORDER BY timestamp DESC LIMIT ?",
-        (limit,),
-    )
-    rows = cursor.fetchall()
-    conn.close()
+    rows = await list_recent_knowledge.aio(limit)
 
     if not rows:
         await update.message.reply_text("База знаний пока пуста.")
@@ -116,11 +131,7 @@ async def clear_conversation(update: Update, context: ContextTypes.DEFAULT_TYPE)
         await update.message.reply_text("Извините, только администратор может очистить контекст.")
         return
     try:
-        conn = sqlite3.connect("liza_db.db")
-        cursor = conn.cursor()
-        cursor.execute("DELETE FROM conversations WHERE user_id = ?", (user_id,))
-        conn.commit()
-        conn.close()
+        await delete_conversation.aio(user_id)
         await update.message.reply_text("Контекст общения был очищен.")
     except Exception as e:
         await update.message.reply_text(f"Ошибка при очистке контекста: {e}")
@@ -135,8 +146,8 @@ async def google_doc(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     try:
         doc_id = context.args[0]
-        content = get_google_docs_text(doc_id)
-        save_conversation(update.effective_user.id, content)
+        content = await asyncio.to_thread(get_google_docs_text, doc_id)
+        await add_knowledge(f"Google Документ {doc_id}", content.strip(), update.effective_user.id)
         await update.message.reply_text("📄 Документ прочитан и добавлен в базу знаний.")
     except Exception as e:
         await update.message.reply_text(f"Ошибка при загрузке документа: {e}")
@@ -155,9 +166,11 @@ async def google_sheet(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         sheet_id = context.args[0]
         sheet_range = " ".join(context.args[1:])
-        rows = get_google_sheet_values(sheet_id, sheet_range)
+        rows = await asyncio.to_thread(get_google_sheet_values, sheet_id, sheet_range)
         content = "\n".join([", ".join(row) for row in rows])
-        save_conversation(update.effective_user.id, content)
+        await add_knowledge(
+            f"Google Таблица {sheet_id} {sheet_range}", content, update.effective_user.id
+        )
         await update.message.reply_text("📊 Таблица обработана и сохранена!")
     except Exception as e:
         await update.message.reply_text(f"Ошибка при загрузке таблицы: {e}")
@@ -174,13 +187,15 @@ async def sync_folder(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
     folder_id = context.args[0]
-    try:
-        sync_drive_folder_to_knowledge(folder_id)
-        await update.message.reply_text(
-            "📁 Папка синхронизирована! Все файлы добавлены в базу знаний."
-        )
-    except Exception as e:
-        await update.message.reply_text(f"Ошибка при синхронизации: {e}")
+    status = await update.message.reply_text("⏳ Синхронизация папки поставлена в очередь…")
+    # Синхронизацию выполняет воркер (см. jobs.py): ход работы бот показывает
+    # правкой статусного сообщения, итог присылает отдельным ответом
+    await jobs.enqueue(
+        "drive_sync",
+        {"folder_id": folder_id, "chat_id": update.effective_chat.id,
+         "message_id": update.message.message_id, "status_message_id": status.message_id},
+        dedupe_key=f"drive_sync:{folder_id}",
+    )
 
 
 async def debug_knowledge(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -188,14 +203,7 @@ async def debug_knowledge(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("⛔ Только администратор может использовать отладку.")
         return
 
-    conn = sqlite3.connect("liza_db.db")
-    cursor = conn.cursor()
-    cursor.execute(
-        "SELECT title, content, timestamp FROM knowledge "
-        "ORDER BY timestamp DESC LIMIT 5"
-    )
-    rows = cursor.fetchall()
-    conn.close()
+    rows = await get_recent_knowledge.aio(5)
 
     if not rows:
         await update.message.reply_text("📬 База знаний пуста.")
@@ -229,13 +237,9 @@ async def delete_knowledge(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
 
-    conn = sqlite3.connect("liza_db.db")
-    cursor = conn.cursor()
-    placeholders = ",".join("?" for _ in ids)
-    cursor.execute(f"DELETE FROM knowledge WHERE id IN ({placeholders})", ids)
-    conn.commit()
-    deleted = cursor.rowcount
-    conn.close()
+    deleted = await delete_knowledge_rows.aio(ids)
+    embeddings.remove_knowledge(ids)
+    answer_cache.invalidate_knowledge(ids)
 
     if deleted:
         await update.message.reply_text(f"✅ Удалено записей: {deleted}")
@@ -262,8 +266,140 @@ async def export_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     spreadsheet_id = context.args[0]
     range_name = " ".join(context.args[1:])
 
+    await activity_buffer.flush()
+    await jobs.enqueue("export_stats", {
+        "spreadsheet_id": spreadsheet_id,
+        "range_name": range_name,
+        "chat_id": update.effective_chat.id,
+        "message_id": update.message.message_id,
+    })
+    await update.message.reply_text("⏳ Выгрузка статистики поставлена в очередь…")
+
+
+# ---------- Отчёт об активности прямо в Telegram ----------
+
+def _local_time(iso_value):
+    """ISO-время из БД -> «ЧЧ:ММ» в часовом поясе STATS_UTC_OFFSET_HOURS."""
     try:
-        export_daily_activity_to_sheet(spreadsheet_id, range_name)
-        await update.message.reply_text("✅ Статистика выгружена в Google Sheets.")
-    except Exception as e:
-        await update.message.reply_text(f"Ошибка экспорта: {e}")
+        moment = datetime.fromisoformat(iso_value)
+    except (TypeError, ValueError):
+        return "—"
+    if moment.utcoffset() is not None:
+        moment = moment - moment.utcoffset()
+    return (moment + timedelta(hours=STATS_UTC_OFFSET_HOURS)).strftime("%H:%M")
+
+
+def _format_duration(seconds):
+    minutes = int(seconds or 0) // 60
+    return f"{minutes // 60}ч {minutes % 60:02d}м"
+
+
+async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    /stats [дней] — активность за последние N дней (по умолчанию 7).
+    В группе — по текущему чату, в личке — по всем чатам.
+    По дням — из сводки activity_rollup_day; по пользователям — из
+    activity_rollup_user_day (все чаты) или из строк текущего чата по индексу
+    (chat_id, day). К Google не обращается.
+    """
+    if update.effective_user.id not in ADMIN_IDS:
+        await update.message.reply_text("Команда доступна только администраторам.")
+        return
+
+    try:
+        days = int(context.args[0]) if context.args else 7
+    except ValueError:
+        await update.message.reply_text("Формат: /stats [количество дней], например /stats 30")
+        return
+    days = max(1, min(days, STATS_MAX_DAYS))
+
+    await activity_buffer.flush()
+    chat = update.effective_chat
+    chat_id = None if chat.type == "private" else chat.id
+    # Дни в daily_user_activity — по UTC (дата сообщения Telegram), см. activity.py
+    since_day = (datetime.now(timezone.utc).date() - timedelta(days=days - 1)).isoformat()
+    by_day = await get_activity_by_day.aio(since_day, chat_id)
+    by_user = await get_activity_by_user.aio(since_day, chat_id)
+
+    if not by_day:
+        await update.message.reply_text(f"За последние {days} дн. активности не было.")
+        return
+
+    scope = "этот чат" if chat_id is not None else "все чаты"
+    lines = [f"📊 Активность за {days} дн. ({scope})", ""]
+    # Подробно по дням — только за последние две недели, иначе сообщение не влезет
+    if len(by_day) > 14:
+        lines.append(f"… ещё {len(by_day) - 14} дн. раньше")
+    for day, active_users, first_msg, last_msg, span_seconds in by_day[-14:]:
+        lines.append(
+            f"{day}: {active_users} чел., {_local_time(first_msg)}–{_local_time(last_msg)}, "
+            f"в среднем {_format_duration(span_seconds / active_users)}"
+        )
+
+    total_user_days = sum(row[1] for row in by_day)
+    total_span = sum(row[4] or 0 for row in by_day)
+    lines += [
+        "",
+        f"Всего пользователе-дней: {total_user_days}, "
+        f"средняя продолжительность дня: {_format_duration(total_span / total_user_days)}",
+        "",
+        "👥 Самые активные:",
+    ]
+    for user_id, username, user_days, span_seconds, all_days in by_user:
+        name = f"@{username}" if username and " " not in username else (username or str(user_id))
+        lines.append(
+            f"{name}: {user_days} дн., в среднем {_format_duration((span_seconds or 0) / user_days)} "
+            f"(всего дней: {all_days or user_days})"
+        )
+
+    await update.message.reply_text("\n".join(lines))
+
+
+async def metrics_report(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/metrics — сводка метрик процесса бота (подробно — на HTTP /metrics)."""
+    if update.effective_user.id not in ADMIN_IDS:
+        await update.message.reply_text("Команда доступна только администраторам.")
+        return
+    # Глубина очереди задач читается из БД
+    text = await asyncio.to_thread(metrics.summary)
+    await update.message.reply_text(text[:4096])
+
+
+async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    /profile [секунд | N req] — профилирует бота (по умолчанию 30 секунд)
+    или следующие N обновлений и присылает отчёт файлом.
+    """
+    if update.effective_user.id not in ADMIN_IDS:
+        await update.message.reply_text("Команда доступна только администраторам.")
+        return
+    try:
+        seconds, requests = profiling.parse_window(context.args)
+    except ValueError:
+        await update.message.reply_text("Формат: /profile 30 (секунд) или /profile 100 req (обновлений)")
+        return
+    if profiling.is_running():
+        await update.message.reply_text("Профилирование уже идёт, дождитесь отчёта.")
+        return
+
+    window = f"{requests} обновлений" if requests else f"{seconds:g} с"
+    await update.message.reply_text(
+        f"🔬 Профилирую: {window} (не дольше {profiling.PROFILE_MAX_SECONDS:g} с), потом пришлю отчёт."
+    )
+    chat_id = update.effective_chat.id
+
+    async def run():
+        try:
+            report = await profiling.profile(seconds, requests)
+        except Exception as e:
+            await context.bot.send_message(chat_id, f"Ошибка профилирования: {e}")
+            return
+        await context.bot.send_document(
+            chat_id,
+            document=report.encode("utf-8"),
+            filename=f"profile-{datetime.now():%Y%m%d-%H%M%S}.txt",
+            caption=report.split("\n\n", 2)[1][:1024],
+        )
+
+    # Окно может длиться минуты — не держим обработку обновлений
+    context.application.create_task(run())
@@ -0,0 +1,357 @@
+import asyncio
+import functools
+import json
+import logging
+import os
+import time
+
+from db_utils import (
+    claim_finished_jobs,
+    claim_job,
+    claim_job_progress,
+    complete_job,
+    count_active_jobs,
+    enqueue_job,
+    extend_job_lease,
+    fail_job,
+    get_oldest_waiting_job,
+    prune_notified_jobs,
+    set_job_progress,
+)
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Долговременная очередь тяжёлых задач в SQLite: бот ставит задачу, её
+# забирает воркер (worker.py или встроенный в бота, см. EMBEDDED_WORKER),
+# а бот, увидев завершённую задачу, отвечает пользователю.
+# Задача арендуется на JOB_LEASE_SECONDS и продлевается, пока выполняется;
+# упавший воркер аренду не продлит, и задачу заберёт другой.
+JOB_LEASE_SECONDS = float(os.environ.get("JOB_LEASE_SECONDS", "120"))
+JOB_RETRY_DELAY = float(os.environ.get("JOB_RETRY_DELAY", "15"))
+JOB_POLL_INTERVAL = float(os.environ.get("JOB_POLL_INTERVAL", "1"))
+JOB_WORKER_CONCURRENCY = int(os.environ.get("JOB_WORKER_CONCURRENCY", "2"))
+JOB_KEEP_SECONDS = float(os.environ.get("JOB_KEEP_SECONDS", str(7 * 24 * 3600)))
+JOB_PROGRESS_INTERVAL = float(os.environ.get("JOB_PROGRESS_INTERVAL", "3"))
+# Сколько процессов worker (Procfile) запущено рядом с ботом. Пока их не
+# объявили, задачи выполняет встроенный в бота воркер; EMBEDDED_WORKER=0/1
+# задаёт это явно
+WORKER_PROCESSES = int(os.environ.get("WORKER_PROCESSES", "0"))
+EMBEDDED_WORKER = os.environ.get("EMBEDDED_WORKER", "0" if WORKER_PROCESSES else "1") == "1"
+# Без встроенного воркера бот громко предупреждает, если задачу никто
+# не забрал за столько секунд
+JOB_UNCLAIMED_WARN_SECONDS = float(os.environ.get("JOB_UNCLAIMED_WARN_SECONDS", "60"))
+
+# kind -> корутина(payload, progress) -> dict (выполняется воркером);
+# progress(text) — синхронная запись хода выполнения, вызывать из потока
+RUNNERS = {}
+# kind -> корутина(bot, payload, result, error) (выполняется ботом по завершении)
+REPORTERS = {}
+# Задачи, меняющие базу знаний: после них бот обновляет свои кеши
+KNOWLEDGE_JOBS = {"document", "drive_sync"}
+
+
+metrics.register_queue("jobs", count_active_jobs)
+
+
+def runner(kind):
+    def register(func):
+        RUNNERS[kind] = func
+        return func
+    return register
+
+
+def reporter(kind):
+    def register(func):
+        REPORTERS[kind] = func
+        return func
+    return register
+
+
+async def enqueue(kind, payload, dedupe_key=None, max_attempts=3):
+    return await enqueue_job.aio(kind, json.dumps(payload), max_attempts, dedupe_key)
+
+
+def _telegram_bot():
+    """Bot API-клиент для воркера (в боте используется application.bot)."""
+    from telegram import Bot
+
+    base_url = os.environ.get("TELEGRAM_API_BASE_URL", "").rstrip("/")
+    if base_url:
+        return Bot(
+            os.environ["BOT_TOKEN"],
+            base_url=f"{base_url}/bot",
+            base_file_url=f"{base_url}/file/bot",
+        )
+    return Bot(os.environ["BOT_TOKEN"])
+
+
+# ---------- Задачи ----------
+
+@runner("voice")
+async def _run_voice(payload, progress):
+    from services import transcribe_voice
+
+    async with _telegram_bot() as bot:
+        file = await bot.get_file(payload["file_id"])
+        data = bytes(await file.download_as_bytearray())
+    return {"text": await transcribe_voice(data)}
+
+
+@runner("document")
+async def _run_document(payload, progress):
+    from services import add_knowledge, extract_upload
+
+    async with _telegram_bot() as bot:
+        file = await bot.get_file(payload["file_id"])
+        content = await extract_upload(file, payload["ext"])
+    if not content:
+        return {"knowledge_id": None, "knowledge_added": [], "knowledge_removed": []}
+    knowledge_id = await add_knowledge(payload["file_name"], content, payload["user_id"])
+    return {
+        "knowledge_id": knowledge_id,
+        "knowledge_added": [knowledge_id] if knowledge_id else [],
+        "knowledge_removed": [],
+    }
+
+
+@runner("drive_sync")
+async def _run_drive_sync(payload, progress):
+    from google_connect import sync_drive_folder_to_knowledge
+
+    last_report = 0.0
+
+    def report_progress(done, total, name):
+        # Вызывается из потока синхронизации: пишем не чаще JOB_PROGRESS_INTERVAL
+        nonlocal last_report
+        now = time.monotonic()
+        if done < total and now - last_report < JOB_PROGRESS_INTERVAL:
+            return
+        last_report = now
+        progress(f"⏳ Обработано файлов: {done} из {total}\nПоследний: {name}")
+
+    return await asyncio.to_thread(
+        sync_drive_folder_to_knowledge, payload["folder_id"], report_progress
+    )
+
+
+@runner("export_stats")
+async def _run_export_stats(payload, progress):
+    from google_connect import export_daily_activity_to_sheet
+
+    return await asyncio.to_thread(
+        export_daily_activity_to_sheet, payload["spreadsheet_id"], payload["range_name"]
+    )
+
+
+def _send_to(bot, payload):
+    """send_reply для ответа в исходный чат (на исходное сообщение, если оно известно)."""
+    return functools.partial(
+        bot.send_message,
+        payload["chat_id"],
+        reply_to_message_id=payload.get("message_id"),
+        allow_sending_without_reply=True,
+    )
+
+
+@reporter("voice")
+async def _report_voice(bot, payload, result, error):
+    from services import submit_user_input
+
+    send_reply = _send_to(bot, payload)
+    if error:
+        await send_reply("Произошла ошибка при обработке голосового сообщения.")
+        return
+    logger.info(f"Transcribed: {result['text']}")
+    await submit_user_input(payload["user_id"], result["text"], None, send_reply, payload["chat_id"])
+
+
+@reporter("document")
+async def _report_document(bot, payload, result, error):
+    send_reply = _send_to(bot, payload)
+    if error:
+        await send_reply("Не удалось обработать документ.")
+    elif result["knowledge_id"] is None:
+        await send_reply("В документе не нашлось текста.")
+    else:
+        await send_reply("Файл принят и обработан. Я запомнила информацию!")
+
+
+@reporter("drive_sync")
+async def _report_drive_sync(bot, payload, result, error):
+    if not payload.get("chat_id"):
+        logger.info(f"Синхронизация завершена: {result or error}")
+        return
+    send_reply = _send_to(bot, payload)
+    if error:
+        await send_reply(f"Ошибка при синхронизации: {error}")
+        return
+    await send_reply(
+        "📁 Папка синхронизирована!\n"
+        f"Новых файлов: {result['added']}, обновлено: {result['updated']}, "
+        f"удалено: {result['deleted']}, без изменений: {result['skipped']}, "
+        f"с ошибками: {result['failed']}."
+    )
+
+
+@reporter("export_stats")
+async def _report_export_stats(bot, payload, result, error):
+    if not payload.get("chat_id"):
+        logger.info(f"Экспорт активности в Google Sheets: {result or error}")
+        return
+    send_reply = _send_to(bot, payload)
+    if error:
+        await send_reply(f"Ошибка экспорта: {error}")
+        return
+    await send_reply(
+        f"✅ Статистика выгружена в Google Sheets: новых строк {result['appended']}, "
+        f"обновлено {result['updated']}."
+    )
+
+
+# ---------- Воркер ----------
+
+class Worker:
+    def __init__(self, name, kinds=None, concurrency=JOB_WORKER_CONCURRENCY):
+        self.name = name
+        self.kinds = kinds
+        self.concurrency = concurrency
+
+    async def _keep_lease(self, job_id):
+        while True:
+            await asyncio.sleep(JOB_LEASE_SECONDS / 3)
+            if not await extend_job_lease.aio(job_id, self.name, JOB_LEASE_SECONDS):
+                logger.warning(f"Задача {job_id}: аренду перехватил другой воркер")
+                return
+
+    async def run_once(self):
+        """Выполняет одну задачу; False — очередь пуста."""
+        job = await claim_job.aio(self.name, JOB_LEASE_SECONDS, self.kinds)
+        if job is None:
+            return False
+        job_id, kind, payload, attempts = job
+        logger.info(f"Задача {job_id} ({kind}), попытка {attempts}")
+        lease = asyncio.get_running_loop().create_task(self._keep_lease(job_id))
+        try:
+            run = RUNNERS.get(kind)
+            if run is None:
+                raise RuntimeError(f"Неизвестный тип задачи: {kind}")
+            with metrics.handler_seconds.time(handler=f"job_{kind}"):
+                result = await run(json.loads(payload), functools.partial(set_job_progress, job_id))
+        except Exception as e:
+            logger.exception(f"Задача {job_id} ({kind}) завершилась ошибкой")
+            delay = JOB_RETRY_DELAY * 2 ** (attempts - 1)
+            await fail_job.aio(job_id, self.name, str(e) or type(e).__name__, delay)
+        else:
+            await complete_job.aio(job_id, self.name, json.dumps(result))
+        finally:
+            lease.cancel()
+        return True
+
+    async def _loop(self, stop):
+        while not stop.is_set():
+            try:
+                if await self.run_once():
+                    continue
+            except Exception:
+                logger.exception("Ошибка воркера очереди задач")
+            try:
+                await asyncio.wait_for(stop.wait(), JOB_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+    async def run(self, stop):
+        """Забирает задачи, пока не установлен stop; начатые задачи доделываются."""
+        await asyncio.gather(*(self._loop(stop) for _ in range(self.concurrency)))
+
+
+# ---------- Ответы по завершённым задачам (в процессе бота) ----------
+
+async def watch_unclaimed_forever():
+    """Бот без встроенного воркера: задачи, которые никто не забирает, — ошибка развёртывания."""
+    while True:
+        await asyncio.sleep(JOB_UNCLAIMED_WARN_SECONDS)
+        try:
+            since = await get_oldest_waiting_job.aio()
+        except Exception:
+            logger.exception("Не удалось проверить очередь задач")
+            continue
+        if since is not None and time.time() - since > JOB_UNCLAIMED_WARN_SECONDS:
+            logger.error(
+                f"Задачи ждут воркера уже {time.time() - since:.0f} с: процесс worker "
+                f"не запущен (WORKER_PROCESSES={WORKER_PROCESSES}). Запустите его "
+                f"или уберите WORKER_PROCESSES, чтобы задачи выполнял сам бот"
+            )
+
+
+async def _refresh_knowledge_caches(results):
+    """
+    Задачи воркера изменили базу знаний: подтягиваем изменения в кеши бота.
+    Кеш ответов сбрасывается по id из результатов задач (индекс эмбеддингов
+    может быть выключен или не досчитан), векторный индекс сверяется с БД.
+    """
+    import embeddings
+    from answer_cache import answer_cache
+
+    removed = [i for result in results for i in result.get("knowledge_removed", [])]
+    if removed:
+        answer_cache.invalidate_knowledge(removed)
+    if any(result.get("knowledge_added") for result in results):
+        answer_cache.knowledge_added()
+    await asyncio.to_thread(embeddings.refresh)
+
+
+async def deliver_finished(bot):
+    """Один проход: ответы по завершённым задачам. Возвращает их число."""
+    finished = await claim_finished_jobs.aio()
+    if not finished:
+        return 0
+    changes = [
+        json.loads(result) for _, kind, _, status, result, _ in finished
+        if kind in KNOWLEDGE_JOBS and status == "done"
+    ]
+    if changes:
+        try:
+            await _refresh_knowledge_caches(changes)
+        except Exception:
+            logger.exception("Не удалось обновить кеши базы знаний")
+    for job_id, kind, payload, status, result, error in finished:
+        report = REPORTERS.get(kind)
+        if report is None:
+            continue
+        try:
+            await report(
+                bot,
+                json.loads(payload),
+                json.loads(result) if status == "done" else None,
+                error if status == "failed" else None,
+            )
+        except Exception:
+            logger.exception(f"Не удалось сообщить о результате задачи {job_id}")
+    await prune_notified_jobs.aio(JOB_KEEP_SECONDS)
+    return len(finished)
+
+
+async def deliver_progress(bot):
+    """Показывает новый ход выполнения задач в их статусных сообщениях."""
+    for job_id, kind, payload, progress in await claim_job_progress.aio():
+        payload = json.loads(payload)
+        if not payload.get("status_message_id"):
+            continue
+        try:
+            await bot.edit_message_text(
+                progress, chat_id=payload["chat_id"], message_id=payload["status_message_id"]
+            )
+        except Exception:
+            logger.warning(f"Не удалось показать ход задачи {job_id}", exc_info=True)
+
+
+async def deliver_finished_forever(bot):
+    while True:
+        try:
+            await deliver_progress(bot)
+            if await deliver_finished(bot):
+                continue
+        except Exception:
+            logger.exception("Ошибка при разборе завершённых задач")
+        await asyncio.sleep(JOB_POLL_INTERVAL)
@@ -10,6 +10,13 @@ from telegram.ext import (
     filters,
 )
 from db_utils import create_db
+from storage import db
+from activity import activity_buffer
+from extraction import shutdown_parse_pool
+import embeddings
+import jobs
+import metrics
+from answer_cache import answer_cache
 from handlers import (
     start,
     help_command,
@@ -23,13 +30,19 @@ from handlers import (
     list_knowledge,
     delete_knowledge,
     export_stats,          # NEW
+    stats,
+    metrics_report,
+    profile_command,
 )
 from services import (
     handle_text,
     handle_voice,
     handle_document,
     sync_every_hour,
+    export_activity_periodically,
     log_daily_activity,    # NEW
+    ACTIVITY_EXPORT_SPREADSHEET_ID,
+    scheduler,
 )
 
 # Настройка логгера
@@ -41,8 +54,45 @@ logger = logging.getLogger(__name__)
 
 BOT_TOKEN = os.environ["BOT_TOKEN"]
 GOOGLE_DRIVE_FOLDER_ID = os.environ.get("GOOGLE_DRIVE_FOLDER_ID")
+# polling (по умолчанию) или webhook (см. webhook.py). В Procfile бот в
+# режиме polling — процесс bot, в режиме webhook — процесс web: только он
+# получает $PORT. Запускается один из них, не оба.
+BOT_MODE = os.environ.get("BOT_MODE", "polling")
+# Другой адрес Bot API — например, локальный фейковый Telegram (fake_telegram.py)
+TELEGRAM_API_BASE_URL = os.environ.get("TELEGRAM_API_BASE_URL", "").rstrip("/")
+SHUTDOWN_DRAIN_TIMEOUT = float(os.environ.get("SHUTDOWN_DRAIN_TIMEOUT", "30"))
+_worker_stop = asyncio.Event()
+_worker_task = None
 
-app = ApplicationBuilder().token(BOT_TOKEN).build()
+
+async def on_stop(application):
+    # Ответы из очереди ещё отправляются через application.bot: дожидаемся
+    # их до application.shutdown(), который закрывает HTTP-клиент бота
+    try:
+        await asyncio.wait_for(scheduler.drain(), SHUTDOWN_DRAIN_TIMEOUT)
+    except asyncio.TimeoutError:
+        logger.warning(f"Остановка: в очереди осталось {scheduler.pending()} запросов")
+    # Встроенный воркер доделывает начатые задачи до закрытия базы
+    _worker_stop.set()
+    if _worker_task is not None:
+        try:
+            await asyncio.wait_for(_worker_task, SHUTDOWN_DRAIN_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning("Остановка: встроенный воркер не успел доделать задачи")
+
+
+async def on_shutdown(application):
+    await activity_buffer.flush()
+    await asyncio.to_thread(shutdown_parse_pool)
+    await asyncio.to_thread(db.close)
+
+
+builder = ApplicationBuilder().token(BOT_TOKEN).post_stop(on_stop).post_shutdown(on_shutdown)
+if TELEGRAM_API_BASE_URL:
+    builder = builder.base_url(f"{TELEGRAM_API_BASE_URL}/bot").base_file_url(
+        f"{TELEGRAM_API_BASE_URL}/file/bot"
+    )
+app = builder.build()
 
 # Регистрация хендлеров команд
 app.add_handler(CommandHandler("start", start))
@@ -57,6 +107,9 @@ app.add_handler(CommandHandler("debug_knowledge", debug_knowledge))
 app.add_handler(CommandHandler("list_knowledge", list_knowledge))
 app.add_handler(CommandHandler("delete_knowledge", delete_knowledge))
 app.add_handler(CommandHandler("export_stats", export_stats))   # NEW
+app.add_handler(CommandHandler("stats", stats))
+app.add_handler(CommandHandler("metrics", metrics_report))
+app.add_handler(CommandHandler("profile", profile_command))
 
 # Хендлеры контента
 app.add_handler(MessageHandler(filters.VOICE, handle_voice))
@@ -66,17 +119,48 @@ app.add_handler(MessageHandler(filters.TEXT & (~filters.COMMAND), handle_text))
 # Хендлер логирования активности – ДОЛЖЕН идти последним
 app.add_handler(MessageHandler(filters.ALL, log_daily_activity))
 
+# Время и ошибки каждого хендлера (см. metrics.py)
+metrics.instrument_application(app)
+
 create_db()
 
 
-async def main():
+def start_background_tasks():
+    global _worker_task
+    app.create_task(metrics.monitor_event_loop())
+    if metrics.METRICS_PORT:
+        app.create_task(metrics.start_server())
+    app.create_task(asyncio.to_thread(embeddings.warm_up))
+    app.create_task(jobs.deliver_finished_forever(app.bot))
+    if jobs.EMBEDDED_WORKER:
+        # Без отдельного процесса worker задачи выполняет сам бот
+        _worker_task = app.create_task(jobs.Worker(f"bot-{os.getpid()}").run(_worker_stop))
+    else:
+        logger.warning(
+            f"Встроенный воркер выключен: задачи выполняют процессы worker "
+            f"(WORKER_PROCESSES={jobs.WORKER_PROCESSES})"
+        )
+        app.create_task(jobs.watch_unclaimed_forever())
+    app.create_task(asyncio.to_thread(answer_cache.warm_up))
+    app.create_task(activity_buffer.run())
     if GOOGLE_DRIVE_FOLDER_ID:
         app.create_task(sync_every_hour())
     else:
         logger.warning("GOOGLE_DRIVE_FOLDER_ID не задан — авто-синхронизация не будет запущена")
+    if ACTIVITY_EXPORT_SPREADSHEET_ID:
+        app.create_task(export_activity_periodically())
+
+
+async def main():
+    start_background_tasks()
     await app.run_polling()
 
 
 if __name__ == "__main__":
-    nest_asyncio.apply()
-    asyncio.run(main())
+    if BOT_MODE == "webhook":
+        from webhook import run_webhook
+
+        asyncio.run(run_webhook(app, start_background_tasks, on_stop, on_shutdown))
+    else:
+        nest_asyncio.apply()
+        asyncio.run(main())
@@ -0,0 +1,406 @@
+import asyncio
+import bisect
+import functools
+import hmac
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Метрики процесса в памяти: счётчики, значения и гистограммы задержек
+# с метками. Отдаются в текстовом формате Prometheus на /metrics
+# отдельного порта METRICS_PORT, кратко — командой /metrics.
+# Наблюдения пишутся из любых потоков (БД, Google).
+# Если задан METRICS_TOKEN, /metrics требует заголовок
+# Authorization: Bearer <токен> и дополнительно отдаётся webhook-сервером
+# (он смотрит в интернет, поэтому без токена метрик на нём нет).
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "0"))
+METRICS_HOST = os.environ.get("METRICS_HOST", "0.0.0.0")
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN", "")
+LOOP_LAG_INTERVAL = float(os.environ.get("LOOP_LAG_INTERVAL", "0.5"))
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+FAST_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5)
+
+REGISTRY = []
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in (*zip(names, values), *extra)]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, "")) for name in self.labels)
+
+    def items(self):
+        with self._lock:
+            return sorted(self._values.items())
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for key, value in self.items():
+            lines.append(f"{self.name}{_format_labels(self.labels, key)} {value}")
+        return lines
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """Значение задаётся через set() или вычисляется при чтении функцией из set_function()."""
+
+    kind = "gauge"
+
+    def __init__(self, name, help_text, labels=()):
+        super().__init__(name, help_text, labels)
+        self._function = None
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def set_function(self, function):
+        """function() -> число или {кортеж меток: число}."""
+        self._function = function
+
+    def items(self):
+        if self._function is None:
+            return super().items()
+        try:
+            value = self._function()
+        except Exception:
+            logger.exception(f"Не удалось вычислить метрику {self.name}")
+            return []
+        if isinstance(value, dict):
+            return sorted(value.items())
+        return [((), value)]
+
+
+class _HistogramValue:
+    __slots__ = ("counts", "total", "count")
+
+    def __init__(self, size):
+        self.counts = [0] * size
+        self.total = 0.0
+        self.count = 0
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = _HistogramValue(len(self.buckets) + 1)
+            state.counts[index] += 1
+            state.total += value
+            state.count += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """with histogram.time(...): — наблюдение длительности блока в секундах."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def items(self):
+        with self._lock:
+            return sorted(
+                (key, (list(state.counts), state.total, state.count))
+                for key, state in self._values.items()
+            )
+
+    def quantile(self, counts, q):
+        """Оценка квантиля по корзинам (линейная интерполяция внутри корзины)."""
+        total = sum(counts)
+        if not total:
+            return 0.0
+        rank = q * total
+        seen = 0
+        for index, count in enumerate(counts):
+            if seen + count >= rank and count:
+                lower = self.buckets[index - 1] if index else 0.0
+                if index == len(self.buckets):
+                    return lower  # выше последней границы — точнее не сказать
+                return lower + (self.buckets[index] - lower) * (rank - seen) / count
+            seen += count
+        return self.buckets[-1]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for key, (counts, total, count) in self.items():
+            cumulative = 0
+            for bound, bucket_count in zip((*self.buckets, "+Inf"), counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.labels, key, (("le", bound),))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labels, key)
+            lines.append(f"{self.name}_sum{labels} {total}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+# ---------- Метрики бота ----------
+
+handler_seconds = Histogram(
+    "liza_handler_seconds", "Время обработки обновления хендлером", ("handler",)
+)
+handler_errors = Counter(
+    "liza_handler_errors_total", "Исключения в хендлерах", ("handler",)
+)
+dependency_seconds = Histogram(
+    "liza_dependency_seconds", "Время запросов к внешним сервисам", ("service", "operation")
+)
+dependency_errors = Counter(
+    "liza_dependency_errors_total", "Ошибки запросов к внешним сервисам", ("service", "operation")
+)
+db_query_seconds = Histogram(
+    "liza_db_query_seconds", "Время выполнения функции БД в потоке БД",
+    ("query", "mode"), buckets=FAST_BUCKETS,
+)
+db_wait_seconds = Histogram(
+    "liza_db_wait_seconds", "Ожидание свободного потока БД", ("mode",), buckets=FAST_BUCKETS,
+)
+openai_tokens = Counter(
+    "liza_openai_tokens_total", "Токены OpenAI", ("model", "type")
+)
+scheduler_wait_seconds = Histogram(
+    "liza_scheduler_wait_seconds", "Ожидание запроса в очереди планировщика"
+)
+queue_depth = Gauge(
+    "liza_queue_depth", "Глубина очередей", ("queue",)
+)
+event_loop_lag_seconds = Histogram(
+    "liza_event_loop_lag_seconds", "Опоздание event loop", buckets=FAST_BUCKETS
+)
+
+# Источники глубины очередей: имя -> функция без аргументов
+_queue_sources = {}
+
+
+def register_queue(name, function):
+    _queue_sources[name] = function
+
+
+def _queue_depths():
+    depths = {}
+    for name, function in list(_queue_sources.items()):
+        try:
+            value = function()
+        except Exception:
+            logger.exception(f"Не удалось узнать длину очереди {name}")
+            continue
+        if isinstance(value, dict):
+            for sub, count in value.items():
+                depths[(f"{name}_{sub}",)] = count
+        else:
+            depths[(name,)] = value
+    return depths
+
+
+queue_depth.set_function(_queue_depths)
+
+
+@contextmanager
+def track_dependency(service, operation):
+    """Время и ошибки одного обращения к внешнему сервису."""
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        dependency_errors.inc(service=service, operation=operation)
+        raise
+    finally:
+        dependency_seconds.observe(
+            time.perf_counter() - started, service=service, operation=operation
+        )
+
+
+def record_openai_usage(model, usage):
+    if usage is None:
+        return
+    openai_tokens.inc(getattr(usage, "prompt_tokens", 0) or 0, model=model, type="prompt")
+    openai_tokens.inc(getattr(usage, "completion_tokens", 0) or 0, model=model, type="completion")
+
+
+# Подписчики на завершение хендлеров: hook(name, seconds, update).
+# Пустой список почти ничего не стоит; так к хендлерам подключается /profile.
+handler_hooks = []
+
+
+def _handler_done(name, seconds, update=None):
+    handler_seconds.observe(seconds, handler=name)
+    for hook in handler_hooks:
+        hook(name, seconds, update)
+
+
+@contextmanager
+def time_handler(name):
+    """Как instrument_handler, но для блока кода (например, process_user_input)."""
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        handler_errors.inc(handler=name)
+        raise
+    finally:
+        _handler_done(name, time.perf_counter() - started)
+
+
+def instrument_handler(callback, name=None):
+    """Обёртка хендлера Telegram: время и исключения по имени хендлера."""
+    name = name or callback.__name__
+
+    @functools.wraps(callback)
+    async def wrapper(update, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await callback(update, *args, **kwargs)
+        except Exception:
+            handler_errors.inc(handler=name)
+            raise
+        finally:
+            _handler_done(name, time.perf_counter() - started, update)
+
+    return wrapper
+
+
+def instrument_application(application):
+    """Оборачивает колбэки всех зарегистрированных хендлеров приложения."""
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            handler.callback = instrument_handler(handler.callback)
+
+
+async def monitor_event_loop(interval=LOOP_LAG_INTERVAL):
+    """Насколько позже запланированного просыпается event loop (блокирующий код)."""
+    loop = asyncio.get_running_loop()
+    while True:
+        expected = loop.time() + interval
+        await asyncio.sleep(interval)
+        event_loop_lag_seconds.observe(max(0.0, loop.time() - expected))
+
+
+# ---------- Вывод ----------
+
+def render():
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+def _format_seconds(seconds):
+    return f"{seconds * 1000:.0f} мс" if seconds < 1 else f"{seconds:.1f} с"
+
+
+def _histogram_lines(histogram, limit):
+    rows = []
+    for key, (counts, total, count) in histogram.items():
+        if count:
+            rows.append((total, key, count, histogram.quantile(counts, 0.95)))
+    rows.sort(reverse=True)
+    return [
+        f"{' / '.join(key) or 'всего'}: {count} шт., среднее {_format_seconds(total / count)}, "
+        f"p95 {_format_seconds(p95)}"
+        for total, key, count, p95 in rows[:limit]
+    ]
+
+
+def summary(limit=8):
+    """Краткая сводка для /metrics: где больше всего суммарного времени."""
+    lines = ["📈 Метрики с момента запуска", "", "Хендлеры:"]
+    lines += _histogram_lines(handler_seconds, limit) or ["нет данных"]
+    errors = [f"{key[0]}: {value}" for key, value in handler_errors.items()]
+    if errors:
+        lines.append("Ошибки: " + ", ".join(errors))
+    lines += ["", "Внешние сервисы:"]
+    lines += _histogram_lines(dependency_seconds, limit) or ["нет данных"]
+    errors = [f"{'/'.join(key)}: {value}" for key, value in dependency_errors.items()]
+    if errors:
+        lines.append("Ошибки: " + ", ".join(errors))
+    lines += ["", "БД (по суммарному времени):"]
+    lines += _histogram_lines(db_query_seconds, limit) or ["нет данных"]
+
+    tokens = {}
+    for (model, kind), value in openai_tokens.items():
+        tokens.setdefault(model, {})[kind] = value
+    lines += ["", "Токены OpenAI:"]
+    lines += [
+        f"{model}: запрос {values.get('prompt', 0)}, ответ {values.get('completion', 0)}"
+        for model, values in sorted(tokens.items())
+    ] or ["нет данных"]
+
+    depths = ", ".join(f"{key[0]} {value}" for key, value in queue_depth.items())
+    lines += ["", f"Очереди: {depths or 'нет данных'}"]
+    lines += ["Ожидание в планировщике: " + (
+        "; ".join(_histogram_lines(scheduler_wait_seconds, 1)) or "нет данных"
+    )]
+    lines += ["Опоздание event loop: " + (
+        "; ".join(_histogram_lines(event_loop_lag_seconds, 1)) or "нет данных"
+    )]
+    return "\n".join(lines)
+
+
+async def handle_metrics(request):
+    """aiohttp-обработчик /metrics в формате Prometheus."""
+    from aiohttp import web
+
+    if METRICS_TOKEN:
+        token = request.headers.get("Authorization", "").removeprefix("Bearer ")
+        # compare_digest не принимает str с не-ASCII символами — сравниваем байты
+        if not hmac.compare_digest(
+            token.encode("utf-8", "surrogateescape"), METRICS_TOKEN.encode("utf-8", "surrogateescape")
+        ):
+            return web.Response(status=401)
+    # Глубина очереди задач читается из БД — не в потоке event loop
+    text = await asyncio.to_thread(render)
+    return web.Response(text=text, content_type="text/plain", charset="utf-8")
+
+
+async def start_server(host=METRICS_HOST, port=METRICS_PORT):
+    """Отдельный HTTP-сервер с /metrics (для режима polling и процесса worker)."""
+    from aiohttp import web
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info(f"Метрики доступны на {host}:{port}/metrics")
+    return runner
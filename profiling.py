@@ -0,0 +1,226 @@
+import asyncio
+import cProfile
+import io
+import logging
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Профилирование по команде /profile на ограниченное окно (секунды или
+# число обновлений). Пока окно открыто:
+# - cProfile в потоке event loop — какие функции занимают сам loop;
+# - поток-сэмплер раз в PROFILE_SAMPLE_INTERVAL снимает стеки всех потоков
+#   (пулы БД, Google, разбор документов) — где проходит время, включая ожидание;
+# - по каждому хендлеру — число вызовов и полное время от начала до конца.
+# Вне окна профилировщика нет: остаётся только проверка пустого списка
+# metrics.handler_hooks при завершении хендлера.
+PROFILE_MAX_SECONDS = float(os.environ.get("PROFILE_MAX_SECONDS", "600"))
+PROFILE_SAMPLE_INTERVAL = float(os.environ.get("PROFILE_SAMPLE_INTERVAL", "0.01"))
+PROFILE_STACK_DEPTH = 25
+PROFILE_TOP = 40
+
+# Верхний кадр из этих модулей — поток простаивает (ждёт задачу или сокет)
+_IDLE_MODULES = ("selectors.py", "threading.py", "queue.py", "thread.py")
+
+
+class _Sampler(threading.Thread):
+    def __init__(self, interval):
+        super().__init__(name="profile-sampler", daemon=True)
+        self.interval = interval
+        self.stacks = Counter()  # (имя потока, стек) -> число сэмплов
+        self.busy = Counter()  # имя потока -> сэмплы, когда поток не простаивал
+        self.total = Counter()  # имя потока -> все сэмплы
+        self._halt = threading.Event()
+
+    def run(self):
+        own = threading.get_ident()
+        while not self._halt.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                name = names.get(ident, str(ident))
+                self.total[name] += 1
+                if frame.f_code.co_filename.endswith(_IDLE_MODULES):
+                    continue
+                self.busy[name] += 1
+                stack = []
+                while frame is not None and len(stack) < PROFILE_STACK_DEPTH:
+                    code = frame.f_code
+                    stack.append(f"{os.path.basename(code.co_filename)}:{frame.f_lineno} {code.co_name}")
+                    frame = frame.f_back
+                self.stacks[(name, tuple(reversed(stack)))] += 1
+
+    def stop(self):
+        self._halt.set()
+        self.join()
+
+
+class ProfileSession:
+    def __init__(self, seconds=None, requests=None):
+        self.seconds = min(seconds or PROFILE_MAX_SECONDS, PROFILE_MAX_SECONDS)
+        self.requests = requests
+        self.handled = 0
+        self.calls = {}  # хендлер -> [число, сумма, максимум]
+        self.slowest = []  # (секунды, хендлер, описание обновления)
+        self.done = asyncio.Event()
+        self._profile = cProfile.Profile()
+        self._sampler = _Sampler(PROFILE_SAMPLE_INTERVAL)
+
+    def _on_handler(self, name, seconds, update):
+        calls = self.calls.setdefault(name, [0, 0.0, 0.0])
+        calls[0] += 1
+        calls[1] += seconds
+        calls[2] = max(calls[2], seconds)
+        self.slowest.append((seconds, name, _describe(update)))
+        if len(self.slowest) > 200:
+            self.slowest = sorted(self.slowest, reverse=True)[:20]
+        if update is not None:
+            self.handled += 1
+            if self.requests and self.handled >= self.requests:
+                self.done.set()
+
+    def start(self):
+        """Вызывается из потока event loop: cProfile работает в том потоке, где включён."""
+        self.started_at = datetime.now()
+        self._wall = time.perf_counter()
+        self._cpu = time.process_time()
+        self._loop_cpu = time.thread_time()
+        metrics.handler_hooks.append(self._on_handler)
+        self._sampler.start()
+        self._profile.enable()
+
+    def stop(self):
+        self._profile.disable()
+        self._sampler.stop()
+        metrics.handler_hooks.remove(self._on_handler)
+        self.wall = time.perf_counter() - self._wall
+        self.cpu = time.process_time() - self._cpu
+        self.loop_cpu = time.thread_time() - self._loop_cpu
+
+    async def run(self):
+        self.start()
+        try:
+            await asyncio.wait_for(self.done.wait(), self.seconds)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            self.stop()
+
+    def report(self):
+        stats = pstats.Stats(self._profile, stream=io.StringIO())
+        lines = [
+            f"Профиль с {self.started_at:%Y-%m-%d %H:%M:%S}, pid {os.getpid()}",
+            "",
+            f"Длительность окна: {self.wall:.2f} с, обновлений: {self.handled}",
+            f"CPU процесса: {self.cpu:.2f} с ({100 * self.cpu / self.wall:.0f}% одного ядра)",
+            f"CPU потока event loop: {self.loop_cpu:.2f} с "
+            f"({100 * self.loop_cpu / self.wall:.0f}% окна)",
+            f"Время в коде под cProfile (поток event loop): {stats.total_tt:.2f} с",
+            "",
+            "== Хендлеры: вызовов, полное время (сумма / среднее / максимум), из него в event loop ==",
+        ]
+        on_loop = _time_on_loop(stats)
+        for name, (count, total, longest) in sorted(
+            self.calls.items(), key=lambda item: item[1][1], reverse=True
+        ):
+            loop_time = on_loop.get(name)
+            lines.append(
+                f"{name}: {count}, {total:.3f} / {total / count:.3f} / {longest:.3f} с"
+                + (f", в loop {loop_time:.3f} с" if loop_time is not None else "")
+            )
+
+        lines += ["", "== Самые медленные вызовы хендлеров =="]
+        for seconds, name, description in sorted(self.slowest, reverse=True)[:20]:
+            lines.append(f"{seconds:.3f} с  {name}  {description}")
+
+        lines += ["", "== Потоки: доля сэмплов, когда поток был занят =="]
+        for name, total in self._sampler.total.most_common():
+            busy = self._sampler.busy[name]
+            if busy:
+                lines.append(f"{name}: {100 * busy / total:.0f}% ({busy} из {total})")
+
+        lines += ["", f"== Самые частые стеки (сэмпл раз в {PROFILE_SAMPLE_INTERVAL * 1000:.0f} мс) =="]
+        for (name, stack), count in self._sampler.stacks.most_common(PROFILE_TOP // 2):
+            lines.append(f"--- {name}: {count} сэмплов ≈ {count * PROFILE_SAMPLE_INTERVAL:.2f} с")
+            lines += [f"    {frame}" for frame in stack]
+
+        out = io.StringIO()
+        stats.stream = out
+        stats.sort_stats("cumulative").print_stats(PROFILE_TOP)
+        lines += ["", "== cProfile: по суммарному времени (поток event loop) ==", out.getvalue()]
+        out = io.StringIO()
+        stats.stream = out
+        stats.sort_stats("tottime").print_stats(PROFILE_TOP)
+        lines += ["== cProfile: по собственному времени ==", out.getvalue()]
+        return "\n".join(lines)
+
+
+def _describe(update):
+    message = getattr(update, "effective_message", None)
+    if message is None:
+        return ""
+    if message.text:
+        return f"chat {message.chat_id}: {message.text[:60]!r}"
+    kind = "голосовое" if message.voice else "документ" if message.document else "сообщение"
+    return f"chat {message.chat_id}: {kind}"
+
+
+def _time_on_loop(stats):
+    """
+    Суммарное время корутины хендлера под cProfile по имени функции.
+    Ожидание (await) сюда не входит — только работа в event loop.
+    """
+    result = {}
+    for (_, _, name), (_, _, _, cumulative, _) in stats.stats.items():
+        result[name] = result.get(name, 0.0) + cumulative
+    return result
+
+
+_session = None
+
+
+def parse_window(args):
+    """
+    Аргументы /profile -> (секунды, число обновлений).
+    /profile 30 — 30 секунд, /profile 50 req — до 50 обновлений.
+    """
+    if not args:
+        return 30.0, None
+    value = args[0].lower()
+    unit = args[1].lower() if len(args) > 1 else ""
+    for suffix in ("req", "r", "s"):
+        if value.endswith(suffix) and value[: -len(suffix)].isdigit():
+            value, unit = value[: -len(suffix)], suffix
+            break
+    number = float(value)  # ValueError — разбирается в хендлере
+    if number <= 0:
+        raise ValueError(value)
+    if unit.startswith(("r", "з")):  # req, requests, запросов
+        return None, int(number)
+    return number, None
+
+
+def is_running():
+    return _session is not None
+
+
+async def profile(seconds=None, requests=None):
+    """Профилирует окно и возвращает текст отчёта; одновременно — одна сессия."""
+    global _session
+    if _session is not None:
+        raise RuntimeError("Профилирование уже идёт")
+    _session = ProfileSession(seconds, requests)
+    try:
+        await _session.run()
+        return await asyncio.to_thread(_session.report)
+    finally:
+        _session = None
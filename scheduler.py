@@ -0,0 +1,225 @@
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Честная очередь запросов к LLM: у каждого пользователя свой «кошелёк»
+# токенов (USER_BURST запросов подряд, дальше USER_RATE_PER_MINUTE в минуту),
+# не больше USER_MAX_PENDING запросов в очереди и один запрос в работе.
+# Первое сообщение пользователя обрабатывается сразу; сообщения, пришедшие,
+# пока оно ждёт или обрабатывается, склеиваются в один следующий запрос
+# (серия считается законченной после COALESCE_WINDOW секунд тишины). Пользователи обслуживаются по кругу, администраторы — первыми.
+# При ошибках лимита API число одновременных запросов уменьшается вдвое
+# и затем растёт на единицу после каждого успешного (AIMD).
+SCHEDULER_CONCURRENCY = int(os.environ.get("SCHEDULER_CONCURRENCY", "8"))
+USER_RATE_PER_MINUTE = float(os.environ.get("USER_RATE_PER_MINUTE", "6"))
+USER_BURST = float(os.environ.get("USER_BURST", "3"))
+USER_MAX_PENDING = int(os.environ.get("USER_MAX_PENDING", "3"))
+COALESCE_WINDOW = float(os.environ.get("COALESCE_WINDOW", "1.5"))
+COALESCE_MAX_CHARS = int(os.environ.get("COALESCE_MAX_CHARS", "4000"))
+RATE_LIMIT_PAUSE = 2.0
+
+
+class TokenBucket:
+    def __init__(self, rate_per_second, capacity):
+        self.rate = rate_per_second
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now):
+        """Через сколько секунд будет доступен токен (0 — уже есть)."""
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate if self.rate > 0 else float("inf")
+
+    def take(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+
+class _Job:
+    __slots__ = ("chat_id", "parts", "args", "ready_at", "queued_at")
+
+    def __init__(self, chat_id, text, args, ready_at):
+        self.chat_id = chat_id
+        self.parts = [text]
+        self.args = args
+        self.ready_at = ready_at
+        self.queued_at = time.monotonic()
+
+    @property
+    def text(self):
+        return "\n".join(self.parts)
+
+
+class _UserState:
+    __slots__ = ("queue", "bucket", "busy", "priority")
+
+    def __init__(self, priority):
+        self.queue = deque()
+        self.bucket = TokenBucket(USER_RATE_PER_MINUTE / 60, USER_BURST)
+        self.busy = False
+        self.priority = priority
+
+
+class FairScheduler:
+    """
+    run(user_id, text, *args) — корутина, которая обрабатывает запрос.
+    Работает в потоке event loop, поэтому без блокировок.
+    """
+
+    def __init__(self, run):
+        self._run = run
+        self._users = {}
+        self._rings = (deque(), deque())  # (администраторы, остальные)
+        self._limit = SCHEDULER_CONCURRENCY
+        self._running = 0
+        self._paused_until = 0.0
+        self._rate_limited_at = 0.0
+        self._wakeup = None
+        self._dispatcher = None
+        self._tasks = set()
+
+    def submit(self, user_id, chat_id, text, *args, priority=False):
+        """
+        Ставит сообщение в очередь. Возвращает False, если очередь
+        пользователя переполнена и сообщение отброшено.
+        """
+        now = time.monotonic()
+        state = self._users.get(user_id)
+        if state is None:
+            state = self._users[user_id] = _UserState(priority)
+
+        last = state.queue[-1] if state.queue else None
+        if (
+            last is not None
+            and last.chat_id == chat_id
+            and len(last.text) + len(text) < COALESCE_MAX_CHARS
+        ):
+            # Ответ пойдёт на последнее сообщение серии. Пока идёт предыдущий
+            # запрос, ждём конца серии; иначе запрос ждёт только свободного места
+            last.parts.append(text)
+            last.args = args
+            if state.busy:
+                last.ready_at = now + COALESCE_WINDOW
+        elif len(state.queue) >= USER_MAX_PENDING:
+            return False
+        else:
+            # Первое сообщение уходит сразу; копятся только пришедшие, пока
+            # предыдущее ещё ждёт или обрабатывается
+            hold = COALESCE_WINDOW if state.busy or state.queue else 0.0
+            state.queue.append(_Job(chat_id, text, args, now + hold))
+            if len(state.queue) == 1 and not state.busy:
+                self._rings[0 if priority else 1].append(user_id)
+
+        self._ensure_dispatcher()
+        self._wakeup.set()
+        return True
+
+    def report_rate_limit(self, retry_after=None):
+        """API ответил 429: уменьшаем параллельность и ненадолго приостанавливаем выдачу."""
+        self._limit = max(1, self._limit // 2)
+        self._rate_limited_at = time.monotonic()
+        pause = retry_after if retry_after else RATE_LIMIT_PAUSE
+        self._paused_until = max(self._paused_until, time.monotonic() + pause)
+        logger.warning(f"Лимит запросов API: параллельность снижена до {self._limit}")
+
+    def pending(self):
+        return sum(len(state.queue) for state in self._users.values())
+
+    async def drain(self):
+        """Ждёт, пока очередь опустеет и все начатые запросы завершатся."""
+        while self._tasks or self.pending():
+            if self._tasks:
+                await asyncio.wait(set(self._tasks))
+            else:
+                await asyncio.sleep(0.1)
+
+    def _ensure_dispatcher(self):
+        if self._dispatcher is None or self._dispatcher.done():
+            self._wakeup = asyncio.Event()
+            self._dispatcher = asyncio.get_running_loop().create_task(self._dispatch())
+
+    def _pick(self, now):
+        """
+        Следующая задача по кругу: сначала администраторы, затем остальные.
+        Возвращает (user_id, job) или (None, через сколько секунд проверить снова).
+        """
+        next_check = float("inf")
+        for ring in self._rings:
+            for _ in range(len(ring)):
+                user_id = ring.popleft()
+                state = self._users[user_id]
+                job = state.queue[0]
+                wait = max(job.ready_at - now, 0.0)
+                if not state.priority:
+                    wait = max(wait, state.bucket.wait_time(now))
+                if wait <= 0:
+                    state.queue.popleft()
+                    if not state.priority:
+                        state.bucket.take(now)
+                    return user_id, job
+                ring.append(user_id)
+                next_check = min(next_check, wait)
+        return None, next_check
+
+    async def _dispatch(self):
+        while True:
+            now = time.monotonic()
+            timeout = None
+            if now < self._paused_until:
+                timeout = self._paused_until - now
+            elif self._running < self._limit:
+                user_id, picked = self._pick(now)
+                if user_id is not None:
+                    self._start(user_id, picked)
+                    continue
+                if picked != float("inf"):
+                    timeout = picked
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def _start(self, user_id, job):
+        state = self._users[user_id]
+        state.busy = True
+        self._running += 1
+        metrics.scheduler_wait_seconds.observe(time.monotonic() - job.queued_at)
+        task = asyncio.get_running_loop().create_task(
+            self._execute(user_id, state, job)
+        )
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _execute(self, user_id, state, job):
+        started = time.monotonic()
+        try:
+            await self._run(user_id, job.text, *job.args)
+            if started > self._rate_limited_at:
+                self._limit = min(SCHEDULER_CONCURRENCY, self._limit + 1)
+        except Exception:
+            logger.exception("Ошибка при обработке запроса из очереди")
+        finally:
+            self._running -= 1
+            state.busy = False
+            if state.queue:
+                self._rings[0 if state.priority else 1].append(user_id)
+            elif state.bucket.wait_time(time.monotonic()) == 0 and (
+                state.bucket.tokens >= state.bucket.capacity
+            ):
+                # Кошелёк полон и очередь пуста — состояние можно забыть
+                self._users.pop(user_id, None)
+            self._wakeup.set()
@@ -1,21 +1,82 @@
 import openai
+import io
 import logging
-import sqlite3
 import os
-import fitz  # PyMuPDF
-import docx
+import tempfile
 from pydub import AudioSegment
 import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from telegram.error import BadRequest, RetryAfter
 
 from db_utils import (
-    save_conversation,
-    get_conversation,
-    get_relevant_knowledge,
+    get_parsed_text,
+    save_parsed_text,
+    save_knowledge,
+    search_chunk_ids,
+    get_chunk_passages,
 )
+from activity import activity_buffer
+from answer_cache import answer_cache
+from scheduler import FairScheduler
+import jobs
+import metrics
+from extraction import (
+    PARSE_CACHE_MAX_ROWS,
+    PARSER_VERSION,
+    SUPPORTED_EXTENSIONS,
+    extract_text,
+    file_md5,
+    get_parse_pool,
+)
+import conversation
+import embeddings
 
 logger = logging.getLogger(__name__)
 openai.api_key = os.environ["OPENAI_API_KEY"]
 
+# Общий асинхронный клиент OpenAI: запросы не блокируют event loop,
+# а семафор ограничивает число одновременных обращений к API.
+OPENAI_MAX_CONCURRENCY = int(os.environ.get("OPENAI_MAX_CONCURRENCY", "8"))
+OPENAI_CHAT_TIMEOUT = float(os.environ.get("OPENAI_CHAT_TIMEOUT", "60"))
+OPENAI_AUDIO_TIMEOUT = float(os.environ.get("OPENAI_AUDIO_TIMEOUT", "120"))
+
+openai_client = openai.AsyncOpenAI(
+    api_key=openai.api_key,
+    timeout=OPENAI_CHAT_TIMEOUT,
+    max_retries=2,
+)
+_openai_semaphore = asyncio.Semaphore(OPENAI_MAX_CONCURRENCY)
+
+# Потоковый режим: ответ появляется в Telegram по мере генерации.
+# Telegram ограничивает частоту правок, поэтому редактируем не чаще,
+# чем раз в STREAM_EDIT_INTERVAL секунд.
+LLM_STREAMING = os.environ.get("LLM_STREAMING", "1") == "1"
+STREAM_EDIT_INTERVAL = float(os.environ.get("STREAM_EDIT_INTERVAL", "1.5"))
+TELEGRAM_MESSAGE_LIMIT = 4096
+STREAM_CURSOR = " ▌"
+
+SUMMARY_MODEL = os.environ.get("SUMMARY_MODEL", "gpt-4o-mini")
+
+# Голосовые: файл скачивается в память и уходит в Whisper как есть (OGG/Opus
+# он принимает). Перекодирование в MP3 — только запасной вариант, в отдельном
+# пуле, чтобы ffmpeg не блокировал event loop и не запускался без ограничений.
+VOICE_SEND_OGG = os.environ.get("VOICE_SEND_OGG", "1") == "1"
+VOICE_MAX_BYTES = int(os.environ.get("VOICE_MAX_BYTES", str(25 * 1024 * 1024)))
+TRANSCODE_WORKERS = int(os.environ.get("TRANSCODE_WORKERS", "2"))
+_transcode_pool = ThreadPoolExecutor(
+    max_workers=TRANSCODE_WORKERS, thread_name_prefix="transcode"
+)
+
+# Загруженные документы скачиваются во временный файл (UPLOAD_SPOOL_DIR,
+# по умолчанию системный tmp) и разбираются в пуле процессов.
+# 20 МБ — предел, который Bot API вообще отдаёт через getFile.
+UPLOAD_MAX_BYTES = int(os.environ.get("UPLOAD_MAX_BYTES", str(20 * 1024 * 1024)))
+UPLOAD_SPOOL_DIR = os.environ.get("UPLOAD_SPOOL_DIR") or None
+UPLOAD_FORMATS = ", ".join(f".{ext}" for ext in SUPPORTED_EXTENSIONS)
+
+# Ссылки на фоновые задачи, чтобы их не собрал сборщик мусора
+_background_tasks = set()
+
 SYSTEM_PROMPT = {
     "role": "system",
     "content": (
@@ -26,17 +87,235 @@ SYSTEM_PROMPT = {
 }
 
 
-async def process_user_input(user_id, user_input, context, send_reply):
-    logger.info(f"User {user_id} wrote: {user_input}")
-    context_history = get_conversation(user_id)
-    context_history += f"\n{user_input}"
-    save_conversation(user_id, context_history)
+def _report_rate_limit(error):
+    """Сообщает планировщику об ответе 429, чтобы он сбавил темп."""
+    retry_after = None
+    try:
+        retry_after = float(error.response.headers.get("retry-after"))
+    except (AttributeError, TypeError, ValueError):
+        pass
+    scheduler.report_rate_limit(retry_after)
+
+
+async def chat_completion(messages, model="gpt-4o"):
+    """Запрос к chat completions через общий клиент с лимитом параллельности."""
+    async with _openai_semaphore:
+        try:
+            with metrics.track_dependency("openai", "chat"):
+                response = await openai_client.chat.completions.create(
+                    model=model,
+                    messages=messages,
+                    timeout=OPENAI_CHAT_TIMEOUT,
+                )
+        except openai.RateLimitError as e:
+            _report_rate_limit(e)
+            raise
+        metrics.record_openai_usage(model, getattr(response, "usage", None))
+        return response
+
+
+async def stream_chat_completion(messages, model="gpt-4o"):
+    """Потоковый вариант chat_completion: отдаёт текст по кусочкам."""
+    async with _openai_semaphore:
+        try:
+            # Ответ на create приходит вместе с началом генерации
+            with metrics.track_dependency("openai", "stream_start"):
+                stream = await openai_client.chat.completions.create(
+                    model=model,
+                    messages=messages,
+                    stream=True,
+                    stream_options={"include_usage": True},
+                    timeout=OPENAI_CHAT_TIMEOUT,
+                )
+        except openai.RateLimitError as e:
+            _report_rate_limit(e)
+            raise
+        with metrics.track_dependency("openai", "stream"):
+            async for chunk in stream:
+                # Последний кусок без choices несёт расход токенов
+                metrics.record_openai_usage(model, getattr(chunk, "usage", None))
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+
+
+async def transcribe_audio(audio_file, model="whisper-1"):
+    """Распознавание речи через Whisper с тем же лимитом параллельности."""
+    async with _openai_semaphore:
+        try:
+            with metrics.track_dependency("openai", "transcribe"):
+                return await openai_client.audio.transcriptions.create(
+                    model=model,
+                    file=audio_file,
+                    timeout=OPENAI_AUDIO_TIMEOUT,
+                )
+        except openai.RateLimitError as e:
+            _report_rate_limit(e)
+            raise
+
+
+def _split_message(text, limit=TELEGRAM_MESSAGE_LIMIT):
+    """Режет длинный текст на части, которые влезают в одно сообщение Telegram."""
+    parts = []
+    while len(text) > limit:
+        cut = text.rfind("\n", 0, limit)
+        if cut <= 0:
+            cut = limit
+        parts.append(text[:cut])
+        text = text[cut:].lstrip("\n")
+    parts.append(text)
+    return parts
+
+
+async def _send_answer(text, send_reply):
+    """Отправляет готовый ответ: сначала пробуем Markdown, потом обычный текст."""
+    for part in _split_message(text):
+        try:
+            await send_reply(part, parse_mode="Markdown")
+        except Exception:
+            await send_reply(part)
+
+
+async def _edit_message(message, text, **kwargs):
+    """
+    Правит сообщение и возвращает паузу (в секундах), которую просит Telegram.
+    Ошибка «message is not modified» и прочие BadRequest не критичны.
+    """
+    try:
+        await message.edit_text(text, **kwargs)
+    except RetryAfter as e:
+        return float(e.retry_after)
+    except BadRequest as e:
+        if kwargs.get("parse_mode"):
+            raise
+        logger.debug(f"Не удалось отредактировать сообщение: {e}")
+    return 0.0
+
+
+async def _stream_answer(messages, note, send_reply):
+    """
+    Отправляет ответ по мере генерации: первое сообщение уходит, как только
+    пришли первые токены, затем оно редактируется не чаще STREAM_EDIT_INTERVAL,
+    а в конце текст перерисовывается с Markdown.
+    """
+    loop = asyncio.get_running_loop()
+    answer = ""
+    message = None
+    next_edit_at = 0.0
+
+    async for delta in stream_chat_completion(messages):
+        answer += delta
+        preview = (note + answer)[: TELEGRAM_MESSAGE_LIMIT - len(STREAM_CURSOR)]
+        if message is None:
+            if answer.strip():
+                message = await send_reply(preview + STREAM_CURSOR)
+                next_edit_at = loop.time() + STREAM_EDIT_INTERVAL
+            continue
+        if loop.time() >= next_edit_at:
+            pause = await _edit_message(message, preview + STREAM_CURSOR)
+            next_edit_at = loop.time() + max(STREAM_EDIT_INTERVAL, pause)
+
+    if message is None:
+        await _send_answer(note + answer, send_reply)
+        return answer
+
+    first, *rest = _split_message(note + answer)
+    for _ in range(3):
+        try:
+            pause = await _edit_message(message, first, parse_mode="Markdown")
+        except BadRequest:
+            pause = await _edit_message(message, first)
+        if not pause:
+            break
+        await asyncio.sleep(pause)
+    for part in rest:
+        await _send_answer(part, send_reply)
+    return answer
+
+
+async def retrieve_knowledge(query, limit=4):
+    """
+    Гибридный поиск: BM25 по FTS5 и косинусная близость эмбеддингов,
+    результаты объединяются через reciprocal rank fusion.
+    Возвращает (id фрагментов, [(knowledge_id, отрывок), ...]).
+    """
+    fts_ids = await search_chunk_ids.aio(query, limit * 2)
+    try:
+        semantic = await asyncio.to_thread(embeddings.search, query, limit * 2)
+    except Exception:
+        logger.exception("Ошибка семантического поиска")
+        semantic = []
+
+    scores = {}
+    for ranking in (fts_ids, [chunk_id for chunk_id, _ in semantic]):
+        for rank, chunk_id in enumerate(ranking):
+            scores[chunk_id] = scores.get(chunk_id, 0.0) + 1.0 / (60 + rank)
+    best = sorted(scores, key=scores.get, reverse=True)[:limit]
+    return best, await get_chunk_passages.aio(best)
+
+
+async def add_knowledge(title, content, added_by):
+    """Сохраняет запись в базу знаний и считает эмбеддинги её фрагментов."""
+    knowledge_id = await save_knowledge.aio(title, content, added_by)
+    if knowledge_id:
+        answer_cache.knowledge_added()
+        try:
+            await asyncio.to_thread(embeddings.index_knowledge, [knowledge_id])
+        except Exception:
+            logger.exception("Не удалось посчитать эмбеддинги для новой записи")
+    return knowledge_id
+
+
+def _run_in_background(coro):
+    task = asyncio.get_running_loop().create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
+
+async def _summarize_text(messages):
+    completion = await chat_completion(messages, model=SUMMARY_MODEL)
+    return completion.choices[0].message.content
+
+
+async def _reply_from_cache(cached, send_reply):
+    answer, has_knowledge, _, _ = cached
+    note = "🧠 Я нашла информацию в базе знаний:\n\n" if has_knowledge else ""
+    await _send_answer(note + answer, send_reply)
+    return answer
+
 
-    knowledge_matches = get_relevant_knowledge(user_input)
-    knowledge_text = "\n\n".join(knowledge_matches)
-    has_knowledge = bool(knowledge_matches)
+async def _remember(chat_id, user_id, question, answer):
+    if await conversation.remember_exchange(chat_id, user_id, question, answer):
+        _run_in_background(conversation.summarize(chat_id, user_id, _summarize_text))
+
+
+async def process_user_input(user_id, user_input, context, send_reply, chat_id=None):
+    logger.info(f"User {user_id} wrote: {user_input}")
+    chat_id = user_id if chat_id is None else chat_id
 
     try:
+        # Ответ с историей зависит от разговора («а подробнее?»), поэтому кеш
+        # ответов общий для всех только у вопросов без истории
+        history = await conversation.build_history(chat_id, user_id)
+
+        # Повторный вопрос: если база знаний не менялась, ответ берём из кеша
+        # без поиска и без обращения к LLM
+        cached = None if history else answer_cache.lookup_fast(user_input)
+        if cached is not None:
+            answer = await _reply_from_cache(cached, send_reply)
+            await _remember(chat_id, user_id, user_input, answer)
+            return
+
+        chunk_ids, passages = await retrieve_knowledge(user_input)
+        cached = None if history else await answer_cache.lookup(user_input, chunk_ids)
+        if cached is not None:
+            answer = await _reply_from_cache(cached, send_reply)
+            await _remember(chat_id, user_id, user_input, answer)
+            return
+
+        knowledge_ids = [knowledge_id for knowledge_id, _ in passages]
+        knowledge_text = "\n\n".join(passage for _, passage in passages)
+        has_knowledge = bool(passages)
+
         if has_knowledge:
             note = "🧠 Я нашла информацию в базе знаний:\n\n"
             user_prompt = (
@@ -51,49 +330,94 @@ async def process_user_input(user_id, user_input, context, send_reply):
 
         messages = [
             SYSTEM_PROMPT,
+            *history,
             {"role": "user", "content": user_prompt},
         ]
 
-        completion = openai.chat.completions.create(
-            model="gpt-4o",
-            messages=messages,
-        )
-        answer = completion.choices[0].message.content
+        if LLM_STREAMING:
+            answer = await _stream_answer(messages, note, send_reply)
+        else:
+            completion = await chat_completion(messages)
+            answer = completion.choices[0].message.content
+            await _send_answer(note + answer, send_reply)
 
-        try:
-            await send_reply(note + answer, parse_mode="Markdown")
-        except Exception:
-            await send_reply(note + answer)
+        if not history:
+            await answer_cache.put(user_input, chunk_ids, knowledge_ids, has_knowledge, answer)
+        await _remember(chat_id, user_id, user_input, answer)
 
     except Exception:
         logger.exception("Ошибка в process_user_input")
         await send_reply("⚠️ Произошла ошибка при обработке запроса.")
 
 
+async def _run_scheduled(user_id, user_input, context, send_reply, chat_id):
+    with metrics.time_handler("process_user_input"):
+        await process_user_input(user_id, user_input, context, send_reply, chat_id)
+
+
+# Сообщения пользователей проходят через честную очередь (см. scheduler.py)
+scheduler = FairScheduler(_run_scheduled)
+metrics.register_queue("scheduler", scheduler.pending)
+
+
+def _is_admin(user_id):
+    from handlers import ADMIN_IDS
+
+    return user_id in ADMIN_IDS
+
+
+async def submit_user_input(user_id, user_input, context, send_reply, chat_id):
+    """Ставит вопрос в очередь; при переполнении очереди пользователя — отказ."""
+    accepted = scheduler.submit(
+        user_id, chat_id, user_input, context, send_reply, chat_id,
+        priority=_is_admin(user_id),
+    )
+    if not accepted:
+        await send_reply("⏳ Я ещё отвечаю на предыдущие сообщения, подождите немного.")
+
+
 async def handle_text(update, context):
     user_id = update.effective_user.id
     user_input = update.message.text.strip()
-    await process_user_input(user_id, user_input, context, update.message.reply_text)
+    await submit_user_input(
+        user_id, user_input, context, update.message.reply_text, update.effective_chat.id
+    )
+
+
+def _transcode_to_mp3(data):
+    """OGG/Opus -> MP3 в памяти (ffmpeg через pydub); выполняется в _transcode_pool."""
+    out = io.BytesIO()
+    AudioSegment.from_file(io.BytesIO(data), format="ogg").export(out, format="mp3")
+    return out.getvalue()
+
+
+async def transcribe_voice(data):
+    """Текст голосового сообщения: сначала OGG напрямую, при отказе — через MP3."""
+    if VOICE_SEND_OGG:
+        try:
+            transcript = await transcribe_audio(("voice.ogg", data))
+            return transcript.text.strip()
+        except openai.BadRequestError as e:
+            logger.warning(f"Whisper не принял OGG, перекодируем в MP3: {e}")
+    loop = asyncio.get_running_loop()
+    mp3 = await loop.run_in_executor(_transcode_pool, _transcode_to_mp3, data)
+    transcript = await transcribe_audio(("voice.mp3", mp3))
+    return transcript.text.strip()
 
 
 async def handle_voice(update, context):
     try:
         voice = update.message.voice
-        file = await context.bot.get_file(voice.file_id)
-        file_path = "voice.ogg"
-        mp3_path = "voice.mp3"
-        await file.download_to_drive(file_path)
-        AudioSegment.from_file(file_path).export(mp3_path, format="mp3")
-        with open(mp3_path, "rb") as audio_file:
-            transcript = openai.audio.transcriptions.create(
-                model="whisper-1",
-                file=audio_file,
-            )
-        text = transcript.text.strip()
-        logger.info(f"Transcribed: {text}")
-
-        user_id = update.effective_user.id
-        await process_user_input(user_id, text, context, update.message.reply_text)
+        if voice.file_size and voice.file_size > VOICE_MAX_BYTES:
+            await update.message.reply_text("Голосовое сообщение слишком длинное.")
+            return
+        # Распознаёт воркер (см. jobs.py), ответ придёт, когда задача завершится
+        await jobs.enqueue("voice", {
+            "file_id": voice.file_id,
+            "user_id": update.effective_user.id,
+            "chat_id": update.effective_chat.id,
+            "message_id": update.message.message_id,
+        })
 
     except Exception:
         logger.exception("Error in voice processing")
@@ -102,52 +426,103 @@ async def handle_voice(update, context):
         )
 
 
+async def extract_upload(file, ext):
+    """
+    Текст файла Telegram. Повторная загрузка того же файла (по file_unique_id)
+    не скачивается, файл с уже знакомым содержимым (по md5, в том числе
+    пришедший через Drive) не разбирается заново.
+    """
+    alias = f"tg:{file.file_unique_id}"
+    cached = await get_parsed_text.aio(PARSER_VERSION, alias=alias)
+    if cached:
+        return cached[1]
+
+    fd, path = tempfile.mkstemp(prefix="upload-", suffix=f".{ext}", dir=UPLOAD_SPOOL_DIR)
+    os.close(fd)
+    try:
+        await file.download_to_drive(path)
+        content_md5 = await asyncio.to_thread(file_md5, path)
+        cached = await get_parsed_text.aio(PARSER_VERSION, content_md5=content_md5)
+        if cached:
+            content = cached[1]
+        else:
+            loop = asyncio.get_running_loop()
+            content = await loop.run_in_executor(get_parse_pool(), extract_text, path, ext)
+    finally:
+        os.unlink(path)
+    await save_parsed_text.aio(
+        content_md5, ext, PARSER_VERSION, content, [alias], PARSE_CACHE_MAX_ROWS
+    )
+    return content
+
+
 async def handle_document(update, context):
     try:
         document = update.message.document
-        file_path = f"./{document.file_name}"
-        file = await context.bot.get_file(document.file_id)
-        await file.download_to_drive(file_path)
-        content = ""
-        if file_path.endswith(".txt"):
-            with open(file_path, "r", encoding="utf-8", errors="ignore") as f:
-                content = f.read()
-        elif file_path.endswith(".pdf"):
-            with fitz.open(file_path) as pdf:
-                for page in pdf:
-                    content += page.get_text()
-        elif file_path.endswith(".docx"):
-            doc = docx.Document(file_path)
-            content = "\n".join([para.text for para in doc.paragraphs])
-        else:
+        file_name = document.file_name or "document"
+        ext = file_name.rsplit(".", 1)[-1].lower() if "." in file_name else ""
+        if ext not in SUPPORTED_EXTENSIONS:
+            await update.message.reply_text(
+                f"Пожалуйста, отправьте файл одного из форматов: {UPLOAD_FORMATS}."
+            )
+            return
+        if document.file_size and document.file_size > UPLOAD_MAX_BYTES:
             await update.message.reply_text(
-                "Пожалуйста, отправьте .txt, .pdf или .docx файл."
+                f"Файл слишком большой: максимум {UPLOAD_MAX_BYTES // (1024 * 1024)} МБ."
             )
             return
 
-        save_conversation(update.effective_user.id, content)
+        # Скачивает и разбирает воркер (см. jobs.py), он же сообщит о результате
+        await jobs.enqueue("document", {
+            "file_id": document.file_id,
+            "file_name": file_name,
+            "ext": ext,
+            "user_id": update.effective_user.id,
+            "chat_id": update.effective_chat.id,
+            "message_id": update.message.message_id,
+        })
         logger.info(
-            f"Received document from {update.effective_user.id}: {document.file_name}"
-        )
-        await update.message.reply_text(
-            "Файл принят и обработан. Я запомнила информацию!"
+            f"Received document from {update.effective_user.id}: {file_name}"
         )
+        await update.message.reply_text("📥 Файл получен, обрабатываю…")
     except Exception:
         logger.exception("Error in document processing")
         await update.message.reply_text(
-            "Не удалось обработать документ. Поддерживаются .txt, .pdf и .docx файлы."
+            f"Не удалось обработать документ. Поддерживаются форматы: {UPLOAD_FORMATS}."
         )
 
 
-async def sync_every_hour():
-    from google_connect import sync_drive_folder_to_knowledge
+# Плановая выгрузка активности в Google Sheets (инкрементальная, см.
+# google_connect.export_daily_activity_to_sheet); без ID таблицы выключена.
+ACTIVITY_EXPORT_SPREADSHEET_ID = os.environ.get("ACTIVITY_EXPORT_SPREADSHEET_ID")
+ACTIVITY_EXPORT_RANGE = os.environ.get("ACTIVITY_EXPORT_RANGE", "Лист1!A1")
+ACTIVITY_EXPORT_INTERVAL = float(os.environ.get("ACTIVITY_EXPORT_INTERVAL", "3600"))
+
+
+async def export_activity_periodically():
+    while True:
+        await asyncio.sleep(ACTIVITY_EXPORT_INTERVAL)
+        try:
+            await activity_buffer.flush()
+            await jobs.enqueue(
+                "export_stats",
+                {"spreadsheet_id": ACTIVITY_EXPORT_SPREADSHEET_ID, "range_name": ACTIVITY_EXPORT_RANGE},
+                dedupe_key=f"export_stats:{ACTIVITY_EXPORT_SPREADSHEET_ID}",
+            )
+        except Exception:
+            logger.exception("Ошибка планового экспорта активности")
 
+
+async def sync_every_hour():
     folder_id = os.environ.get("GOOGLE_DRIVE_FOLDER_ID")
     while True:
         try:
             logger.info("⏳ Автоматическая синхронизация папки Google Диска")
             if folder_id:
-                sync_drive_folder_to_knowledge(folder_id)
+                # Выполнит воркер; если прошлая синхронизация ещё идёт, новая не ставится
+                await jobs.enqueue(
+                    "drive_sync", {"folder_id": folder_id}, dedupe_key=f"drive_sync:{folder_id}"
+                )
         except Exception as e:
             logger.error(f"Ошибка при авто-синхронизации: {e}")
         await asyncio.sleep(3600)
@@ -156,11 +531,7 @@ async def sync_every_hour():
 # ---------- Логирование первой и последней активности за день ----------
 
 async def log_daily_activity(update, context):
-    """
-    ВРЕМЕННЫЙ ВАРИАНТ:
-    Пишем первую/последнюю активность за день напрямую в БД, минуя db_utils,
-    чтобы убедиться, что хендлер работает и БД заполняется.
-    """
+    """Учитывает первую/последнюю активность за день (в БД пишется пачками, см. activity.py)."""
     msg = update.effective_message
     if msg is None or msg.from_user is None:
         return
@@ -169,29 +540,8 @@ async def log_daily_activity(update, context):
 
     username = msg.from_user.username or msg.from_user.full_name or ""
     now = msg.date or datetime.utcnow()
-    day = now.date().isoformat()
-    iso_dt = now.isoformat()
 
-    logger.info(
-        f"[ACTIVITY] direct-write chat={msg.chat.id} user={msg.from_user.id} ({username}) day={day} dt={iso_dt}"
+    logger.debug(
+        f"[ACTIVITY] chat={msg.chat.id} user={msg.from_user.id} ({username}) dt={now.isoformat()}"
     )
-
-    conn = sqlite3.connect("liza_db.db")
-    cursor = conn.cursor()
-
-    cursor.execute("""
-        INSERT INTO daily_user_activity (chat_id, user_id, username, day, first_msg, last_msg)
-        VALUES (?, ?, ?, ?, ?, ?)
-        ON CONFLICT(chat_id, user_id, day) DO UPDATE SET
-            username = excluded.username,
-            last_msg = excluded.last_msg
-    """, (
-        msg.chat.id,
-        msg.from_user.id,
-        username,
-        day,
-        iso_dt,
-        iso_dt,
-    ))
-    conn.commit()
-    conn.close()
+    activity_buffer.record(msg.chat.id, msg.from_user.id, username, now)
@@ -0,0 +1,126 @@
+import asyncio
+import functools
+import logging
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+DB_PATH = os.environ.get("LIZA_DB_PATH", "liza_db.db")
+DB_READERS = int(os.environ.get("DB_READERS", "2"))
+
+# Настройки соединения: WAL позволяет читателям не ждать писателя,
+# synchronous=NORMAL в WAL-режиме делает fsync только на checkpoint.
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-16000",
+    "PRAGMA mmap_size=134217728",
+    "PRAGMA busy_timeout=5000",
+)
+
+
+class Storage:
+    """
+    Долгоживущие соединения с SQLite, работающие в отдельных потоках:
+    - один поток-писатель со своим соединением (все изменения идут через него);
+    - небольшой пул потоков-читателей, у каждого своё соединение.
+    Подготовленные выражения кешируются самим sqlite3 (cached_statements).
+    """
+
+    def __init__(self, path=DB_PATH, readers=DB_READERS):
+        self.path = path
+        self._local = threading.local()
+        self._writer = ThreadPoolExecutor(
+            max_workers=1,
+            thread_name_prefix="db-writer",
+            initializer=self._open,
+            initargs=("writer",),
+        )
+        self._readers = ThreadPoolExecutor(
+            max_workers=readers,
+            thread_name_prefix="db-reader",
+            initializer=self._open,
+            initargs=("reader",),
+        )
+
+    def _open(self, role):
+        conn = sqlite3.connect(self.path, cached_statements=256)
+        for pragma in PRAGMAS:
+            conn.execute(pragma)
+        if role == "reader":
+            conn.execute("PRAGMA query_only=ON")
+        self._local.conn = conn
+        self._local.role = role
+
+    def _call(self, fn, write, args, kwargs, submitted_at=None):
+        conn = self._local.conn
+        mode = "write" if write else "read"
+        started = time.perf_counter()
+        if submitted_at is not None:
+            metrics.db_wait_seconds.observe(started - submitted_at, mode=mode)
+        try:
+            if not write:
+                return fn(conn, *args, **kwargs)
+            with conn:
+                return fn(conn, *args, **kwargs)
+        finally:
+            metrics.db_query_seconds.observe(
+                time.perf_counter() - started, query=fn.__name__, mode=mode
+            )
+
+    def _submit(self, fn, write, args, kwargs):
+        executor = self._writer if write else self._readers
+        return executor.submit(self._call, fn, write, args, kwargs, time.perf_counter())
+
+    def run(self, fn, *args, write=False, **kwargs):
+        """
+        Синхронно выполняет fn(conn, *args, **kwargs) в потоке БД.
+        Вызов из потока БД выполняется сразу, чтобы не было взаимной блокировки.
+        """
+        role = getattr(self._local, "role", None)
+        if role == "writer" or (role == "reader" and not write):
+            return self._call(fn, write, args, kwargs)
+        return self._submit(fn, write, args, kwargs).result()
+
+    async def arun(self, fn, *args, write=False, **kwargs):
+        """Асинхронный вариант run: event loop не ждёт диска."""
+        return await asyncio.wrap_future(self._submit(fn, write, args, kwargs))
+
+    def close(self):
+        try:
+            self.run(lambda conn: conn.execute("PRAGMA optimize"), write=True)
+        except Exception:
+            logger.exception("Ошибка при PRAGMA optimize")
+        self._readers.shutdown(wait=True)
+        self._writer.shutdown(wait=True)
+
+
+db = Storage()
+
+
+def _db_call(write):
+    def decorator(fn):
+        @functools.wraps(fn)
+        def sync(*args, **kwargs):
+            return db.run(fn, *args, write=write, **kwargs)
+
+        async def aio(*args, **kwargs):
+            return await db.arun(fn, *args, write=write, **kwargs)
+
+        sync.aio = aio
+        return sync
+
+    return decorator
+
+
+# Функции вида f(conn, ...) превращаются в f(...), выполняемую в потоке БД;
+# из асинхронного кода их нужно вызывать как `await f.aio(...)`.
+db_read = _db_call(write=False)
+db_write = _db_call(write=True)
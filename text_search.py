@@ -0,0 +1,181 @@
+import re
+
+# Подготовка текста для полнотекстового индекса (FTS5).
+# В SQLite нет русского стеммера, поэтому и документы, и запросы
+# приводятся к основам здесь, а FTS5 хранит уже «стеммированный» текст.
+
+_WORD_RE = re.compile(r"[0-9a-zа-яё]+", re.IGNORECASE)
+
+STOP_WORDS = frozenset(
+    """
+    а без более бы был была были было быть в вам вас весь во вот все всё всего
+    где да даже для до его ее её если есть еще ещё же за здесь и из или им их
+    к как какая какие какой когда кто ли либо мне может мы на над надо наш не
+    него нее неё нет ни них но ну о об однако он она они оно от очень по под
+    при про с со так также такой там те тем то того тоже той только том ты у
+    уже хотя чего чей чем что чтобы чье чьё эта эти это этот я
+    подскажи подскажите скажи скажите пожалуйста расскажи расскажите
+    the a an and or of to in on for is are what where how
+    """.split()
+)
+
+_VOWELS = "аеиоуыэюя"
+
+_PERFECTIVE_GERUND_1 = ("вшись", "вши", "в")
+_PERFECTIVE_GERUND_2 = ("ывшись", "ившись", "ывши", "ивши", "ыв", "ив")
+_ADJECTIVE = (
+    "ими", "ыми", "его", "ого", "ему", "ому", "ее", "ие", "ые", "ое", "ей", "ий",
+    "ый", "ой", "ем", "им", "ым", "ом", "их", "ых", "ую", "юю", "ая", "яя", "ою", "ею",
+)
+_PARTICIPLE_1 = ("ем", "нн", "вш", "ющ", "щ")
+_PARTICIPLE_2 = ("ивш", "ывш", "ующ")
+_REFLEXIVE = ("ся", "сь")
+_VERB_1 = (
+    "ете", "йте", "ешь", "нно", "ла", "на", "ли", "ем", "ло", "но", "ет", "ют",
+    "ны", "ть", "й", "л", "н",
+)
+_VERB_2 = (
+    "ейте", "уйте", "ила", "ыла", "ена", "ите", "или", "ыли", "ило", "ыло", "ено",
+    "ует", "уют", "ены", "ить", "ыть", "ишь", "ей", "уй", "ил", "ыл", "им", "ым",
+    "ен", "ят", "ит", "ыт", "ую", "у", "ю",
+)
+_NOUN = (
+    "иями", "ями", "ами", "ией", "иям", "ием", "иях", "ев", "ов", "ие", "ье", "еи",
+    "ии", "ей", "ой", "ий", "ям", "ем", "ам", "ом", "ах", "ях", "ию", "ью", "ия",
+    "ья", "а", "е", "и", "й", "о", "у", "ы", "ь", "ю", "я",
+)
+_SUPERLATIVE = ("ейше", "ейш")
+_DERIVATIONAL = ("ость", "ост")
+
+
+def _sorted(suffixes):
+    return tuple(sorted(suffixes, key=len, reverse=True))
+
+
+_PERFECTIVE_GERUND_1 = _sorted(_PERFECTIVE_GERUND_1)
+_PERFECTIVE_GERUND_2 = _sorted(_PERFECTIVE_GERUND_2)
+_ADJECTIVE = _sorted(_ADJECTIVE)
+_PARTICIPLE_1 = _sorted(_PARTICIPLE_1)
+_PARTICIPLE_2 = _sorted(_PARTICIPLE_2)
+_VERB_1 = _sorted(_VERB_1)
+_VERB_2 = _sorted(_VERB_2)
+_NOUN = _sorted(_NOUN)
+
+
+def _strip_after_a_ya(word, suffixes):
+    """Суффиксы группы 1 удаляются, только если перед ними стоит «а» или «я»."""
+    for suffix in suffixes:
+        if word.endswith(suffix) and word[: -len(suffix)][-1:] in ("а", "я"):
+            return word[: -len(suffix)]
+    return None
+
+
+def _strip(word, suffixes):
+    for suffix in suffixes:
+        if word.endswith(suffix):
+            return word[: -len(suffix)]
+    return None
+
+
+def _regions(word):
+    """Возвращает начало областей RV и R2 (по алгоритму Snowball)."""
+    rv = len(word)
+    for i, ch in enumerate(word):
+        if ch in _VOWELS:
+            rv = i + 1
+            break
+    r1 = len(word)
+    for i in range(1, len(word)):
+        if word[i - 1] in _VOWELS and word[i] not in _VOWELS:
+            r1 = i + 1
+            break
+    r2 = len(word)
+    for i in range(r1 + 1, len(word)):
+        if word[i - 1] in _VOWELS and word[i] not in _VOWELS:
+            r2 = i + 1
+            break
+    return rv, r2
+
+
+def stem_ru(word):
+    """Упрощённый Snowball-стеммер для русского языка."""
+    word = word.lower().replace("ё", "е")
+    if not re.search("[а-я]", word):
+        return word
+    rv, r2 = _regions(word)
+    head, tail = word[:rv], word[rv:]
+
+    # Шаг 1: деепричастия, иначе возвратность + прилагательные/глаголы/существительные
+    stripped = _strip_after_a_ya(tail, _PERFECTIVE_GERUND_1)
+    if stripped is None:
+        stripped = _strip(tail, _PERFECTIVE_GERUND_2)
+    if stripped is not None:
+        tail = stripped
+    else:
+        reflexive = _strip(tail, _REFLEXIVE)
+        if reflexive is not None:
+            tail = reflexive
+        adjective = _strip(tail, _ADJECTIVE)
+        if adjective is not None:
+            tail = adjective
+            participle = _strip_after_a_ya(tail, _PARTICIPLE_1)
+            if participle is None:
+                participle = _strip(tail, _PARTICIPLE_2)
+            if participle is not None:
+                tail = participle
+        else:
+            verb = _strip_after_a_ya(tail, _VERB_1)
+            if verb is None:
+                verb = _strip(tail, _VERB_2)
+            if verb is not None:
+                tail = verb
+            else:
+                noun = _strip(tail, _NOUN)
+                if noun is not None:
+                    tail = noun
+
+    # Шаг 2: «и» на конце
+    if tail.endswith("и"):
+        tail = tail[:-1]
+
+    # Шаг 3: словообразовательные суффиксы в R2
+    r2_in_tail = max(r2 - rv, 0)
+    derivational = _strip(tail, _DERIVATIONAL)
+    if derivational is not None and len(derivational) >= r2_in_tail:
+        tail = derivational
+
+    # Шаг 4: «нн» -> «н», превосходная степень, мягкий знак
+    superlative = _strip(tail, _SUPERLATIVE)
+    if superlative is not None:
+        tail = superlative
+    if tail.endswith("нн"):
+        tail = tail[:-1]
+    elif tail.endswith("ь"):
+        tail = tail[:-1]
+
+    return head + tail
+
+
+def tokenize(text):
+    return _WORD_RE.findall(text.lower())
+
+
+def stem_text(text):
+    """Текст для индексации: основы всех слов через пробел."""
+    return " ".join(stem_ru(token) for token in tokenize(text))
+
+
+def build_match_query(text):
+    """
+    Превращает вопрос на естественном языке в запрос FTS5:
+    основы значимых слов, объединённые через OR (ранжирует BM25).
+    Возвращает пустую строку, если искать нечего.
+    """
+    terms = []
+    for token in tokenize(text):
+        if token in STOP_WORDS or len(token) < 2:
+            continue
+        stem = stem_ru(token)
+        if stem and stem not in terms:
+            terms.append(stem)
+    return " OR ".join(f'"{term}"' for term in terms)
@@ -0,0 +1,142 @@
+import asyncio
+import hmac
+import logging
+import os
+import signal
+
+from aiohttp import web
+from telegram import Update
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Режим webhook: Telegram сам присылает обновления на встроенный aiohttp-сервер.
+# Запрос подтверждается сразу (200), обновление кладётся в ограниченную
+# очередь и обрабатывается одним из WEBHOOK_WORKERS обработчиков.
+# Если очередь заполнена, отвечаем 503 — Telegram повторит доставку позже.
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL", "")
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "/telegram")
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET", "")
+WEBHOOK_HOST = os.environ.get("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.environ.get("PORT", "8080"))
+WEBHOOK_QUEUE_SIZE = int(os.environ.get("WEBHOOK_QUEUE_SIZE", "1000"))
+WEBHOOK_WORKERS = int(os.environ.get("WEBHOOK_WORKERS", "16"))
+WEBHOOK_MAX_CONNECTIONS = int(os.environ.get("WEBHOOK_MAX_CONNECTIONS", "40"))
+WEBHOOK_DRAIN_TIMEOUT = float(os.environ.get("WEBHOOK_DRAIN_TIMEOUT", "30"))
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+class WebhookServer:
+    def __init__(self, application, secret=WEBHOOK_SECRET, path=WEBHOOK_PATH,
+                 queue_size=WEBHOOK_QUEUE_SIZE, workers=WEBHOOK_WORKERS):
+        self.application = application
+        self.secret = secret
+        self.path = path
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.workers_count = workers
+        self._workers = []
+        self._runner = None
+        metrics.register_queue("webhook", self.queue.qsize)
+
+    def make_app(self):
+        app = web.Application()
+        app.router.add_post(self.path, self.handle_update)
+        app.router.add_get("/healthz", self.handle_health)
+        # Webhook-сервер доступен из интернета: метрики на нём — только с токеном
+        if metrics.METRICS_TOKEN:
+            app.router.add_get("/metrics", metrics.handle_metrics)
+        return app
+
+    async def handle_health(self, request):
+        return web.json_response({"queued": self.queue.qsize()})
+
+    async def handle_update(self, request):
+        token = request.headers.get(SECRET_HEADER, "")
+        # compare_digest не принимает str с не-ASCII символами — сравниваем байты
+        if not self.secret or not hmac.compare_digest(
+            token.encode("utf-8", "surrogateescape"), self.secret.encode("utf-8", "surrogateescape")
+        ):
+            return web.Response(status=403)
+        try:
+            data = await request.json()
+        except ValueError:
+            return web.Response(status=400)
+        update = Update.de_json(data, self.application.bot)
+        try:
+            self.queue.put_nowait(update)
+        except asyncio.QueueFull:
+            logger.warning("Очередь обновлений webhook переполнена, просим Telegram повторить")
+            return web.Response(status=503)
+        return web.Response()
+
+    async def _work(self):
+        while True:
+            update = await self.queue.get()
+            try:
+                await self.application.process_update(update)
+            except Exception:
+                logger.exception("Ошибка при обработке обновления из webhook")
+            finally:
+                self.queue.task_done()
+
+    async def start(self, host=WEBHOOK_HOST, port=WEBHOOK_PORT):
+        self._workers = [
+            asyncio.get_running_loop().create_task(self._work())
+            for _ in range(self.workers_count)
+        ]
+        self._runner = web.AppRunner(self.make_app())
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        logger.info(f"Webhook-сервер слушает {host}:{port}{self.path}")
+
+    async def stop(self, drain_timeout=WEBHOOK_DRAIN_TIMEOUT):
+        """Перестаёт принимать запросы, дожидается уже принятых обновлений."""
+        if self._runner is not None:
+            await self._runner.cleanup()
+        try:
+            await asyncio.wait_for(self.queue.join(), drain_timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Не дождались обработки {self.queue.qsize()} обновлений")
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+
+
+async def run_webhook(application, on_startup, on_stop, on_shutdown):
+    """
+    Запускает бота в режиме webhook до SIGINT/SIGTERM.
+    on_startup() — запуск фоновых задач; on_stop(application) и
+    on_shutdown(application) — то же, что post_stop и post_shutdown в режиме
+    polling, и в том же порядке относительно application.stop()/shutdown().
+    """
+    if not WEBHOOK_URL or not WEBHOOK_SECRET:
+        raise RuntimeError("Для BOT_MODE=webhook нужны WEBHOOK_URL и WEBHOOK_SECRET")
+
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+
+    server = WebhookServer(application)
+    await application.initialize()
+    # Фоновые задачи бесконечны: запускаем их до application.start(), как в
+    # режиме polling, иначе application.stop() будет ждать их завершения
+    on_startup()
+    await application.start()
+    try:
+        await server.start()
+        await application.bot.set_webhook(
+            url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=Update.ALL_TYPES,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+        )
+        await stop_event.wait()
+        logger.info("Остановка: дожидаемся обработки принятых обновлений")
+    finally:
+        await server.stop()
+        await on_stop(application)
+        await application.stop()
+        await application.shutdown()
+        await on_shutdown(application)
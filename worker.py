@@ -0,0 +1,49 @@
+import asyncio
+import logging
+import os
+import signal
+import socket
+
+from db_utils import create_db
+from extraction import shutdown_parse_pool
+from jobs import Worker
+import metrics
+from storage import db
+
+# Отдельный процесс для тяжёлых задач (распознавание голосовых, разбор
+# документов, синхронизация Drive, экспорт в Sheets) — см. jobs.py.
+# Запуск: python worker.py (процесс worker в Procfile). Воркеров может быть
+# несколько; их число объявляется боту в WORKER_PROCESSES, тогда встроенный
+# в бота воркер выключается.
+
+logging.basicConfig(
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+    level=logging.INFO,
+)
+logger = logging.getLogger(__name__)
+
+
+async def main():
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    name = f"{socket.gethostname()}-{os.getpid()}"
+    logger.info(f"Воркер {name} запущен")
+    monitor = loop.create_task(metrics.monitor_event_loop())
+    metrics_server = await metrics.start_server() if metrics.METRICS_PORT else None
+    try:
+        await Worker(name).run(stop)
+    finally:
+        monitor.cancel()
+        if metrics_server is not None:
+            await metrics_server.cleanup()
+        await asyncio.to_thread(shutdown_parse_pool)
+        await asyncio.to_thread(db.close)
+    logger.info(f"Воркер {name} остановлен")
+
+
+if __name__ == "__main__":
+    create_db()
+    asyncio.run(main())